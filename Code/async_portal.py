@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+# asyncio harvesting of users, groups and items straight from the portal REST API. Every request goes through one
+# keep-alive connection pool, at most `concurrency` requests are in flight and 429/5xx answers are retried with
+# exponential backoff. The results are plain REST JSON, turned into CSV rows by get_portal_data_async.
+
+# HTTP statuses (or the code of an ArcGIS JSON error) worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Portal search refuses to page beyond this many results for a single query
+SEARCH_WINDOW = 10000
+
+
+class AsyncPortalClient:
+
+    def __init__(self, rest_url, token=None, concurrency=16, requests_per_second=20, retries=5, referer='http',
+                 on_request=None):
+        self.rest_url = rest_url.rstrip('/') + '/'
+        self.params = {'f': 'json', 'token': token} if token else {'f': 'json'}
+        self.headers = {'Referer': referer}
+        self.concurrency = concurrency
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0
+        self.retries = retries
+        # on_request(url, seconds, failed) is called after every attempt, e.g. RunMetrics.record_request
+        self.on_request = on_request
+        self.next_slot = 0
+        self.semaphore = None
+        self.session = None
+        self.requests = 0
+        self.retried = 0
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60, ssl=False)
+        self.session = aiohttp.ClientSession(connector=connector, headers=self.headers,
+                                             timeout=aiohttp.ClientTimeout(total=120))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def throttle(self):
+        # Same spacing as HostRateLimiter; the event loop is single threaded so no lock is needed
+        if self.interval == 0:
+            return
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def fetch(self, url, params):
+        # (status, body, Retry-After) of a single attempt, status is None when the connection itself failed
+        async with self.semaphore:
+            await self.throttle()
+            self.requests += 1
+            started = time.perf_counter()
+            status, body, retry_after = None, None, None
+            try:
+                async with self.session.get(url, params=params) as response:
+                    body = await response.json(content_type=None) if response.status < 400 else None
+                    status = response.status
+                    if isinstance(body, dict) and 'error' in body:
+                        status = body['error'].get('code', 500)
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                pass
+            if self.on_request is not None:
+                self.on_request(url, time.perf_counter() - started, status is None or status >= 400)
+            return status, body, retry_after
+
+    async def get(self, path, **params):
+        url = self.rest_url + path
+        params = dict(self.params, **params)
+        for attempt in range(self.retries + 1):
+            status, body, retry_after = await self.fetch(url, params)
+            if status is not None and status < 400:
+                return body
+            if (status is not None and status not in RETRY_STATUS) or attempt == self.retries:
+                raise RuntimeError('{0} failed ({1}): {2}'.format(path, status, body.get('error') if body else None))
+            self.retried += 1
+            if retry_after and retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = min(60, 2 ** attempt) * (0.5 + random.random())
+            await asyncio.sleep(delay)
+
+    async def paged(self, path, page_size=100, first=None, **params):
+        # (results, total) of a start/num paged endpoint, the pages after the first are requested concurrently
+        if first is None:
+            first = await self.get(path, start=1, num=page_size, **params)
+        total = first.get('total', 0)
+        rest = await asyncio.gather(*[self.get(path, start=start, num=page_size, **params)
+                                      for start in range(1 + page_size, min(total, SEARCH_WINDOW) + 1, page_size)])
+        return [result for page in [first] + rest for result in page.get('results', [])], total
+
+    async def anchored(self, path, query, key, page_size=100, **params):
+        # Like search_items in portal_audit_tools: results past SEARCH_WINDOW are reached by re-anchoring the
+        # query on the created time of the last result seen, skipping the results (by key) already returned at
+        # that time. Pages inside one window are requested concurrently.
+        results = []
+        created_from = None
+        skip_keys = set()
+        while True:
+            q = query
+            if created_from is not None:
+                q = '({0}) AND created:[{1:019d} TO 9999999999999999999]'.format(query, created_from)
+            window, total = await self.paged(path, page_size, q=q, sortField='created', sortOrder='asc', **params)
+            window = [result for result in window if result[key] not in skip_keys]
+            results.extend(window)
+
+            if total <= SEARCH_WINDOW:
+                return results
+            last_created = window[-1]['created'] if window else created_from
+            if last_created == created_from:
+                raise RuntimeError('{0}: more than {1} results share created time {2}, they cannot all be paged'.format(
+                    path, SEARCH_WINDOW, last_created))
+            created_from = last_created
+            skip_keys = {result[key] for result in window if result['created'] == last_created}
+
+    async def pages(self, path, key, page_size=100, **params):
+        # Every result of a users or groups search: in the requested order when they fit in one SEARCH_WINDOW,
+        # otherwise in created order, re-anchored like search_items
+        first = await self.get(path, start=1, num=page_size, **params)
+        if first.get('total', 0) <= SEARCH_WINDOW:
+            results, total = await self.paged(path, page_size, first=first, **params)
+            return results
+        logging.info('{0} has {1} results, paging them by created time'.format(path, first['total']))
+        params.pop('sortField', None)
+        return await self.anchored(path, params.pop('q'), key, page_size, **params)
+
+    async def search_items(self, query, page_size=100):
+        return await self.anchored('search', query, 'id', page_size)
+
+
+class GroupTitles:
+    # group id -> title, seeded from the group search; unknown ids are requested once however many callers ask
+
+    def __init__(self, client, groups):
+        self.client = client
+        self.titles = {g['id']: g['title'] for g in groups}
+        self.pending = {}
+
+    async def title(self, group_id):
+        if group_id in self.titles:
+            return self.titles[group_id]
+        if group_id not in self.pending:
+            self.pending[group_id] = asyncio.ensure_future(self.client.get('community/groups/{0}'.format(group_id)))
+        try:
+            group = await self.pending[group_id]
+            title = group.get('title', group_id)
+        except RuntimeError:
+            title = group_id
+        self.titles[group_id] = title
+        return title
+
+
+async def item_sharing(client, titles, item):
+    # Titles of every group the item is shared with, as item.shared_with would return them
+    sharing = await client.get('content/items/{0}/groups'.format(item['id']))
+    groups = sharing.get('admin', []) + sharing.get('member', []) + sharing.get('other', [])
+    return await asyncio.gather(*[titles.title(g['id']) for g in groups])
+
+
+async def user_groups(client, titles, user):
+    detail = await client.get('community/users/{0}'.format(user['username']))
+    return await asyncio.gather(*[titles.title(g['id']) for g in detail.get('groups', [])])
+
+
+async def group_detail(client, group):
+    # Members (owner/admins/users) and the number of items shared to the group
+    members, content = await asyncio.gather(client.get('community/groups/{0}/users'.format(group['id'])),
+                                            client.get('search', q='group:{0}'.format(group['id']), num=0))
+    return members, content.get('total', 0)
+
+
+async def harvest(client, user_query, group_query, item_query, reuse_user, reuse_group, reuse_item):
+    # reuse_* say whether a record is unchanged since the previous run, in which case its per-record
+    # lookups are skipped and None is returned in their place. A lookup that still fails after its retries
+    # returns the error instead, so one bad record doesn't sink the whole harvest.
+    groups, items = await asyncio.gather(client.pages('community/groups', 'id', q=group_query, sortField='title'),
+                                         client.search_items(item_query))
+    users = await client.pages('community/users', 'username', q=user_query, sortField='username')
+    titles = GroupTitles(client, groups)
+
+    async def maybe(reuse, lookup, *args):
+        if reuse(args[-1]):
+            return None
+        try:
+            return await lookup(*args)
+        except RuntimeError as error:
+            logging.error('{0} failed: {1}'.format(lookup.__name__, error))
+            return error
+
+    item_details, user_details, group_details = await asyncio.gather(
+        asyncio.gather(*[maybe(reuse_item, item_sharing, client, titles, item) for item in items]),
+        asyncio.gather(*[maybe(reuse_user, user_groups, client, titles, user) for user in users]),
+        asyncio.gather(*[maybe(reuse_group, group_detail, client, group) for group in groups]))
+    return {'users': list(zip(users, user_details)), 'groups': list(zip(groups, group_details)),
+            'items': list(zip(items, item_details)), 'group_titles': titles.titles}
+
+
+def harvest_portal(rest_url, token, user_query, group_query, item_query, reuse_user, reuse_group, reuse_item,
+                   concurrency=16, requests_per_second=20, referer='http', on_request=None):
+    async def run():
+        async with AsyncPortalClient(rest_url, token, concurrency, requests_per_second, referer=referer,
+                                     on_request=on_request) as client:
+            result = await harvest(client, user_query, group_query, item_query, reuse_user, reuse_group, reuse_item)
+            logging.info('Async harvest: {0} requests, {1} retried'.format(client.requests, client.retried))
+            return result
+    return asyncio.run(run())
@@ -0,0 +1,267 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import path
+
+from run_metrics import peak_rss_mb
+
+# Offline benchmarks for the audit pipeline: a synthetic portal (synthetic_portal.FakeGIS) stands in for ArcGIS
+# Enterprise and synthetic_logs generates the request data, so this runs on a plain Linux box without ArcGIS.
+# Every measurement runs in a fresh process, so peak RSS belongs to that stage alone.
+#
+#   python benchmark.py --scale small medium --output results.json
+#   python benchmark.py --scale small --baseline results.json
+
+SCALES = {'small': {'users': 500, 'groups': 100, 'items': 5000, 'rows': 1000000, 'log_rows': 200000},
+          'medium': {'users': 5000, 'groups': 1000, 'items': 50000, 'rows': 10000000, 'log_rows': 2000000},
+          'large': {'users': 20000, 'groups': 5000, 'items': 200000, 'rows': 50000000, 'log_rows': 10000000}}
+
+# Rows per chunk in the chunked process_sys_log_report benchmark
+CHUNK_ROWS = 250000
+
+
+def import_audit_tools():
+    from synthetic_portal import FakeItem, FakeUser, install_stand_ins
+    install_stand_ins()
+    import portal_audit_tools
+    # Search results are wrapped in the synthetic classes even when the real arcgis package is installed
+    portal_audit_tools.Item = FakeItem
+    portal_audit_tools.User = FakeUser
+    logging.getLogger().setLevel(logging.WARNING)
+    return portal_audit_tools
+
+
+def fake_portal(scale, latency):
+    from synthetic_portal import FakeGIS
+    return FakeGIS(users=scale['users'], groups=scale['groups'], items=scale['items'], latency=latency)
+
+
+def prepare_sys_log(data_dir, scale):
+    from synthetic_logs import write_items_csv, write_sys_log_report
+    resources = write_sys_log_report(path.join(data_dir, 'sys_log_report'), scale['rows'])
+    write_items_csv(path.join(data_dir, 'csv_files'), resources)
+
+
+def prepare_server_logs(data_dir, scale):
+    from synthetic_logs import write_server_logs
+    write_server_logs(path.join(data_dir, 'server_logs'), scale['log_rows'])
+
+
+def run_get_portal_data(data_dir, scale, latency, workers):
+    audit_tools = import_audit_tools()
+    portal = fake_portal(scale, latency)
+    os.makedirs(path.join(data_dir, 'csv_files'), exist_ok=True)
+    started = time.perf_counter()
+    if audit_tools.get_portal_data(portal, data_dir, workers, 0) is None:
+        raise RuntimeError('get_portal_data failed, see the log')
+    return time.perf_counter() - started, scale['users'] + scale['groups'] + scale['items']
+
+
+def prepare_portal_csvs(data_dir, scale):
+    # items.csv and users.csv from the synthetic portal, without latency
+    run_get_portal_data(data_dir, scale, 0, 8)
+
+
+def run_check_governance(data_dir, scale, latency, workers):
+    audit_tools = import_audit_tools()
+    portal = fake_portal(scale, latency)
+    title_13_item = next(iter(portal.item_records))
+    notifications = audit_tools.NotificationQueue(None, None, path.join(data_dir, 'notifications'))
+    policy = {'required_tags': ['demo'], 'public_item_types': ['Web Map'], 'stale_days': 30, 'max_size_mb': 50}
+    started = time.perf_counter()
+    if audit_tools.check_governance(portal, title_13_item, notifications, data_dir, policy, None, None,
+                                    workers) is None:
+        raise RuntimeError('check_governance failed, see the log')
+    return time.perf_counter() - started, scale['items']
+
+
+def run_process_sys_log_report(data_dir, scale, latency, workers):
+    audit_tools = import_audit_tools()
+    started = time.perf_counter()
+    if audit_tools.process_sys_log_report(data_dir) is None:
+        raise RuntimeError('process_sys_log_report failed, see the log')
+    return time.perf_counter() - started, scale['rows']
+
+
+def run_process_sys_log_report_chunked(data_dir, scale, latency, workers):
+    audit_tools = import_audit_tools()
+    started = time.perf_counter()
+    if audit_tools.process_sys_log_report(data_dir, chunk_rows=CHUNK_ROWS) is None:
+        raise RuntimeError('process_sys_log_report failed, see the log')
+    return time.perf_counter() - started, scale['rows']
+
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def hwm_rss_mb():
+    # Peak RSS since the last reset_peak_rss (getrusage's ru_maxrss is never reset)
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+
+
+def reset_peak_rss():
+    # Linux only: clears the peak RSS mark so it covers what runs from here on (the stage, not the data loading)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    return {'start_rss_mb': round(current_rss_mb(), 1)}
+
+
+def load_requests(data_dir):
+    # all_requests and items.csv the way process_sys_log_report gets them, with the workbook's plain string columns
+    import pandas as pd
+    requests = pd.read_parquet(path.join(data_dir, 'sys_log_report', 'all_requests.parquet'))
+    requests = requests.astype({'Resource': str, 'User': str, 'Server Machine': str})
+    return requests, pd.read_csv(path.join(data_dir, 'csv_files', 'items.csv'))
+
+
+def item_metrics_before(requests, items_df):
+    # The item_metrics / all_requests block before Resource was parsed once into categorical columns,
+    # kept to measure against. Its filter is corrected to keep feature service requests too, so both cases write
+    # the same rows.
+    items_df = items_df[items_df['TYPE'].isin(['Map Service', 'Feature Service'])]
+    items_df.loc[items_df['TYPE'] == 'Map Service', 'Resource'] = items_df['TITLE'] + '.MapServer'
+    items_df.loc[items_df['TYPE'] == 'Feature Service', 'Resource'] = items_df['TITLE'] + '.FeatureServer'
+    last_accessed = requests.groupby('Resource')['Date Time (Local Time)'].max().reset_index()
+    last_accessed = last_accessed[last_accessed['Resource'].str.contains('GPServer') == False]
+    last_accessed.loc[last_accessed.Resource.str.contains('/'), 'Resource'] = \
+        last_accessed.Resource.str.split('/', expand=True)[1]
+    item_metrics = items_df.merge(right=last_accessed, how='outer', left_on='Resource', right_on='Resource')
+
+    requests = requests[['Date Time (Local Time)', 'Epoch Time', 'Date Time (Day)', 'Date Time (Hour)',
+                         'Date Time (Minute)', 'User', 'Server Machine', 'Content Length (Bytes)', 'HTTP Code',
+                         'Elapsed Time (>= 0 sec)', 'Elapsed Time (Floor)', 'Resource', 'ArcGIS Method',
+                         'ArcGIS Code', 'ArcGIS Type']]
+    requests.rename(columns={'Date Time (Local Time)': 'Date_Time', 'Resource': 'Resource'}, inplace=True)
+    requests = requests[requests['Resource'].str.contains('MapServer|FeatureServer') == True]
+    requests.to_csv(os.devnull, index=False)
+    return item_metrics, requests
+
+
+def run_item_metrics_before(data_dir, scale, latency, workers):
+    requests, items_df = load_requests(data_dir)
+    rss = reset_peak_rss()
+    started = time.perf_counter()
+    item_metrics_before(requests, items_df)
+    return time.perf_counter() - started, scale['rows'], rss
+
+
+def run_item_metrics(data_dir, scale, latency, workers):
+    audit_tools = import_audit_tools()
+    requests, items_df = load_requests(data_dir)
+    rss = reset_peak_rss()
+    started = time.perf_counter()
+    # Handed over without a reference held here, as process_sys_log_report does
+    frames = {'all_requests': requests}
+    del requests
+    chunks = (frames.pop('all_requests') for _ in range(1))
+    last_accessed, rows, requests = audit_tools.export_all_requests(chunks, os.devnull, keep=True)
+    items_df = items_df[items_df['TYPE'].isin(list(audit_tools.SERVICE_ITEM_TYPES))].copy()
+    items_df['Resource'] = items_df['TITLE'] + '.' + items_df['TYPE'].map(audit_tools.SERVICE_ITEM_TYPES)
+    last_accessed = last_accessed.drop('GPServer', level='Service_Type', errors='ignore').reset_index()
+    last_accessed['Resource'] = last_accessed['Service_Name'] + '.' + last_accessed['Service_Type']
+    items_df.merge(right=last_accessed, how='outer', left_on='Resource', right_on='Resource')
+    return time.perf_counter() - started, scale['rows'], rss
+
+
+def run_read_server_logs(data_dir, scale, latency, workers):
+    from server_log_reader import read_server_logs
+    started = time.perf_counter()
+    read_server_logs(path.join(data_dir, 'server_logs'), workers=workers)
+    return time.perf_counter() - started, scale['log_rows']
+
+
+# name -> (prepare, run); run returns (seconds, units processed), plus optionally a dict of extra results
+BENCHMARKS = {'get_portal_data': (None, run_get_portal_data),
+              'check_governance': (prepare_portal_csvs, run_check_governance),
+              'process_sys_log_report': (prepare_sys_log, run_process_sys_log_report),
+              'process_sys_log_report_chunked': (prepare_sys_log, run_process_sys_log_report_chunked),
+              'item_metrics_before': (prepare_sys_log, run_item_metrics_before),
+              'item_metrics': (prepare_sys_log, run_item_metrics),
+              'read_server_logs': (prepare_server_logs, run_read_server_logs)}
+
+
+def measure(run, data_dir, scale, latency, workers):
+    cpu = time.process_time()
+    seconds, units, *extra = run(data_dir, scale, latency, workers)
+    result = {'seconds': round(seconds, 3), 'cpu_seconds': round(time.process_time() - cpu, 3),
+              'units': units, 'units_per_second': round(units / seconds, 1) if seconds else None,
+              'peak_rss_mb': peak_rss_mb()}
+    for values in extra:
+        result.update(values)
+    if 'start_rss_mb' in result:
+        result['peak_rss_mb'] = round(hwm_rss_mb(), 1)
+        result['stage_rss_mb'] = round(result['peak_rss_mb'] - result['start_rss_mb'], 1)
+    return result
+
+
+def in_fresh_process(func, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+
+def compare(results, baseline, tolerance):
+    # Regressions: slower or bigger than the baseline by more than tolerance
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        for metric in ('seconds', 'peak_rss_mb'):
+            if previous.get(metric) and result.get(metric) and result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append('{0} {1}: {2} vs {3}'.format(key, metric, result[metric], previous[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the audit pipeline against synthetic data')
+    parser.add_argument('--scale', nargs='+', default=['small'], choices=list(SCALES))
+    parser.add_argument('--benchmark', nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds added to every synthetic REST call')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = {}
+    for scale_name in args.scale:
+        scale = SCALES[scale_name]
+        for name in args.benchmark:
+            prepare, run = BENCHMARKS[name]
+            data_dir = tempfile.mkdtemp(prefix='audit_benchmark_')
+            try:
+                if prepare is not None:
+                    in_fresh_process(prepare, data_dir, scale)
+                key = '{0}/{1}'.format(name, scale_name)
+                results[key] = in_fresh_process(measure, run, data_dir, scale, args.latency, args.workers)
+                print('{0:40} {1:>10.2f}s {2:>12} units/s {3:>10.0f} MB{4}'.format(
+                    key, results[key]['seconds'], results[key]['units_per_second'], results[key]['peak_rss_mb'] or 0,
+                    ' ({0:.0f} MB above the stage start)'.format(results[key]['stage_rss_mb'])
+                    if 'stage_rss_mb' in results[key] else ''))
+            finally:
+                shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import csv
+import json
+import logging
+import os
+import threading
+from os import path
+
+# Progress of one day's run, kept in <today_dir>/checkpoint.json. Completed stages are skipped when the run is
+# started again, and the long CSV loops in get_portal_data record how far they got so they can pick up there.
+
+
+class RunCheckpoint:
+
+    def __init__(self, checkpoint_file):
+        self.checkpoint_file = checkpoint_file
+        self.lock = threading.Lock()
+        self.state = {'completed': [], 'cursors': {}}
+        if path.isfile(checkpoint_file):
+            with open(checkpoint_file, encoding='utf-8') as f:
+                self.state.update(json.load(f))
+
+    def save(self):
+        # Written to a temporary file first so a crash mid-write can't leave a corrupt checkpoint behind
+        temp_file = self.checkpoint_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(temp_file, self.checkpoint_file)
+
+    def done(self, stage):
+        with self.lock:
+            return stage in self.state['completed']
+
+    def complete(self, stage):
+        with self.lock:
+            self.state['completed'].append(stage)
+            self.save()
+
+    def cursor(self, name):
+        with self.lock:
+            return self.state['cursors'].get(name)
+
+    def set_cursor(self, name, cursor):
+        with self.lock:
+            if cursor is None:
+                self.state['cursors'].pop(name, None)
+            else:
+                self.state['cursors'][name] = cursor
+            self.save()
+
+
+class ResumableCsv:
+    # csv.DictWriter over one of get_portal_data's loops. Every `every` records the file is flushed and its size
+    # saved as a cursor. A rerun truncates the file back to the last cursor and skips the records whose key is in
+    # a row already written, so records added or removed on the portal in between don't shift what gets skipped.
+    # Without a checkpoint it is a plain writer.
+
+    def __init__(self, csv_path, fieldnames, key, checkpoint=None, name=None, every=500):
+        self.csv_path = csv_path
+        self.fieldnames = fieldnames
+        self.key = key
+        self.checkpoint = checkpoint
+        self.name = name or path.splitext(path.basename(csv_path))[0]
+        self.every = every
+        self.written = set()
+        self.consumed = 0
+        self.file = None
+        self.writer = None
+
+    def __enter__(self):
+        cursor = self.checkpoint.cursor(self.name) if self.checkpoint is not None else None
+        if cursor is not None and path.isfile(self.csv_path):
+            self.file = open(self.csv_path, 'r+', newline='', encoding='utf-8')
+            self.file.truncate(cursor['offset'])
+            self.written = {row[self.key] for row in csv.DictReader(self.file)}
+            self.file.seek(cursor['offset'])
+            self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames)
+            logging.info('Resuming {0} after {1} records'.format(self.name, len(self.written)))
+        else:
+            self.file = open(self.csv_path, 'w', newline='', encoding='utf-8')
+            self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames)
+            self.writer.writeheader()
+        return self
+
+    def skip(self, key):
+        # True for records that were already written before the run was interrupted
+        return key in self.written
+
+    def advance(self, key, row=None):
+        if row is not None:
+            self.writer.writerow(row)
+            self.written.add(key)
+        self.consumed += 1
+        if self.checkpoint is not None and self.consumed % self.every == 0:
+            self.save_cursor()
+
+    def save_cursor(self):
+        self.file.flush()
+        self.checkpoint.set_cursor(self.name, {'rows': len(self.written), 'offset': self.file.tell()})
+
+    def __exit__(self, exc_type, exc, traceback):
+        # A finished loop keeps its final cursor until the stage completes, an interrupted one its last good position
+        try:
+            if self.checkpoint is not None:
+                self.save_cursor()
+        finally:
+            self.file.close()
@@ -0,0 +1,153 @@
+import operator
+import re
+from functools import reduce
+
+import pandas as pd
+
+# Governance rules evaluated over the items frame written to items.csv. A rule declares the items it applies to,
+# the check that flags violators among them and the message for their owners; scopes and checks are vectorized
+# tests over the whole frame, so adding a rule costs one pass over the columns it reads. Rules that need data
+# items.csv doesn't have (thumbnail digests) name a fetched column, which is fetched once, for just the items
+# in scope of the rules that need it. A fetcher marks the items it couldn't fetch for as UNVERIFIABLE.
+
+TITLE_13_LICENSE = ('This report contains information, the release of which is protected by Title 13, United States '
+                    'Code (U.S.C.) and is for Bureau of the Census official use only. Moreover, Census Bureau policy '
+                    'DS 018 prohibits the browsing of files in which individuals or businesses may be directly or '
+                    'indirectly identified, except for work-related purposes.')
+
+UNVERIFIABLE = 'unverifiable'
+
+VIOLATION_FIELDS = ['RULE', 'ID', 'TITLE', 'OWNER', 'TYPE', 'HOMEPAGE', 'MESSAGE', 'ADVICE']
+
+
+class Rule:
+
+    def __init__(self, name, check, message, advice, applies=None, fetch=(), notify=True):
+        self.name = name
+        self.check = check
+        self.message = message
+        self.advice = advice
+        self.applies = applies
+        self.fetch = list(fetch)
+        # Violations of rules that aren't the owner's to fix are only written to violations.csv
+        self.notify = notify
+
+    def scope(self, items):
+        return self.applies(items) if self.applies is not None else pd.Series(True, index=items.index)
+
+
+# Scopes and checks: items frame -> boolean Series
+
+def text(items, column):
+    return items[column].fillna('').astype(str)
+
+
+def blank(column):
+    return lambda items: text(items, column).str.strip() == ''
+
+
+def shorter_than(column, length):
+    return lambda items: ~blank(column)(items) & (text(items, column).str.len() <= length)
+
+
+def differs_from(column, value):
+    return lambda items: ~blank(column)(items) & (text(items, column) != value)
+
+
+def unverifiable(column):
+    return lambda items: text(items, column) == UNVERIFIABLE
+
+
+def fetched_differs_from(column, value):
+    # Unlike differs_from, a missing value counts as different, while an unverifiable one can't be compared
+    return lambda items: ~unverifiable(column)(items) & (text(items, column) != value)
+
+
+def missing_tags(tags):
+    # TAGS holds the tag list the way items.csv writes it: 'census', 'boundaries'
+    def check(items):
+        item_tags = text(items, 'TAGS').str.lower()
+        return reduce(operator.or_, [~item_tags.str.contains("'{0}'".format(re.escape(tag.lower())))
+                                     for tag in tags])
+    return check
+
+
+def shared_publicly_except(item_types):
+    return lambda items: (text(items, 'SHARED_WITH_EVERYONE').str.lower() == 'true') & ~items['TYPE'].isin(item_types)
+
+
+def larger_than(column, limit):
+    return lambda items: pd.to_numeric(items[column], errors='coerce') > limit
+
+
+def unused_for(days, today=None):
+    # No views at all and not modified in the last days
+    def check(items):
+        modified = pd.to_datetime(items['MODIFIED'], format='%m/%d/%Y', errors='coerce')
+        views = pd.to_numeric(items['VIEWS'], errors='coerce').fillna(0)
+        return (views == 0) & (modified < pd.Timestamp(today or 'today').normalize() - pd.Timedelta(days=days))
+    return check
+
+
+def title_13_rules(thumbnail_digest, thumbnail_homepage):
+    # Evaluated over the items the portal's 'title 13' search finds: they need the Title 13 thumbnail, a real
+    # description and the Title 13 terms of use
+    return [Rule('title_13_thumbnail', fetched_differs_from('THUMBNAIL_DIGEST', thumbnail_digest),
+                 'This item does not have the correct thumbnail according to Title 13 guidelines',
+                 'Please use the Title 13 thumbnail located at {0}'.format(thumbnail_homepage),
+                 lambda items: ~blank('THUMBNAIL')(items), ['THUMBNAIL_DIGEST']),
+            Rule('title_13_thumbnail_unverifiable', unverifiable('THUMBNAIL_DIGEST'),
+                 'The thumbnail of this item could not be downloaded to check it against the Title 13 guidelines',
+                 'It is checked again on the next run', lambda items: ~blank('THUMBNAIL')(items),
+                 ['THUMBNAIL_DIGEST'], notify=False),
+            Rule('title_13_description', blank('DESCRIPTION'), 'This item does not contain a valid description.',
+                 'Please ensure that you are using a detailed description for titled data'),
+            Rule('title_13_short_description', shorter_than('DESCRIPTION', 25),
+                 'The description of this item is not detailed enough', 'Please make the item description longer'),
+            Rule('title_13_terms_of_use', blank('LICENSE_INFO'), 'This item does not contain terms of use.',
+                 'Please ensure that you are using the correct terms of use for titled data'),
+            Rule('title_13_wrong_terms_of_use', differs_from('LICENSE_INFO', TITLE_13_LICENSE),
+                 'This item is not using the correct terms of use for Title 13 data.', 'Please fix this immediately')]
+
+
+def policy_rules(required_tags=(), public_item_types=(), stale_days=0, max_size_mb=0, today=None):
+    # Portal-wide rules, each one off unless configured
+    rules = []
+    if required_tags:
+        rules.append(Rule('required_tags', missing_tags(required_tags),
+                          'This item is missing one of the required tags: {0}'.format(', '.join(required_tags)),
+                          'Please add the missing tags'))
+    if public_item_types:
+        rules.append(Rule('public_sharing', shared_publicly_except(public_item_types),
+                          'This item is shared with everyone, which is only allowed for {0} items'.format(
+                              ', '.join(public_item_types)),
+                          'Please stop sharing it with everyone'))
+    if stale_days:
+        rules.append(Rule('stale_item', unused_for(stale_days, today),
+                          'This item has never been viewed and has not been modified in {0} days'.format(stale_days),
+                          'Please delete it if it is no longer needed'))
+    if max_size_mb:
+        rules.append(Rule('oversize_item', larger_than('SIZE', max_size_mb),
+                          'This item is larger than {0} MB'.format(max_size_mb),
+                          'Please reduce its size or move the data out of the portal'))
+    return rules
+
+
+def evaluate(items, rules, fetchers=None):
+    # One row per (rule, item) violation. fetchers: fetched column -> function(items in scope) -> Series
+    fetchers = fetchers or {}
+    scopes = {rule.name: rule.scope(items).fillna(False).astype(bool) for rule in rules}
+    fetched = {}
+    for column in dict.fromkeys(column for rule in rules for column in rule.fetch):
+        in_scope = reduce(operator.or_, [scopes[rule.name] for rule in rules if column in rule.fetch])
+        fetched[column] = fetchers[column](items[in_scope]).reindex(items.index)
+    items = items.assign(**fetched)
+
+    violations = [pd.DataFrame(columns=VIOLATION_FIELDS)]
+    for rule in rules:
+        flagged = items.loc[scopes[rule.name] & rule.check(items).fillna(False).astype(bool)]
+        violations.append(pd.DataFrame({'RULE': rule.name, 'ID': flagged['ID'], 'TITLE': flagged['TITLE'],
+                                        'OWNER': flagged['OWNER'], 'TYPE': flagged['TYPE'],
+                                        'HOMEPAGE': flagged['HOMEPAGE'], 'MESSAGE': rule.message,
+                                        'ADVICE': rule.advice}, columns=VIOLATION_FIELDS))
+    return pd.concat(violations, ignore_index=True)
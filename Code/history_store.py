@@ -0,0 +1,135 @@
+import logging
+import os
+import shutil
+from datetime import datetime, timedelta
+from os import path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Daily snapshots of every audit dataset, kept as <history_dir>/<dataset>/snapshot=YYYY-MM-DD/part-N.parquet.
+# The snapshot partition lets read_history skip whole days before any file is opened.
+
+PARTITIONING = ds.partitioning(pa.schema([('snapshot', pa.string())]), flavor='hive')
+
+# zstd keeps the repetitive request and stats columns small while still reading quickly
+COMPRESSION = 'zstd'
+
+
+def partition_dir(history_dir, name, day):
+    return path.join(history_dir, name, 'snapshot={0}'.format(day.strftime('%Y-%m-%d')))
+
+
+def arrow_type(column):
+    # Every day of a dataset is written with the same types whatever that day's values: numbers as float64 (a column
+    # can be int one day and float the next), dates as timestamps and everything else as text. A column without a
+    # single value (e.g. an empty text column read back from CSV as NaN) is left untyped, and read_history gives it
+    # the type it has on the other days.
+    if column.isna().all():
+        return pa.null()
+    if column.dtype.kind in 'iuf' and not pd.api.types.is_bool_dtype(column):
+        return pa.float64()
+    if column.dtype.kind == 'M':
+        return None
+    return pa.string()
+
+
+def to_arrow(frame):
+    # Periods have no Parquet type, they are stored as the timestamp their period starts at
+    arrays = []
+    for column in frame.columns:
+        values = frame[column]
+        if isinstance(values.dtype, pd.PeriodDtype):
+            values = values.dt.to_timestamp()
+        arrow = arrow_type(values)
+        if arrow == pa.string():
+            values = values.astype(str).where(values.notna(), None)
+        elif arrow == pa.float64():
+            values = values.astype('float64')
+        arrays.append(pa.nulls(len(values)) if arrow == pa.null() else pa.array(values, type=arrow, from_pandas=True))
+    return pa.Table.from_arrays(arrays, names=[str(column) for column in frame.columns])
+
+
+def fits(schema, table):
+    # A chunk can go on into the open file if it has the file's columns and types, or no values in a column at all
+    return table.schema.names == schema.names and all(
+        chunk_type == pa.null() or chunk_type == field.type for field, chunk_type in zip(schema, table.schema.types))
+
+
+def write_snapshot(history_dir, name, frame, day):
+    # Rerunning on the same day replaces that day's snapshot. frame may also be an iterable of frames, which are
+    # written one row group at a time; returns the rows written. A chunk that gives a column its first values after
+    # the file was opened without them starts the next part file.
+    snapshot_dir = partition_dir(history_dir, name, day)
+    if path.isdir(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.makedirs(snapshot_dir)
+    writer = None
+    parts = 0
+    rows = 0
+    try:
+        for chunk in [frame] if isinstance(frame, pd.DataFrame) else frame:
+            table = to_arrow(chunk)
+            if writer is not None and not fits(writer.schema, table):
+                writer.close()
+                writer = None
+            if writer is None:
+                writer = pq.ParquetWriter(path.join(snapshot_dir, 'part-{0}.parquet'.format(parts)), table.schema,
+                                          compression=COMPRESSION)
+                parts += 1
+            else:
+                table = table.cast(writer.schema)
+            writer.write_table(table)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def prune_history(history_dir, name, keep_days, today):
+    oldest = (today - timedelta(days=keep_days)).strftime('%Y-%m-%d')
+    dataset_dir = path.join(history_dir, name)
+    removed = 0
+    for partition in os.listdir(dataset_dir) if path.isdir(dataset_dir) else []:
+        if partition.startswith('snapshot=') and partition[len('snapshot='):] < oldest:
+            shutil.rmtree(path.join(dataset_dir, partition))
+            removed += 1
+    return removed
+
+
+def archive_snapshots(history_dir, frames, retention, default_days, day=None):
+    # frames: dataset name -> frame (or iterable of frames), retention: dataset name -> days to keep (default_days for the rest)
+    day = day or datetime.now()
+    for name, frame in frames.items():
+        rows = write_snapshot(history_dir, name, frame, day)
+        removed = prune_history(history_dir, name, retention.get(name, default_days), day)
+        logging.info('History {0}: {1} rows archived, {2} expired days removed'.format(name, rows, removed))
+
+
+def combine(bounds):
+    expression = None
+    for bound in bounds:
+        if bound is not None:
+            expression = bound if expression is None else expression & bound
+    return expression
+
+
+def read_history(history_dir, name, start=None, end=None, columns=None, row_filter=None):
+    # start / end are dates (inclusive) matched against the snapshot partition, row_filter an optional pyarrow expression
+    # such as ds.field('Resource') == 'Parcels.MapServer'; both are applied before rows are read into pandas
+    dataset_dir = path.join(history_dir, name)
+    days = combine([ds.field('snapshot') >= start.strftime('%Y-%m-%d') if start is not None else None,
+                    ds.field('snapshot') <= end.strftime('%Y-%m-%d') if end is not None else None])
+
+    # The days in range are read with one schema merged from their files: untyped columns take the type the other
+    # days have, and snapshots archived before the types were fixed widen (int64 to float64, string to large_string)
+    dataset = ds.dataset(dataset_dir, format='parquet', partitioning=PARTITIONING)
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments(filter=days)]
+    if schemas:
+        dataset = ds.dataset(dataset_dir, schema=pa.unify_schemas(schemas + [PARTITIONING.schema],
+                                                                  promote_options='permissive'),
+                             format='parquet', partitioning=PARTITIONING)
+    return dataset.to_table(columns=columns, filter=combine([row_filter, days])).to_pandas()
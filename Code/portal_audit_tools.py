@@ -1,6 +1,8 @@
-from arcgis.gis import GIS, RoleManager
+from arcgis.gis import GIS, Item, User
 from datetime import datetime
 import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
 import csv
 from os import path
 import os
@@ -9,43 +11,304 @@ import logging
 import keyring
 import subprocess
 import warnings
-import arcpy
 import time
 import smtplib
 from email.mime.text import MIMEText
-import base64
+import hashlib
+import json
 import shutil
+from server_log_reader import read_server_logs
+from table_store import open_table_store
+from history_store import archive_snapshots
+from rollups import rollup_tables, update_rollups
+from governance import UNVERIFIABLE, evaluate, policy_rules, title_13_rules
+from run_metrics import RunMetrics
+from checkpoint import ResumableCsv, RunCheckpoint
+import textwrap
+import threading
+from collections import Counter, defaultdict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 warnings.filterwarnings('ignore')
 
-
-def send_email(server, sender, recipient, subject, body):
+# Portal search refuses to page beyond this many results for a single query
+SEARCH_WINDOW = 10000
+
+# System Log Parser sheets: name -> (sheet name, header row)
+SYS_LOG_SHEETS = {'stats_by_user': ('Statistics By User', 4),
+                  'stats_by_resource': ('Statistics By Resource', 4),
+                  'all_requests': ('Elapsed Time - All Resources', 3),
+                  'throughput': ('Throughput per Minute', 3)}
+
+# Portal item types that are matched to server requests, and the service type in their Resource names
+SERVICE_ITEM_TYPES = {'Map Service': 'MapServer', 'Feature Service': 'FeatureServer'}
+
+# all_requests columns written to all_requests.csv, and their names in the FGDB
+ALL_REQUESTS_COLUMNS = {'Date Time (Local Time)': 'Date_Time', 'Epoch Time': 'Epoch_Time',
+                        'Date Time (Day)': 'Date_Time_Day', 'Date Time (Hour)': 'Date_Time_Hour',
+                        'Date Time (Minute)': 'Date_Time_Minute', 'User': 'User', 'Server Machine': 'Server_Machine',
+                        'Content Length (Bytes)': 'Content_Length_Bits', 'HTTP Code': 'HTTP_Code',
+                        'Elapsed Time (>= 0 sec)': 'Elapsed_Time', 'Elapsed Time (Floor)': 'Elapsed_Time_Floor',
+                        'Resource': 'Resource', 'ArcGIS Method': 'ArcGIS_Method', 'ArcGIS Code': 'ArcGIS_Code',
+                        'ArcGIS Type': 'ArcGIS_Type'}
+
+# all_requests.csv columns given fixed types when it is read back in chunks, so every chunk has the same schema
+ALL_REQUESTS_TEXT = ['User', 'Server_Machine', 'Resource', 'ArcGIS_Method', 'ArcGIS_Type']
+ALL_REQUESTS_DATES = ['Date_Time', 'Date_Time_Day', 'Date_Time_Hour', 'Date_Time_Minute']
+
+# Portal CSVs that can be upserted on incremental runs, and the column each is keyed on
+DELTA_KEYS = {'users': 'USERNAME', 'groups': 'ID', 'items': 'ID'}
+
+# CSV columns of the portal exports
+ITEM_FIELDS = ['TITLE', 'OWNER', 'ID', 'TYPE', 'AUTHORITATIVE', 'TAGS', 'ACCESS', 'SHARED_WITH_ORG',
+               'SHARED_WITH_EVERYONE', 'SHARED_WITH_GROUPS', 'VIEWS', 'CREATED', 'HOMEPAGE', 'THUMBNAIL', 'DESCRIPTION',
+               'SIZE', 'MODIFIED', 'LICENSE_INFO', 'MODIFIED_EPOCH']
+USER_FIELDS = ['USERNAME', 'EMAIL', 'ROLE', 'LAST_LOGIN', 'CREATED', 'GROUPS', 'ITEMS']
+GROUP_FIELDS = ['TITLE', 'OWNER', 'MANAGERS', 'USERS', 'NUM_ADMINS', 'NUM_USERS', 'ITEMS', 'ID']
+
+# Item types counted for their owners but left out of items.csv
+SKIPPED_ITEM_TYPES = ['Geoprocessing Service', 'Service Definition', 'Code Attachment', 'Geometry Service',
+                      'Vector Tile Service', 'Vector Tile Package']
+
+# Tables built by process_sys_log_report
+SYS_LOG_TABLES = ['throughput', 'item_metrics', 'stats_by_resource', 'stats_by_user', 'all_requests']
+
+# Tables built by check_governance
+GOVERNANCE_TABLES = ['violations']
+
+
+class HostRateLimiter:
+    # Spaces out REST calls so that no single host receives more than requests_per_second
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, host):
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class AuditCache:
+    # Run-scoped lookups shared by every stage: group id -> title and role id -> name.
+    # Hits and misses are counted so the log shows how many requests the cache saved.
+
+    def __init__(self, portal):
+        self.portal = portal
+        self.lock = threading.Lock()
+        self.group_titles = {}
+        self.users = {}
+        self.role_names = {role.role_id: role.name for role in portal.users.roles.all()}
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def add_groups(self, groups):
+        self.add_group_titles({g.groupid: g.title for g in groups})
+
+    def add_group_titles(self, titles):
+        with self.lock:
+            self.group_titles.update(titles)
+
+    def group_title(self, group_id):
+        with self.lock:
+            title = self.group_titles.get(group_id)
+            self.hits['group'] += title is not None
+        if title is not None:
+            return title
+
+        group = self.portal.groups.get(group_id)
+        title = group.title if group is not None else group_id
+        with self.lock:
+            self.misses['group'] += 1
+            self.group_titles[group_id] = title
+        return title
+
+    def user(self, username):
+        with self.lock:
+            found = username in self.users
+            self.hits['owner'] += found
+            if found:
+                return self.users[username]
+
+        user = self.portal.users.get(username)
+        with self.lock:
+            self.misses['owner'] += 1
+            self.users[username] = user
+        return user
+
+    def role_name(self, role_id, default):
+        with self.lock:
+            name = self.role_names.get(role_id)
+            if name is None:
+                self.misses['role'] += 1
+                return default
+            self.hits['role'] += 1
+            return name
+
+    def log_stats(self):
+        for lookup in sorted(set(self.hits) | set(self.misses)):
+            logging.info('Cache {0}: {1} hits, {2} misses'.format(lookup, self.hits[lookup], self.misses[lookup]))
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def ordered_map(executor, func, iterable, window):
+    # Like executor.map, but only keeps `window` tasks in flight and yields results in input order
+    pending = deque()
+    for arg in iterable:
+        pending.append(executor.submit(func, arg))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def search_items(portal, query, page_size=100):
+    # Generator over /sharing/rest/search, the next page is fetched while the current one is consumed.
+    # Portal will not page past SEARCH_WINDOW results, so long result sets are re-anchored on the
+    # created time of the last item seen and the items already returned at that timestamp are skipped.
+    url = portal._portal.resturl + 'search'
+
+    def fetch(start, created_from):
+        q = query
+        if created_from is not None:
+            q = '({0}) AND created:[{1:019d} TO 9999999999999999999]'.format(query, created_from)
+        return portal._con.get(url, {'q': q, 'start': start, 'num': page_size, 'sortField': 'created',
+                                     'sortOrder': 'asc', 'f': 'json'})
+
+    created_from = None
+    skip_ids = set()
+    last_created = None
+    last_ids = set()
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        page = prefetcher.submit(fetch, 1, created_from)
+        while page is not None:
+            response = page.result()
+            results = [r for r in response.get('results', []) if r['id'] not in skip_ids]
+            for result in results:
+                if result['created'] != last_created:
+                    last_created = result['created']
+                    last_ids = set()
+                last_ids.add(result['id'])
+
+            next_start = response.get('nextStart', -1)
+            if next_start == -1:
+                page = None
+            elif next_start + page_size > SEARCH_WINDOW and last_created != created_from:
+                created_from = last_created
+                skip_ids = set(last_ids)
+                page = prefetcher.submit(fetch, 1, created_from)
+            else:
+                page = prefetcher.submit(fetch, next_start, created_from)
+
+            for result in results:
+                yield Item(portal, result['id'], result)
+
+
+def send_email(smtp, sender, recipient, subject, body):
     msg = MIMEText(body)
     msg['From'] = sender
     msg['To'] = recipient
     msg['Subject'] = subject
-    s = smtplib.SMTP(server)
-    s.send_message(msg)
-    s.quit()
+    smtp.send_message(msg)
+
+
+class NotificationQueue:
+    # Collects governance violations during the run and sends one digest per owner over a single
+    # SMTP connection. With a dry_run_dir the digests are written there as text files instead.
+
+    def __init__(self, server, sender, dry_run_dir=None, retries=3):
+        self.server = server
+        self.sender = sender
+        self.dry_run_dir = dry_run_dir
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.violations = defaultdict(list)
+
+    def add(self, recipient, subject, body):
+        with self.lock:
+            self.violations[recipient].append((subject, textwrap.dedent(body).strip()))
+
+    def digests(self):
+        for recipient, violations in sorted(self.violations.items()):
+            subject = '{0} items are not compliant with portal governance'.format(len(violations))
+            body = '\n\n'.join('{0}\n\n{1}'.format(v_subject, v_body) for v_subject, v_body in violations)
+            yield recipient, subject, body
+
+    def send(self):
+        if self.dry_run_dir is not None:
+            os.makedirs(self.dry_run_dir, exist_ok=True)
+            for recipient, subject, body in self.digests():
+                with open(path.join(self.dry_run_dir, '{0}.txt'.format(recipient)), 'w', encoding='utf-8') as f:
+                    f.write('To: {0}\nSubject: {1}\n\n{2}\n'.format(recipient, subject, body))
+            logging.info('Wrote {0} notification digests to {1}'.format(len(self.violations), self.dry_run_dir))
+            return
+
+        smtp = None
+        sent = 0
+        try:
+            for recipient, subject, body in self.digests():
+                for attempt in range(self.retries):
+                    try:
+                        if smtp is None:
+                            smtp = smtplib.SMTP(self.server)
+                        send_email(smtp, self.sender, recipient, subject, body)
+                        sent += 1
+                        break
+                    except (smtplib.SMTPException, OSError) as e:
+                        logging.warning('Sending to {0} failed (attempt {1}): {2}'.format(recipient, attempt + 1, e))
+                        # Start over with a fresh connection
+                        if smtp is not None:
+                            try:
+                                smtp.quit()
+                            except (smtplib.SMTPException, OSError):
+                                pass
+                            smtp = None
+                        time.sleep(2 ** attempt)
+        finally:
+            # A failed QUIT must not hide the error that ended the loop, the digests are already sent
+            if smtp is not None:
+                try:
+                    smtp.quit()
+                except (smtplib.SMTPException, OSError) as e:
+                    logging.warning('Closing the SMTP connection failed: {0}'.format(e))
+        logging.info('Sent {0} of {1} notification digests'.format(sent, len(self.violations)))
 
 
 def create_directories(report_dir, today_dir):
-    os.chdir(report_dir)
-    if path.isdir(today_dir) is False:
-        logging.info(f'Creating  {today_dir}...')
-        os.mkdir(path.join(report_dir, today_dir))
-        os.chdir(today_dir)
-        os.mkdir('csv_files')
+    # Also fills in csv_files when today_dir is already there, e.g. left behind by an interrupted run
+    csv_dir = path.join(report_dir, today_dir, 'csv_files')
+    if path.isdir(csv_dir) is False:
+        logging.info(f'Creating  {csv_dir}...')
+    os.makedirs(csv_dir, exist_ok=True)
 
 
 def generate_sys_log_report(slp_directory, today_dir, server_log_dir):
+    # Runs next to the portal stages, so slp.exe gets its own working directory instead of an os.chdir.
+    # Returns whether a report came out, so a rerun only regenerates it when it didn't.
     if path.isdir(today_dir) is True:
-        os.chdir(today_dir)
-        os.mkdir('sys_log_report')
-        os.chdir(slp_directory)
         output_dir = path.join(today_dir, 'sys_log_report')
-        cmd = (str(f"slp.exe -f AGSFS -i {server_log_dir} -d {output_dir} -eh now -sh 1440 -a complete -r spreadsheet -sbu true -o false, shell=True"))
+        os.makedirs(output_dir, exist_ok=True)
+        slp = path.join(slp_directory, 'slp.exe')
+        cmd = (str(f'"{slp}" -f AGSFS -i {server_log_dir} -d {output_dir} -eh now -sh 1440 -a complete -r spreadsheet -sbu true -o false, shell=True'))
         logging.info('Creating the System Log Report...')
-        subprocess.call(cmd)
+        subprocess.call(cmd, cwd=slp_directory)
+        return any(file.endswith('xlsx') for file in os.listdir(output_dir))
+    return False
 
 
 def connect_to_portal(url, cred_name, portal_user):
@@ -58,252 +321,612 @@ def connect_to_portal(url, cred_name, portal_user):
         logging.exception(e)
 
 
-def validate_title_13(portal, title_13_thumbnail_id, server, sender):
-    titled_data = portal.content.search(query='title 13', max_items=10000)
-
-    # Get the Title 13 logo
-    titled_item = portal.content.get(title_13_thumbnail_id)
-    titled_image_bytes = titled_item.get_thumbnail()
-    titled_b64_item = base64.b64encode(titled_image_bytes)
-
-    # Check each item in the titled data list
-    for item in titled_data:
-
-        title = item.title
-        owner = portal.users.get(item.owner)
-        email = owner.email
-        homepage = item.homepage
-
-        #  Check the thumbnail
-        if item.thumbnail is not None:
-            thumbnail = item.thumbnail
-            image_bytes = item.get_thumbnail()
-            b64_item = base64.b64encode(image_bytes)
-            match = b64_item == titled_b64_item
-
-            if match is False:
-                subject = "{0} is not compliant with portal governance".format(item.title)
-
-                body = """
-                    This item does not have the correct thumbnail according to Title 13 guidelines
-                    
-                        Item Owner: {0}
-                        Item ID: {1}
-                        Item URL: {2}
-
-                    Please use the Title 13 thumbnail located at {3}""".format(item.owner, item.id, item.homepage,
-                                                                               titled_item.homepage)
-                send_email(server, sender, email, subject, body)
-
-        # Check the description
-        if item.description is None:
-            subject = "{0} is not compliant with portal governance".format(item.title)
-            body = """
-                This item does not contain a valid description.
-
-                    Item Owner: {0}
-                    Item ID: {1}
-                    Item URL: {2}
-
-                Please ensure that you are using a detailed description for titled data
-                """.format(item.owner, item.id, item.homepage)
-            send_email(server, sender, email, subject, body)
-
-        if item.description is not None:
-            if len(item.description) <= 25:
-                subject = "{0} is not compliant with portal governance".format(item.title)
-                body = """
-                    The description of this item is not detailed enough
-
-                        Item Owner: {0}
-                        Item ID: {1}
-                        Item URL: {2}
-
-                    Please make the item description longer
-                         """.format(item.owner, item.id, item.homepage)
-                send_email(server, sender, email, subject, body)
-
-        # Check the terms of use
-        if item.licenseInfo is None:
-            # print(item.title)
-            subject = "{0} is not compliant with portal governance".format(item.title)
-            body = """
-                This item does not contain terms of use.
-                
-                    Item Owner: {0}
-                    Item ID: {1}
-                    Item URL: {2}
-
-                Please ensure that you are using the correct terms of use for titled data
-
-                """.format(item.owner, item.id, item.homepage)
-            send_email(server, sender, email, subject, body)
-
-        if item.licenseInfo is not None:
-            subject = "{0} is not compliant with portal governance".format(item.title)
-            check = item.licenseInfo == 'This report contains information, the release of which is protected by Title 13, United States Code (U.S.C.) and is for Bureau of the Census official use only. Moreover, Census Bureau policy DS 018 prohibits the browsing of files in which individuals or businesses may be directly or indirectly identified, except for work-related purposes.'
-            if check == False:
-                body = """
-                        This item is not using the correct terms of use for Title 13 data.
-                            
-                            Item Owner: {0}
-                            Item ID: {1}
-                            Item URL: {2}
-
-                        Please fix this immediately
-                            """.format(item.owner, item.id, item.homepage)
-                send_email(server, sender, email, subject, body)
-
-
-def get_portal_data(portal, today_dir):
+def thumbnail_key(item_id, thumbnail, modified):
+    # A thumbnail only needs downloading again when the item, its thumbnail file or its modified time (epoch
+    # milliseconds, so a change later the same day counts too) change
+    return '{0}|{1}|{2}'.format(item_id, thumbnail, modified)
+
+
+def thumbnail_digest(item):
+    image_bytes = item.get_thumbnail()
+    return hashlib.sha256(image_bytes).hexdigest() if image_bytes else None
 
+
+def try_thumbnail_digest(item):
     try:
-        logging.info('Querying the Enterprise Portal...')
+        return thumbnail_digest(item)
+    except Exception as e:
+        logging.warning('Could not download the thumbnail of {0}: {1}'.format(item.id, e))
+        return UNVERIFIABLE
+
+
+def get_thumbnail_digests(portal, items, cached_digests, used_digests, workers=8):
+    # Digest of each item's thumbnail. Digests found in cached_digests are reused, the rest are downloaded in
+    # batches on a thread pool; every digest used ends up in used_digests. Items whose thumbnail fails to download
+    # come back UNVERIFIABLE and are left out of used_digests, so the next run tries them again.
+    modified = pd.to_numeric(items['MODIFIED_EPOCH'], errors='coerce').astype('Int64').astype(str)
+    keys = [thumbnail_key(*row) for row in zip(items['ID'], items['THUMBNAIL'], modified)]
+    misses = []
+    for key, item_id, item_type, thumbnail in zip(keys, items['ID'], items['TYPE'], items['THUMBNAIL']):
+        if key in cached_digests:
+            used_digests[key] = cached_digests[key]
+        elif key not in used_digests:
+            used_digests[key] = None
+            # Without its type, Item requests the whole item to find out whether it has layers
+            misses.append((key, Item(portal, item_id, {'id': item_id, 'type': item_type, 'thumbnail': thumbnail})))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batched(misses, 100):
+            for (key, item), digest in zip(batch, executor.map(try_thumbnail_digest, [item for key, item in batch])):
+                if digest == UNVERIFIABLE:
+                    del used_digests[key]
+                else:
+                    used_digests[key] = digest
+    logging.info('Thumbnails: {0} downloaded, {1} from cache'.format(len(misses), len(keys) - len(misses)))
+    return pd.Series([used_digests.get(key, UNVERIFIABLE) for key in keys], index=items.index, dtype=object)
+
+
+def title_13_items(portal, items):
+    # The items the portal's 'title 13' search finds. Their items.csv rows where there are some, items.csv leaves
+    # out the skipped types (and esri owned items), whose rows are built from the search results.
+    found = {item.id: item for item in search_items(portal, 'title 13')}
+    titled = items[items['ID'].isin(found)] if 'ID' in items else pd.DataFrame(columns=ITEM_FIELDS)
+    exported = set(titled['ID'])
+    rows = [get_item_row(item, (None, None, None)) for item_id, item in found.items() if item_id not in exported]
+    if rows:
+        titled = pd.concat([titled, pd.DataFrame(rows, columns=ITEM_FIELDS)], ignore_index=True)
+    logging.info('Title 13: {0} items, {1} not in items.csv'.format(len(found), len(rows)))
+    return titled
+
+
+def owner_emails(today_dir, owners, cache=None):
+    # From this run's users.csv, owners missing from it are looked up through the cache
+    users = read_run_table(today_dir, 'users')
+    emails = dict(zip(users.get('USERNAME', []), users.get('EMAIL', [])))
+    for owner in owners:
+        if owner not in emails and cache is not None:
+            user = cache.user(owner)
+            emails[owner] = user.email if user is not None else None
+    return emails
+
+
+def validate_items(portal, today_dir, title_13, policy, notifications, cache=None, thumbnail_cache_file=None,
+                   workers=8):
+    # Evaluates the Title 13 rules over the Title 13 search results and the policy rules over items.csv, writes
+    # violations.csv and queues a notification for the owner of every violation of a rule that notifies
+    items = read_run_table(today_dir, 'items')
+
+    # Digests from previous runs, only the entries still in use are written back
+    cached_digests = read_json(thumbnail_cache_file) if thumbnail_cache_file is not None else {}
+    used_digests = {}
+    fetchers = {'THUMBNAIL_DIGEST': lambda scoped: get_thumbnail_digests(portal, scoped, cached_digests, used_digests,
+                                                                         workers)}
+    violations = pd.concat([evaluate(title_13_items(portal, items), title_13, fetchers),
+                            evaluate(items, policy, fetchers)], ignore_index=True)
+    if thumbnail_cache_file is not None:
+        write_json(thumbnail_cache_file, used_digests)
+
+    violations.to_csv(path.join(today_dir, 'csv_files', 'violations.csv'), index=False)
+    logging.info('Violations File:    {0}'.format(path.join(today_dir, 'csv_files', 'violations.csv')))
+    for rule, count in violations['RULE'].value_counts().items():
+        logging.info('{0}: {1} violations'.format(rule, count))
+
+    notified = violations[violations['RULE'].isin([rule.name for rule in title_13 + policy if rule.notify])]
+    emails = owner_emails(today_dir, notified['OWNER'].unique(), cache)
+    for violation in notified.itertuples(index=False):
+        email = emails.get(violation.OWNER)
+        if not email:
+            continue
+        subject = "{0} is not compliant with portal governance".format(violation.TITLE)
+        body = """
+            {0}
+
+                Item Owner: {1}
+                Item ID: {2}
+                Item URL: {3}
+
+            {4}""".format(violation.MESSAGE, violation.OWNER, violation.ID, violation.HOMEPAGE, violation.ADVICE)
+        notifications.add(email, subject, body)
+    if cache is not None:
+        cache.log_stats()
+    return violations
+
+
+def check_governance(portal, title_13_thumbnail_id, notifications, today_dir, policy=None, cache=None,
+                     thumbnail_cache_file=None, workers=8):
+    # The Title 13 rules and the policy rules configured in config.ini (policy: keyword arguments of policy_rules)
+    try:
+        titled_item = portal.content.get(title_13_thumbnail_id)
+        validate_items(portal, today_dir, title_13_rules(thumbnail_digest(titled_item), titled_item.homepage),
+                       policy_rules(**(policy or {})), notifications, cache, thumbnail_cache_file, workers)
+        notifications.send()
+        return True
+    except Exception as error:
+        logging.exception(error)
 
-        # Query users, groups, and items
-        users = portal.users.search('!USER:esri_*')
-        groups = portal.groups.search('!owner:esri_*')
-        all_items = portal.content.search(query='!owner:esri*', max_items=10000)
 
-        # Create empty dictionaries, will be used to populate CSV files
-        user_dict = {}
-        group_dict = {}
-        item_dict = {}
+def split_list(value):
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+def read_json(json_file):
+    if path.isfile(json_file):
+        with open(json_file, encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def write_json(json_file, data):
+    with open(json_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+
 
-        # Get users and write them to CSV
-        with open(path.join(today_dir, 'csv_files', 'users.csv'), 'w', newline='', encoding='utf-8') as user_csv:
-            user_file = csv.DictWriter(user_csv,
-                                       fieldnames=['USERNAME', 'EMAIL', 'ROLE', 'LAST_LOGIN',
-                                                   'CREATED', 'GROUPS', 'ITEMS'])
-            user_file.writeheader()
+def read_csv_rows(report_dir, name, key):
+    # Rows of a previous run's CSV keyed on `key`, empty when there is nothing to compare against
+    if report_dir is None:
+        return {}
+    csv_path = path.join(report_dir, 'csv_files', '{0}.csv'.format(name))
+    if path.isfile(csv_path) is False:
+        return {}
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        return {row[key]: row for row in csv.DictReader(f)}
 
-            rm = RoleManager(portal)
-            roles = rm.all()
 
-            for user in users:
-                # if user.idpUSER is not None:
-                num_items = 0
+def write_delta_files(today_dir, previous_dir):
+    # <name>_delta.csv holds the rows that are new or changed since the previous run,
+    # deleted.csv the keys that have disappeared from the portal
+    with open(path.join(today_dir, 'csv_files', 'deleted.csv'), 'w', newline='', encoding='utf-8') as deleted_csv:
+        deleted_file = csv.DictWriter(deleted_csv, fieldnames=['DATASET', 'KEY'])
+        deleted_file.writeheader()
 
-                user_dict['USERNAME'] = user.username
-                user_dict['EMAIL'] = user.email
-                user_dict['ROLE'] = user.role
-                for role in roles:
-                    role_id = role.role_id
-                    if role_id == user.roleId:
-                        user_dict['ROLE'] = role.name
+        for name, key in DELTA_KEYS.items():
+            previous = read_csv_rows(previous_dir, name, key)
+            current = read_csv_rows(today_dir, name, key)
+            changed = [row for row_key, row in current.items() if previous.get(row_key) != row]
+            deleted = [row_key for row_key in previous if row_key not in current]
 
-                if user.lastLogin != -1:
-                    user_dict['LAST_LOGIN'] = datetime.fromtimestamp(float(user.lastLogin / 1000)).strftime('%m/%d/%Y')
-                else:
-                    user_dict['LAST_LOGIN'] = -1
-                user_dict['CREATED'] = datetime.fromtimestamp(float(user.created / 1000)).strftime('%m/%d/%Y')
+            with open(path.join(today_dir, 'csv_files', '{0}_delta.csv'.format(name)), 'w', newline='',
+                      encoding='utf-8') as delta_csv:
+                delta_file = csv.DictWriter(delta_csv, fieldnames=list(next(iter(current.values()), {}).keys()))
+                delta_file.writeheader()
+                delta_file.writerows(changed)
 
-                user_groups = user.groups
-                g_list = []
+            for row_key in deleted:
+                deleted_file.writerow({'DATASET': name, 'KEY': row_key})
+            logging.info('{0}: {1} changed, {2} deleted since the previous run'.format(name, len(changed), len(deleted)))
 
-                for g in user_groups:
-                    g_list.append(g.title)
-                user_dict['GROUPS'] = str(g_list)[1:-1]
 
-                user_content = user.items()
-                folders = user.folders
+def count_user_items(user, limiter, host):
+    # Fallback when the owner index is incomplete: walk the root folder and every subfolder
+    num_items = 0
+    limiter.wait(host)
+    user_content = user.items()
+    limiter.wait(host)
+    folders = user.folders
 
-                for item in user_content:
-                    num_items += 1
+    for item in user_content:
+        num_items += 1
 
-                for folder in folders:
-                    folder_items = user.items(folder=folder['title'])
-                    for item in folder_items:
-                        num_items += 1
-                user_dict['ITEMS'] = num_items
-                user_file.writerow(user_dict)
-        logging.info('User File:    {0}'.format(path.join(today_dir, 'csv_files', 'user.csv')))
+    for folder in folders:
+        limiter.wait(host)
+        folder_items = user.items(folder=folder['title'])
+        for item in folder_items:
+            num_items += 1
+    return num_items
 
-        # Get Groups
-        with open(path.join(today_dir, 'csv_files', 'groups.csv'), 'w', newline='', encoding='utf-8') as group_csv:
-            groups_file = csv.DictWriter(group_csv, fieldnames=['TITLE', 'OWNER', 'MANAGERS', 'USERS', 'NUM_ADMINS', 'NUM_USERS', 'ITEMS'])
-            groups_file.writeheader()
 
-            for g in groups:
+def get_item_sharing(portal, item, cache):
+    # Same answer as item.shared_with, but group titles come from the cache instead of one Group request each
+    sharing = portal._con.get(portal._portal.resturl + 'content/items/{0}/groups'.format(item.id), {'f': 'json'})
+    groups = sharing.get('admin', []) + sharing.get('member', []) + sharing.get('other', [])
+    # The response already carries the titles, groups outside the group search no longer need a request later
+    cache.add_group_titles({g['id']: g['title'] for g in groups if 'title' in g})
+    group_titles = [cache.group_title(g['id']) for g in groups]
+    return item.access == 'public', item.access in ['org', 'public'], group_titles
+
+
+def get_item_row(item, sharing):
+    # sharing: (shared with everyone, shared with org, SHARED_WITH_GROUPS text)
+    return {'TITLE': item.title, 'OWNER': item.owner, 'ID': item.id, 'TYPE': item.type,
+            'AUTHORITATIVE': item.content_status, 'TAGS': str(item.tags)[1:-1], 'DESCRIPTION': item.description,
+            'VIEWS': item.numViews,
+            'CREATED': datetime.fromtimestamp(float(item.created / 1000)).strftime('%m/%d/%Y'),
+            'HOMEPAGE': item.homepage, 'SHARED_WITH_EVERYONE': sharing[0], 'SHARED_WITH_ORG': sharing[1],
+            'SHARED_WITH_GROUPS': sharing[2], 'ACCESS': item.access, 'SIZE': item.size / 1000 / 1000,
+            'THUMBNAIL': item.thumbnail,
+            'MODIFIED': datetime.fromtimestamp(float(item.modified / 1000)).strftime('%m/%d/%Y'),
+            'LICENSE_INFO': item.licenseInfo, 'MODIFIED_EPOCH': item.modified}
+
 
-                members = g.get_members()
+def reuse_item_sharing(item, previous, watermark):
+    if previous is not None and item.modified <= watermark and previous['ACCESS'] == item.access:
+        return previous['SHARED_WITH_EVERYONE'], previous['SHARED_WITH_ORG'], previous['SHARED_WITH_GROUPS']
+    return None
 
-                group_dict['TITLE'] = g.title
-                group_dict['OWNER'] = members['owner']
-                group_dict['MANAGERS'] = str(str(members['admins']).replace("'", ''))[1:-1]
-                group_dict['USERS'] = str(str(members['users']).replace("'", ''))[1:-1]
 
-                group_dict['NUM_ADMINS'] = len(members['admins'])
-                group_dict['NUM_USERS'] = len(members['users'])
-                                
-                group_dict['ITEMS'] = len(g.content())
-                groups_file.writerow(group_dict)
+def get_group_detail(portal, group, limiter, host):
+    # Members and item count; the count comes from a num=0 search instead of loading every item of the group
+    limiter.wait(host)
+    members = group.get_members()
+    limiter.wait(host)
+    content = portal._con.get(portal._portal.resturl + 'search',
+                              {'q': 'group:{0}'.format(group.groupid), 'num': 0, 'f': 'json'})
+    return members, content.get('total', 0)
+
+
+def get_group_row(group_id, title, members, item_count):
+    return {'ID': group_id, 'TITLE': title, 'OWNER': members['owner'],
+            'MANAGERS': str(str(members['admins']).replace("'", ''))[1:-1],
+            'USERS': str(str(members['users']).replace("'", ''))[1:-1],
+            'NUM_ADMINS': len(members['admins']), 'NUM_USERS': len(members['users']), 'ITEMS': item_count}
+
+
+def group_members(row):
+    # Usernames in a groups.csv row: its owner, managers and users
+    names = [row['OWNER']] + row['MANAGERS'].split(', ') + row['USERS'].split(', ')
+    return {name for name in names if name}
+
+
+def get_user_row(user, cache, limiter, host, owner_counts=None, previous=None, watermark=None, group_titles=None):
+    user_dict = {'USERNAME': user.username, 'EMAIL': user.email,
+                 'ROLE': cache.role_name(user.roleId, user.role)}
+
+    if user.lastLogin != -1:
+        user_dict['LAST_LOGIN'] = datetime.fromtimestamp(float(user.lastLogin / 1000)).strftime('%m/%d/%Y')
+    else:
+        user_dict['LAST_LOGIN'] = -1
+    user_dict['CREATED'] = datetime.fromtimestamp(float(user.created / 1000)).strftime('%m/%d/%Y')
+
+    # A failed lookup only leaves this user's GROUPS/ITEMS empty, the rest of the export carries on
+    try:
+        if previous is not None and user.modified <= watermark:
+            user_dict['GROUPS'] = previous['GROUPS']
+        elif group_titles is not None:
+            user_dict['GROUPS'] = str(list(group_titles))[1:-1]
+        else:
+            limiter.wait(host)
+            user_groups = user.groups
+            g_list = []
+
+            for g in user_groups:
+                g_list.append(cache.group_title(g.groupid))
+            user_dict['GROUPS'] = str(g_list)[1:-1]
+
+        if owner_counts is not None:
+            num_items = owner_counts.get(user.username, 0)
+        else:
+            num_items = count_user_items(user, limiter, host)
+        user_dict['ITEMS'] = num_items
+    except Exception as e:
+        logging.error('Could not enrich user {0}: {1}'.format(user.username, e))
+    return user_dict
+
+
+def get_portal_data(portal, today_dir, workers=8, requests_per_second=20, previous_dir=None, watermark=None,
+                    cache=None, checkpoint=None):
+
+    try:
+        logging.info('Querying the Enterprise Portal...')
+
+        # Incremental runs reuse the expensive lookups from the previous run for anything not modified since
+        previous_users = read_csv_rows(previous_dir, 'users', 'USERNAME')
+        previous_groups = read_csv_rows(previous_dir, 'groups', 'ID')
+        previous_items = read_csv_rows(previous_dir, 'items', 'ID')
+        if previous_dir is not None:
+            logging.info('Incremental run, reusing rows from {0} not modified since {1}'.format(
+                previous_dir, datetime.fromtimestamp(watermark / 1000)))
+
+        # Query users and groups, items are streamed page by page below
+        users = portal.users.search('!USER:esri_*')
+        groups = portal.groups.search('!owner:esri_*')
+
+        # Group titles are resolved from this search instead of per item / per user requests
+        if cache is None:
+            cache = AuditCache(portal)
+        cache.add_groups(groups)
+
+        # Owner -> item count, built while the items stream past and used for the users ITEMS column
+        owner_counts = Counter()
+
+        # Get Items. A resumed run still streams every item for the owner counts, but only looks up and
+        # writes the ones not already in items.csv
+        with ResumableCsv(path.join(today_dir, 'csv_files', 'items.csv'), ITEM_FIELDS, 'ID',
+                          checkpoint) as items_file:
+            try:
+                for item in search_items(portal, '!owner:esri*'):
+                    owner_counts[item.owner] += 1
+                    if items_file.skip(item.id):
+                        continue
+                    if item.type in SKIPPED_ITEM_TYPES:
+                        items_file.advance(item.id)
+                    else:
+                        print(item)
+                        sharing = reuse_item_sharing(item, previous_items.get(item.id), watermark)
+                        if sharing is None:
+                            everyone, org, item_groups = get_item_sharing(portal, item, cache)
+                            sharing = (everyone, org, str(item_groups)[1:-1])
+                        items_file.advance(item.id, get_item_row(item, sharing))
+            except Exception as e:
+                # The owner index is incomplete, users fall back to walking their folders
+                logging.error('Item search failed, counting user items folder by folder: {0}'.format(e))
+                owner_counts = None
+
+        logging.info('Item File:    {0}'.format(path.join(today_dir, 'csv_files', 'items.csv')))
+
+        host = urlparse(portal.url).netloc
+        limiter = HostRateLimiter(requests_per_second)
+
+        # Get Groups. Their member lists also give every user's GROUPS, so users need no per-user groups request
+        # unless a group's members couldn't be read (or were written before a resume)
+        memberships = defaultdict(list)
+        members_complete = True
+        with ResumableCsv(path.join(today_dir, 'csv_files', 'groups.csv'), GROUP_FIELDS, 'ID',
+                          checkpoint) as groups_file:
+
+            def group_row(g):
+                previous = previous_groups.get(g.groupid)
+                if previous is not None and g.modified <= watermark:
+                    previous['TITLE'] = g.title
+                    return g.groupid, previous
+                try:
+                    members, item_count = get_group_detail(portal, g, limiter, host)
+                    return g.groupid, get_group_row(g.groupid, g.title, members, item_count)
+                except Exception as e:
+                    logging.error('Could not read group {0}: {1}'.format(g.groupid, e))
+                    return g.groupid, None
+
+            # Member lists are fetched concurrently, rows are still written in search order
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                remaining = [g for g in groups if not groups_file.skip(g.groupid)]
+                members_complete = len(remaining) == len(groups)
+                for group_id, row in ordered_map(executor, group_row, remaining, workers * 4):
+                    groups_file.advance(group_id, row)
+                    if row is None:
+                        members_complete = False
+                        continue
+                    for username in group_members(row):
+                        memberships[username].append(row['TITLE'])
         logging.info('Group File:    {0}'.format(path.join(today_dir, 'csv_files', 'groups.csv')))
 
+        # Get users and write them to CSV
+        with ResumableCsv(path.join(today_dir, 'csv_files', 'users.csv'), USER_FIELDS, 'USERNAME',
+                          checkpoint) as user_file:
+
+            def user_row(u):
+                return u.username, get_user_row(u, cache, limiter, host, owner_counts, previous_users.get(u.username),
+                                                watermark,
+                                                memberships.get(u.username, []) if members_complete else None)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                remaining = (u for u in users if not user_file.skip(u.username))
+                for username, row in ordered_map(executor, user_row, remaining, workers * 4):
+                    user_file.advance(username, row)
+        logging.info('User File:    {0}'.format(path.join(today_dir, 'csv_files', 'user.csv')))
+
+        if previous_dir is not None:
+            write_delta_files(today_dir, previous_dir)
+        cache.log_stats()
+        return groups
+    except Exception as e:
+        logging.error(e)
+
+
+def get_portal_data_async(portal, today_dir, workers=8, requests_per_second=20, previous_dir=None, watermark=None,
+                          cache=None, metrics=None):
+    # Same CSVs as get_portal_data, harvested by async_portal with up to `workers` requests in flight
+
+    try:
+        from async_portal import harvest_portal
+        logging.info('Querying the Enterprise Portal (async)...')
+
+        previous_users = read_csv_rows(previous_dir, 'users', 'USERNAME')
+        previous_groups = read_csv_rows(previous_dir, 'groups', 'ID')
+        previous_items = read_csv_rows(previous_dir, 'items', 'ID')
+        if cache is None:
+            cache = AuditCache(portal)
+
+        def unchanged(previous, record):
+            return previous is not None and record['modified'] <= watermark
+
+        def reuse_item(record):
+            previous = previous_items.get(record['id'])
+            return record['type'] in SKIPPED_ITEM_TYPES or \
+                (unchanged(previous, record) and previous['ACCESS'] == record['access'])
+
+        harvest = harvest_portal(portal._portal.resturl, portal._con.token, '!USER:esri_*', '!owner:esri_*',
+                                 '!owner:esri*', lambda record: unchanged(previous_users.get(record['username']), record),
+                                 lambda record: unchanged(previous_groups.get(record['id']), record), reuse_item,
+                                 workers, requests_per_second,
+                                 on_request=metrics.record_request if metrics is not None else None)
+        cache.add_group_titles(harvest['group_titles'])
+
         # Get Items
+        owner_counts = Counter()
         with open(path.join(today_dir, 'csv_files', 'items.csv'), 'w', newline='', encoding='utf-8') as items_csv:
-            items_file = csv.DictWriter(items_csv, fieldnames=['TITLE', 'OWNER', 'ID', 'TYPE', 'AUTHORITATIVE',
-                                                               'TAGS', 'ACCESS', 'SHARED_WITH_ORG',
-                                                               'SHARED_WITH_EVERYONE', 'SHARED_WITH_GROUPS', 'VIEWS',
-                                                               'CREATED', 'HOMEPAGE', 'THUMBNAIL', 'DESCRIPTION', 'SIZE'])
-
+            items_file = csv.DictWriter(items_csv, fieldnames=ITEM_FIELDS)
             items_file.writeheader()
-            for item in all_items:
-                if item.type in ['Geoprocessing Service', 'Service Definition', 'Code Attachment', 'Geometry Service',
-                                 'Vector Tile Service', 'Vector Tile Package']:
-                    pass
+            for record, item_groups in harvest['items']:
+                owner_counts[record['owner']] += 1
+                if record['type'] in SKIPPED_ITEM_TYPES:
+                    continue
+                item = Item(portal, record['id'], record)
+                if item_groups is None:
+                    sharing = reuse_item_sharing(item, previous_items.get(item.id), watermark)
+                elif isinstance(item_groups, Exception):
+                    sharing = (None, None, None)
                 else:
-                    print(item)
-                    item_groups = []
-                    item_dict['TITLE'] = item.title
-                    item_dict['OWNER'] = item.owner
-                    item_dict['ID'] = item.id
-                    item_dict['TYPE'] = item.type
-                    item_dict['AUTHORITATIVE'] = item.content_status
-                    item_dict['TAGS'] = str(item.tags)[1:-1]
-                    item_dict['DESCRIPTION'] = item.description
-                    item_dict['VIEWS'] = item.numViews
-                    item_dict['CREATED'] = datetime.fromtimestamp(float(item.created / 1000)).strftime('%m/%d/%Y')
-                    # item_dict['dependent_on'] = item.dependent_upon()
-                    # item_dict['dependent_to'] = item.dependent_to()
-                    item_dict['HOMEPAGE'] = item.homepage
-                    item_dict['SHARED_WITH_EVERYONE'] = item.shared_with['everyone']
-                    item_dict['SHARED_WITH_ORG'] = item.shared_with['org']
-                    for g in item.shared_with['groups']:
-                        item_groups.append(g.title)
-                    item_dict['SHARED_WITH_GROUPS'] = str(item_groups)[1:-1]
-                    # print(item_groups)
-                    item_dict['ACCESS'] = item.access
-                    item_dict['SIZE'] = item.size / 1000 / 1000
-                    item_dict['THUMBNAIL'] = item.thumbnail
-                    items_file.writerow(item_dict)
-
+                    sharing = (item.access == 'public', item.access in ['org', 'public'], str(item_groups)[1:-1])
+                items_file.writerow(get_item_row(item, sharing))
         logging.info('Item File:    {0}'.format(path.join(today_dir, 'csv_files', 'items.csv')))
-        return groups
+
+        # Get users, nothing left to request so the rows are built in order
+        host = urlparse(portal.url).netloc
+        limiter = HostRateLimiter(requests_per_second)
+        with open(path.join(today_dir, 'csv_files', 'users.csv'), 'w', newline='', encoding='utf-8') as user_csv:
+            user_file = csv.DictWriter(user_csv, fieldnames=USER_FIELDS)
+            user_file.writeheader()
+            for record, user_groups in harvest['users']:
+                user = User(portal, record['username'], record)
+                if isinstance(user_groups, Exception):
+                    user_groups = []
+                user_file.writerow(get_user_row(user, cache, limiter, host, owner_counts,
+                                                previous_users.get(user.username), watermark, user_groups))
+        logging.info('User File:    {0}'.format(path.join(today_dir, 'csv_files', 'users.csv')))
+
+        # Get Groups
+        with open(path.join(today_dir, 'csv_files', 'groups.csv'), 'w', newline='', encoding='utf-8') as group_csv:
+            groups_file = csv.DictWriter(group_csv, fieldnames=GROUP_FIELDS)
+            groups_file.writeheader()
+            for record, detail in harvest['groups']:
+                if detail is None:
+                    previous = previous_groups[record['id']]
+                    previous['TITLE'] = record['title']
+                    groups_file.writerow(previous)
+                elif not isinstance(detail, Exception):
+                    groups_file.writerow(get_group_row(record['id'], record['title'], *detail))
+        logging.info('Group File:    {0}'.format(path.join(today_dir, 'csv_files', 'groups.csv')))
+
+        if previous_dir is not None:
+            write_delta_files(today_dir, previous_dir)
+        cache.log_stats()
+        return [record for record, detail in harvest['groups']]
     except Exception as e:
         logging.error(e)
 
 
-def process_sys_log_report(today_dir):
+def read_sys_log_report(report_dir, skip=()):
+    # A CSV or Parquet export of a sheet (e.g. throughput.parquet) is read directly, everything else
+    # comes out of the System Log Parser workbook, which is opened once for all of its sheets
+    frames = {}
+    workbook = None
+    try:
+        for name, (sheet_name, header) in SYS_LOG_SHEETS.items():
+            if name in skip:
+                continue
+            started = time.perf_counter()
+            parquet_file = path.join(report_dir, '{0}.parquet'.format(name))
+            csv_file = path.join(report_dir, '{0}.csv'.format(name))
+            if path.isfile(parquet_file):
+                source = parquet_file
+                frames[name] = pd.read_parquet(parquet_file)
+            elif path.isfile(csv_file):
+                source = csv_file
+                frames[name] = pd.read_csv(csv_file)
+            else:
+                if workbook is None:
+                    report = latest_report(report_dir)
+                    workbook = pd.ExcelFile(report)
+                    logging.info('Opened {0} in {1:.1f}s'.format(report, time.perf_counter() - started))
+                    started = time.perf_counter()
+                source = sheet_name
+                frames[name] = workbook.parse(sheet_name, header=header)
+            logging.info('Read {0}: {1} rows from {2} in {3:.1f}s'.format(name, len(frames[name]), source,
+                                                                        time.perf_counter() - started))
+    finally:
+        if workbook is not None:
+            workbook.close()
+    return frames
+
+
+def latest_report(report_dir):
+    return path.join(report_dir, [file for file in os.listdir(report_dir) if file.endswith('xlsx')][-1])
+
+
+def iter_sys_log_requests(report_dir, chunk_rows):
+    # The all_requests sheet in frames of up to chunk_rows rows, from its Parquet or CSV export or streamed
+    # row by row out of the workbook, so the whole sheet is never in memory at once
+    sheet_name, header = SYS_LOG_SHEETS['all_requests']
+    parquet_file = path.join(report_dir, 'all_requests.parquet')
+    csv_file = path.join(report_dir, 'all_requests.csv')
+    if path.isfile(parquet_file):
+        parquet = pq.ParquetFile(parquet_file)
+        columns = [column for column in ALL_REQUESTS_COLUMNS if column in parquet.schema_arrow.names]
+        for batch in parquet.iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+    elif path.isfile(csv_file):
+        yield from pd.read_csv(csv_file, chunksize=chunk_rows, usecols=lambda column: column in ALL_REQUESTS_COLUMNS)
+    else:
+        from openpyxl import load_workbook
+        workbook = load_workbook(latest_report(report_dir), read_only=True, data_only=True)
+        try:
+            rows = workbook[sheet_name].iter_rows(min_row=header + 1, values_only=True)
+            columns = next(rows)
+            while True:
+                chunk = list(islice(rows, chunk_rows))
+                if not chunk:
+                    break
+                yield pd.DataFrame.from_records(chunk, columns=columns).dropna(how='all')
+        finally:
+            workbook.close()
+
+
+def split_resources(resources):
+    # Resource ("folder/name.MapServer") -> the code of each request's resource (-1 where there is none) and the
+    # Service_Name and Service_Type of each distinct resource. Only the distinct resources are parsed, so the
+    # cost doesn't grow with the number of requests.
+    resources = resources.astype('category')
+    services = resources.cat.categories.to_series().str.rsplit('/', n=1).str[-1].str.rsplit('.', n=1)
+    return resources.cat.codes.to_numpy(), services.str[0].to_numpy(), services.str[1].fillna('').to_numpy()
+
+
+def export_all_requests(chunks, csv_path, keep=False):
+    # Appends the map and feature service requests of each chunk to csv_path. Returns the last request per
+    # (Service_Type, Service_Name), the rows written and, with keep, the exported requests as one frame.
+    # Only Resource is converted. The chunks are consumed: each column is moved out of its chunk as its service
+    # requests are copied, and added to the export as a block of its own (a DataFrame built from all the columns at
+    # once would consolidate them into one more copy), so a chunk is released while its export is built.
+    last_requests = [pd.DataFrame(columns=['Service_Type', 'Service_Name', 'Date Time (Local Time)'])]
+    kept = []
+    rows = 0
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        for chunk in chunks:
+            codes, names, types = split_resources(chunk['Resource'])
+            last = chunk['Date Time (Local Time)'].groupby(codes).max()
+            last = last[last.index >= 0]
+            last_requests.append(pd.DataFrame({'Service_Type': types[last.index], 'Service_Name': names[last.index],
+                                               'Date Time (Local Time)': last.to_numpy()}))
+
+            # Requests without a resource (code -1) pick up the trailing False
+            is_service = np.append(np.isin(types, list(SERVICE_ITEM_TYPES.values())), False)[codes]
+            services = pd.DataFrame(index=chunk.index[is_service])
+            for column, renamed in ALL_REQUESTS_COLUMNS.items():
+                services[renamed] = chunk.pop(column)[is_service]
+            chunk = services
+            chunk.to_csv(f, index=False, header=f.tell() == 0)
+            rows += len(chunk)
+            if keep:
+                kept.append(chunk)
+    last_accessed = pd.concat(last_requests, ignore_index=True).astype({'Service_Type': str, 'Service_Name': str})
+    last_accessed = last_accessed.groupby(['Service_Type', 'Service_Name'])['Date Time (Local Time)'].max()
+    if not keep:
+        return last_accessed, rows, None
+    return last_accessed, rows, kept[0] if len(kept) == 1 else pd.concat(kept, ignore_index=True)
+
+
+def process_sys_log_report(today_dir, server_log_dir=None, log_workers=None, chunk_rows=0):
+    # chunk_rows > 0 streams all_requests through in chunks of that many rows instead of holding the whole sheet.
+    # Reading the server logs natively, the requests go through Parquet files under sys_log_report, and only the
+    # columns of every request that the throughput and stats sheets are built from are held at once.
 
     try:
         report_dir = path.join(today_dir, 'sys_log_report')
-        os.chdir(report_dir)
-        for file in os.listdir(report_dir):
-            if file.endswith('xlsx'):
-                report = file
-                
-        # System Log Parser dfs
-        stats_by_user = pd.read_excel(report, sheet_name='Statistics By User', header=4)
-        stats_by_resource = pd.read_excel(report, sheet_name='Statistics By Resource', header=4)
-        all_requests = pd.read_excel(report, sheet_name='Elapsed Time - All Resources', header=3)
+
+        # System Log Parser dfs, or the same frames read straight from the server logs
+        if server_log_dir is not None:
+            logging.info('Reading the ArcGIS Server logs in {0}...'.format(server_log_dir))
+            sys_log_frames = read_server_logs(server_log_dir, workers=log_workers, chunk_rows=chunk_rows,
+                                              spill_dir=path.join(report_dir, 'all_requests_parts'))
+        else:
+            sys_log_frames = read_sys_log_report(report_dir, skip=['all_requests'] if chunk_rows else [])
+        stats_by_user = sys_log_frames['stats_by_user']
+        stats_by_resource = sys_log_frames['stats_by_resource']
 
 
         # Items DF
         items_df = pd.read_csv(path.join(today_dir, 'csv_files', 'items.csv'))
 
         # Throughput
-        throughput = pd.read_excel(report, sheet_name='Throughput per Minute', header=3)
+        throughput = sys_log_frames['throughput']
         throughput['date'] = pd.to_datetime(throughput['Date Time (Local Time)']).dt.to_period('D')
         throughput['Date Time (Local Time)'] = pd.to_datetime(throughput['Date Time (Local Time)'])
         throughput['Date Time (Local Time)'].dt.strftime('%m/%d/%Y %H:%M:%S')
@@ -336,129 +959,153 @@ def process_sys_log_report(today_dir):
         logging.info('Stats by Resource File:    {0}'.format(path.join(today_dir, 'csv_files', 'stats_by_resource.csv')))
 
 
+        # All Requests: map and feature service requests only, a chunk at a time when chunk_rows is set
+        all_requests_file = path.join(today_dir, 'csv_files', 'all_requests.csv')
+        if 'all_requests' in sys_log_frames and not chunk_rows:
+            # Handed over without a reference held here, so the export can free the sheet as it downcasts it
+            chunks = (sys_log_frames.pop('all_requests') for _ in range(1))
+        elif 'all_requests' in sys_log_frames:
+            # The native reader's requests, read back from the Parquet files it wrote them to
+            chunks = sys_log_frames.pop('all_requests')
+        else:
+            chunks = iter_sys_log_requests(report_dir, chunk_rows)
+        last_accessed, request_rows, all_requests = export_all_requests(chunks, all_requests_file,
+                                                                        keep=not chunk_rows)
+        logging.info('All Requests File:  {0} ({1} rows)'.format(all_requests_file, request_rows))
+
         # Item_Metrics
-        items_df = items_df[items_df['TYPE'].isin(['Map Service', 'Feature Service'])]
-        items_df.loc[items_df['TYPE'] == 'Map Service', 'Resource'] = items_df['TITLE'] + '.MapServer'
-        items_df.loc[items_df['TYPE'] == 'Feature Service', 'Resource'] = items_df['TITLE'] + '.FeatureServer'
-        last_accessed = all_requests.groupby('Resource')['Date Time (Local Time)'].max().reset_index()
+        items_df = items_df[items_df['TYPE'].isin(list(SERVICE_ITEM_TYPES))].copy()
+        items_df['Resource'] = items_df['TITLE'] + '.' + items_df['TYPE'].map(SERVICE_ITEM_TYPES)
+        last_accessed = last_accessed.drop('GPServer', level='Service_Type', errors='ignore').reset_index()
+        last_accessed['Resource'] = last_accessed['Service_Name'] + '.' + last_accessed['Service_Type']
         last_accessed['LAST_ACCESSED'] = pd.to_datetime(last_accessed['Date Time (Local Time)']).dt.to_period('D')
-        last_accessed = last_accessed[last_accessed['Resource'].str.contains('GPServer') == False]
-        last_accessed.loc[last_accessed.Resource.str.contains('/'), 'Resource'] = last_accessed.Resource.str.split("/", expand=True)[1]
-        last_accessed.rename(columns={'Date Time (Local Time)': 'Date_Time'}, inplace=True)
+        last_accessed = last_accessed[['Resource', 'Date Time (Local Time)', 'LAST_ACCESSED']].rename(
+            columns={'Date Time (Local Time)': 'Date_Time'})
         item_metrics = items_df.merge(right=last_accessed, how='outer', left_on='Resource', right_on='Resource')
 
         item_metrics.to_csv(path.join(today_dir, 'csv_files', 'item_metrics.csv'), index=False)
         logging.info('Item Metrics File:    {0}'.format(path.join(today_dir, 'csv_files', 'item_metrics.csv')))
 
+        # Handed to process_fgdb so these tables load without reading the CSVs back; a chunked all_requests
+        # is left out and streamed from its CSV instead
+        tables = {'throughput': throughput, 'stats_by_user': stats_by_user, 'stats_by_resource': stats_by_resource,
+                  'item_metrics': item_metrics}
+        if all_requests is not None:
+            tables['all_requests'] = all_requests
+        return tables
 
-        # All Requests
+    except Exception as processing_error:
+        logging.error(processing_error)
 
-        all_requests = all_requests[['Date Time (Local Time)',	'Epoch Time',	'Date Time (Day)',
-                                     'Date Time (Hour)', 'Date Time (Minute)',
-                                     'User', 'Server Machine',   'Content Length (Bytes)',
-                                     'HTTP Code',   'Elapsed Time (>= 0 sec)', 'Elapsed Time (Floor)',
-                                     'Resource', 'ArcGIS Method', 'ArcGIS Code',
-                                     'ArcGIS Type']]
+def read_request_chunks(today_dir, chunk_rows):
+    csv_path = path.join(today_dir, 'csv_files', 'all_requests.csv')
+    if path.isfile(csv_path) and path.getsize(csv_path) > 0:
+        yield from pd.read_csv(csv_path, chunksize=chunk_rows, parse_dates=ALL_REQUESTS_DATES,
+                               dtype={column: str for column in ALL_REQUESTS_TEXT})
 
-     
-        all_requests.rename(columns={'Date Time (Local Time)': 'Date_Time',  'Epoch Time': 'Epoch_Time', 'Date Time (Day)': 'Date_Time_Day',
-				    'Date Time (Hour)': 'Date_Time_Hour', 'Date Time (Minute)':'Date_Time_Minute',
-                                    'User':'User',  'Server Machine': 'Server_Machine',
-                                    'Content Length (Bytes)':'Content_Length_Bits', 'HTTP Code': 'HTTP_Code',
-                                    'Elapsed Time (>= 0 sec)':'Elapsed_Time', 'Elapsed Time (Floor)':'Elapsed_Time_Floor',
-                                     'Resource': 'Resource',  'ArcGIS Method': 'ArcGIS_Method',
-                                    'ArcGIS Code': 'ArcGIS_Code', 'ArcGIS Type': 'ArcGIS_Type'}, inplace=True)
 
-        all_requests = all_requests[all_requests['Resource'].str.contains('MapServer', 'FeatureServer') == True]
-        all_requests.to_csv(path.join(today_dir, 'csv_files', 'all_requests.csv'), index=False)
-        logging.info('All Requests File:  {0}'.format(path.join(today_dir, 'csv_files', 'all_requests.csv')))
+def has_run_table(today_dir, name):
+    return path.isfile(path.join(today_dir, 'csv_files', '{0}.csv'.format(name)))
 
-    except Exception as processing_error:
-        logging.error(processing_error)
 
-def process_fgdb(fgdb, today_dir):
+def read_run_table(today_dir, name, frames=None, chunk_rows=0):
+    # frames holds the tables already in memory, anything else is read from this run's CSVs. With chunk_rows,
+    # all_requests comes back as an iterator of frames for the table and history stores to write chunk by chunk.
+    if frames and name in frames:
+        return frames[name]
+    if chunk_rows and name == 'all_requests':
+        return read_request_chunks(today_dir, chunk_rows)
+    try:
+        return pd.read_csv(path.join(today_dir, 'csv_files', '{0}.csv'.format(name)))
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+
 
-    users_csv = path.join(today_dir, 'csv_files', 'users.csv')
-    items_csv = path.join(today_dir, 'csv_files', 'items.csv')
-    groups_csv = path.join(today_dir, 'csv_files', 'groups.csv')
-    throughput_csv = path.join(today_dir, 'csv_files', 'throughput.csv')
-    item_metrics_csv = path.join(today_dir, 'csv_files', 'item_metrics.csv')
-    stats_by_user_csv = path.join(today_dir, 'csv_files', 'stats_by_user.csv')
-    stats_by_resource_csv = path.join(today_dir, 'csv_files', 'stats_by_resource.csv')
-    all_requests_csv = path.join(today_dir, 'csv_files', 'all_requests.csv')
+def process_fgdb(fgdb, today_dir, incremental=False, frames=None, chunk_rows=0):
 
     try:
         logging.info('Processing fgdb...')
-        arcpy.env.workspace = fgdb
-
-        items = path.join(fgdb, 'items')
-        groups = path.join(fgdb,'groups')
-        users = path.join(fgdb,'users')
-        item_metrics = path.join(fgdb,'item_metrics')
-        stats_by_resource = path.join(fgdb,'stats_by_resource')
-        stats_by_user = path.join(fgdb,'stats_by_user')
-        throughput = path.join(fgdb,'throughput')
-        all_requests = path.join(fgdb, 'all_requests')
-
-
-        # Start truncating data
-        logging.info('Truncating users...')
-        arcpy.management.TruncateTable(users)
-       
-        logging.info('Truncating groups...')
-        arcpy.management.TruncateTable(groups)
-        
-        logging.info('Truncating items...')
-        arcpy.management.TruncateTable(items)
-
-        logging.info('Truncating throughput...')
-        arcpy.management.TruncateTable(throughput)
-
-        logging.info('Truncating stats_by_resource...')
-        arcpy.management.TruncateTable(stats_by_resource)
-        
-        logging.info('Truncating stats_by_user...')
-        arcpy.management.TruncateTable(stats_by_user)
-        
-        logging.info('Truncating item_metrics...')
-        arcpy.management.TruncateTable(item_metrics)
-
-        logging.info('Truncating all_requests...')
-        arcpy.management.TruncateTable(all_requests)
-
-
-        # Start appending data
-        logging.info('Appending users')
-        arcpy.Append_management(users_csv, users, "NO_TEST")
-
-        logging.info('Appending groups')
-        arcpy.Append_management(groups_csv, groups, "NO_TEST")
-        
-        logging.info('Appending items')
-        arcpy.Append_management(items_csv, items, "NO_TEST")
-
-        logging.info('Appending throughput')
-        arcpy.Append_management(throughput_csv, throughput, "NO_TEST")
-
-        logging.info('Appending item_metrics')
-        arcpy.Append_management(item_metrics_csv, item_metrics, "NO_TEST")
-        
-        logging.info('Appending stats_by_resource')
-        arcpy.Append_management(stats_by_resource_csv, stats_by_resource, "NO_TEST")
-        
-        logging.info('Appending stats_by_user')
-        arcpy.Append_management(stats_by_user_csv, stats_by_user, "NO_TEST")
-
-        logging.info('Appending all_requests')
-        arcpy.Append_management(all_requests_csv, all_requests, "NO_TEST")
-
-        arcpy.Compact_management(fgdb)
+        store = open_table_store(fgdb)
+
+        # Incremental runs only touch the portal rows that changed
+        deltas = {}
+        stale_keys = {name: set() for name in DELTA_KEYS}
+        if incremental:
+            with open(path.join(today_dir, 'csv_files', 'deleted.csv'), newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    stale_keys[row['DATASET']].add(row['KEY'])
+            for name, key in DELTA_KEYS.items():
+                deltas[name] = read_run_table(today_dir, '{0}_delta'.format(name))
+                stale_keys[name].update(str(row_key) for row_key in deltas[name].get(key, []))
+
+        # Read everything first so the tables are only locked while they load
+        tables = SYS_LOG_TABLES if incremental else list(DELTA_KEYS) + SYS_LOG_TABLES
+        tables = tables + [name for name in GOVERNANCE_TABLES if has_run_table(today_dir, name)]
+        loads = {name: read_run_table(today_dir, name, frames, chunk_rows) for name in tables}
+
+        for name, key in DELTA_KEYS.items():
+            store.ensure_key(name, key)
+        logging.info('Loading {0}'.format(', '.join(loads)))
+        store.replace_all(loads)
+        for name, key in DELTA_KEYS.items():
+            if name in deltas:
+                logging.info('Upserting {0}'.format(name))
+                store.upsert(name, deltas[name], key, stale_keys[name])
+
+        store.compact()
         logging.info('Compacting fgdb')
+        return True
+
+    except Exception as error:
+        logging.exception(error)
+
+
+def archive_history(history_dir, today_dir, frames, history_days, request_history_days, chunk_rows=0):
+    # all_requests is by far the largest dataset, so it has its own, shorter retention
+    try:
+        logging.info('Archiving today\'s tables to {0}...'.format(history_dir))
+        tables = {name: read_run_table(today_dir, name, frames, chunk_rows)
+                  for name in list(DELTA_KEYS) + SYS_LOG_TABLES + GOVERNANCE_TABLES
+                  if frames and name in frames or has_run_table(today_dir, name)}
+        archive_snapshots(history_dir, tables, {'all_requests': request_history_days}, history_days)
+        return True
+    except Exception as error:
+        logging.exception(error)
+
 
+def build_rollups(rollup_dir, fgdb, today_dir, frames, history_days, chunk_rows=0):
+    # Folds today's requests into the minute / hour / day rollups and reloads the rollup tables from them
+    try:
+        logging.info('Updating request rollups in {0}...'.format(rollup_dir))
+        requests = read_run_table(today_dir, 'all_requests', frames, chunk_rows)
+        update_rollups(rollup_dir, [requests] if isinstance(requests, pd.DataFrame) else requests,
+                       {'day': history_days})
+        open_table_store(fgdb).replace_all(rollup_tables(rollup_dir))
+        return True
     except Exception as error:
         logging.exception(error)
 
 
+def run_stage(checkpoint, metrics, name, func, *args):
+    # Runs one pipeline stage unless today's checkpoint already has it. Stages report failure by
+    # returning None or False (they log their own errors), only successful ones are checkpointed.
+    if checkpoint.done(name):
+        logging.info('Skipping {0}, already completed today'.format(name))
+        return None
+    with metrics.stage(name):
+        result = func(*args)
+    if result is not None and result is not False:
+        checkpoint.complete(name)
+    return result
+
+
+def count_csv_rows(today_dir, name):
+    csv_path = path.join(today_dir, 'csv_files', '{0}.csv'.format(name))
+    if path.isfile(csv_path) is False:
+        return None
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        return max(sum(1 for row in csv.reader(f)) - 1, 0)
+
 
 def cleanup(number_of_days, directory):
 
@@ -492,10 +1139,33 @@ if __name__ == '__main__':
     today_directory = path.join(reports_directory, f'{datetime.now().strftime("%m-%d-%Y")}')
     system_log_parser = config.get('ALL', 'sys_log_directory')
     server_log_directory = config.get('ALL', 'server_log_directory')
+    sys_log_source = config.get('ALL', 'sys_log_source', fallback='slp')
+    portal_client = config.get('ALL', 'portal_client', fallback='threads')
+    log_workers = config.getint('ALL', 'log_workers', fallback=0)
     file_geodatabase = config.get('ALL', 'file_geodatabase')
     title_13_thumbnail_id = config.get('ALL', 'title_13_thumbnail')
     server = config.get('ALL', 'server')
     sender = config.get('ALL', 'sender')
+    user_workers = config.getint('ALL', 'user_workers', fallback=8)
+    requests_per_second = config.getfloat('ALL', 'requests_per_second', fallback=20)
+    incremental = config.getboolean('ALL', 'incremental', fallback=False)
+    full_refresh_days = config.getint('ALL', 'full_refresh_days', fallback=7)
+    state_file = path.join(log_dir, 'audit_state.json')
+    thumbnail_cache_file = path.join(log_dir, 'thumbnail_cache.json')
+    email_dry_run = config.getboolean('ALL', 'email_dry_run', fallback=False)
+    governance_policy = {'required_tags': split_list(config.get('ALL', 'required_tags', fallback='')),
+                         'public_item_types': split_list(config.get('ALL', 'public_item_types', fallback='')),
+                         'stale_days': config.getint('ALL', 'stale_item_days', fallback=0),
+                         'max_size_mb': config.getfloat('ALL', 'max_item_size_mb', fallback=0)}
+    history_directory = config.get('ALL', 'history_directory', fallback=path.join(log_dir, 'history'))
+    history_days = config.getint('ALL', 'history_days', fallback=400)
+    request_history_days = config.getint('ALL', 'request_history_days', fallback=30)
+    request_chunk_rows = config.getint('ALL', 'request_chunk_rows', fallback=0)
+    rollup_directory = config.get('ALL', 'rollup_directory', fallback=path.join(log_dir, 'rollups'))
+    profile_stages = config.getboolean('ALL', 'profile_stages', fallback=False)
+    resume_runs = config.getboolean('ALL', 'resume_runs', fallback=True)
+    run_report_file = path.join(config.get('ALL', 'run_report_directory', fallback=path.join(log_dir, 'run_reports')),
+                                '{0}.json'.format(datetime.now().strftime('%Y-%m-%d')))
 
     logging.info("***** Start time:  {0}\n".format(datetime.now().strftime("%A %B %d %I:%M:%S %p %Y")))
     logging.info('Portal URL:   {0}'.format(portal_url))
@@ -506,20 +1176,101 @@ if __name__ == '__main__':
     logging.info('FGDB:   {0}\n'.format(file_geodatabase))
 
     
-    # Go!
+    # Incremental runs compare against the last successful run, with a full refresh every full_refresh_days
+    audit_state = read_json(state_file)
+    run_started = int(time.time() * 1000)
+    previous_directory = None
+    watermark = None
+    if incremental and audit_state.get('last_dir') not in (None, today_directory) \
+            and path.isdir(audit_state['last_dir']) \
+            and run_started - audit_state.get('last_full', 0) < full_refresh_days * 86400000:
+        previous_directory = audit_state['last_dir']
+        watermark = audit_state['last_run']
+
+    # Go! Stages finished earlier today are skipped, the portal export resumes from its cursors
+    metrics = RunMetrics(path.join(today_directory, 'profiles') if profile_stages else None)
     try:
         create_directories(reports_directory, today_directory)
-        generate_sys_log_report(system_log_parser, today_directory, server_log_directory)
-        portal_connection = connect_to_portal(portal_url, portal_cred_name, portal_cred_user)
-        get_portal_data(portal_connection, today_directory)
-        validate_title_13(portal_connection, title_13_thumbnail_id, server, sender)
-        process_sys_log_report(today_directory)
-        process_fgdb(file_geodatabase, today_directory)
+        checkpoint_file = path.join(today_directory, 'checkpoint.json')
+        if not resume_runs and path.isfile(checkpoint_file):
+            os.remove(checkpoint_file)
+        checkpoint = RunCheckpoint(checkpoint_file)
+
+        # slp.exe only needs the server logs, so it runs while the portal is harvested
+        sys_log_report = None
+        with ThreadPoolExecutor(max_workers=1) as sys_log_runner:
+            if sys_log_source == 'slp':
+                sys_log_report = sys_log_runner.submit(run_stage, checkpoint, metrics, 'generate_sys_log_report',
+                                                       generate_sys_log_report, system_log_parser, today_directory,
+                                                       server_log_directory)
+            with metrics.stage('connect_to_portal'):
+                portal_connection = connect_to_portal(portal_url, portal_cred_name, portal_cred_user)
+            # connect_to_portal logs its own error. An export finished earlier today still feeds the later stages.
+            if portal_connection is None:
+                logging.error('Skipping get_portal_data and check_governance, could not connect to the portal')
+            else:
+                metrics.instrument(portal_connection._con)
+                audit_cache = AuditCache(portal_connection)
+                if portal_client == 'async':
+                    run_stage(checkpoint, metrics, 'get_portal_data', get_portal_data_async, portal_connection,
+                              today_directory, user_workers, requests_per_second, previous_directory, watermark,
+                              audit_cache, metrics)
+                else:
+                    run_stage(checkpoint, metrics, 'get_portal_data', get_portal_data, portal_connection,
+                              today_directory, user_workers, requests_per_second, previous_directory, watermark,
+                              audit_cache, checkpoint)
+                for name in DELTA_KEYS:
+                    metrics.rows('get_portal_data', name, count_csv_rows(today_directory, name))
+                notifications = NotificationQueue(server, sender, path.join(today_directory, 'notifications')
+                                                  if email_dry_run else None)
+                # Governance reads items.csv, so it waits for a complete portal export rather than mailing owners
+                # about a partial one
+                if checkpoint.done('get_portal_data'):
+                    run_stage(checkpoint, metrics, 'check_governance', check_governance, portal_connection,
+                              title_13_thumbnail_id, notifications, today_directory, governance_policy, audit_cache,
+                              thumbnail_cache_file, user_workers)
+                else:
+                    logging.error('Skipping check_governance, the portal export did not complete')
+        if sys_log_report is not None:
+            sys_log_report.result()
+        portal_complete = checkpoint.done('get_portal_data')
+
+        # Everything after the export reads the portal CSVs (item_metrics joins items.csv, process_fgdb replaces the
+        # portal tables), so none of it runs, or is checkpointed, until the export is complete. A same-day rerun
+        # that finishes the export then runs them all.
+        if portal_complete:
+            sys_log_tables = run_stage(checkpoint, metrics, 'process_sys_log_report', process_sys_log_report,
+                                       today_directory, server_log_directory if sys_log_source == 'native' else None,
+                                       log_workers, request_chunk_rows)
+            for name, table in (sys_log_tables or {}).items():
+                metrics.rows('process_sys_log_report', name, len(table))
+            if sys_log_tables is not None and 'all_requests' not in sys_log_tables:
+                metrics.rows('process_sys_log_report', 'all_requests', count_csv_rows(today_directory, 'all_requests'))
+            run_stage(checkpoint, metrics, 'process_fgdb', process_fgdb, file_geodatabase, today_directory,
+                      previous_directory is not None, sys_log_tables, request_chunk_rows)
+            run_stage(checkpoint, metrics, 'archive_history', archive_history, history_directory, today_directory,
+                      sys_log_tables, history_days, request_history_days, request_chunk_rows)
+            run_stage(checkpoint, metrics, 'build_rollups', build_rollups, rollup_directory, file_geodatabase,
+                      today_directory, sys_log_tables, history_days, request_chunk_rows)
+        else:
+            logging.error('Skipping the report, geodatabase, history and rollup stages, the portal export did not '
+                          'complete')
         cleanup(7, reports_directory)
 
+        # Only a run whose portal tables reached the geodatabase becomes the baseline for the next deltas
+        if checkpoint.done('process_fgdb'):
+            write_json(state_file, {'last_run': run_started, 'last_dir': today_directory,
+                                    'last_full': run_started if previous_directory is None
+                                    else audit_state['last_full']})
+
     except Exception as e:
         print(e)
         logging.exception(e)
 
+    try:
+        metrics.write_report(run_report_file)
+    except Exception as e:
+        logging.exception(e)
+
     logging.info("***** Completed time:  {0}\n".format(datetime.now().strftime("%A %B %d %I:%M:%S %p %Y")))
     logging.shutdown()
@@ -0,0 +1,263 @@
+import json
+import logging
+import os
+import shutil
+from collections import Counter
+from datetime import datetime, timedelta
+from os import path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Pre-aggregated request rollups for the dashboards: per service, user and machine at minute, hour and day
+# granularity. Each rollup is kept as <rollup_dir>/<dimension>_<granularity>/day=YYYY-MM-DD/part-0.parquet with one
+# row per (period, key, latency bucket). The buckets are a mergeable quantile sketch in the style of DDSketch
+# (relative error SKETCH_ACCURACY), so a period split across two runs is finished by adding the second run's
+# counts to the first, without going back to the raw requests.
+# Every partition carries a watermark in its Parquet metadata: its latest request time and the signatures of the
+# requests folded in at that time. The newest partition's watermark tells a later run which of its requests are
+# already in the rollup, including the ones that share the watermark's timestamp.
+
+# Rollup dimension -> all_requests column
+DIMENSIONS = {'service': 'Resource', 'user': 'User', 'machine': 'Server_Machine'}
+
+# Rollup granularity -> pandas frequency
+GRANULARITIES = {'minute': 'min', 'hour': 'h', 'day': 'D'}
+
+# Days of each granularity kept, minute rollups are only for recent troubleshooting
+RETENTION_DAYS = {'minute': 3, 'hour': 90, 'day': 400}
+
+SKETCH_ACCURACY = 0.01
+GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+
+# Elapsed times at or below this (seconds) share the lowest bucket
+MIN_ELAPSED = 0.0001
+
+QUANTILES = {'P95_Elapsed': 0.95, 'P99_Elapsed': 0.99}
+
+# Parquet metadata key of a partition's watermark
+WATERMARK_KEY = b'rollup_watermark'
+
+FOLD_KEYS = ['Period', 'Key', 'Bucket']
+FOLD_AGGREGATES = {'Count': 'sum', 'Elapsed_Sum': 'sum', 'Elapsed_Max': 'max', 'Bytes': 'sum', 'Last_Request': 'max'}
+
+
+def rollup_names():
+    return ['{0}_{1}'.format(dimension, granularity) for dimension in DIMENSIONS for granularity in GRANULARITIES]
+
+
+def sketch_bucket(elapsed):
+    # Bucket i holds the values in (GAMMA ** (i - 1), GAMMA ** i]
+    return np.ceil(np.log(np.maximum(elapsed, MIN_ELAPSED)) / np.log(GAMMA)).astype(np.int16)
+
+
+def bucket_value(bucket):
+    # The point of the bucket within SKETCH_ACCURACY of every value in it
+    return 2 * GAMMA ** bucket.astype(float) / (GAMMA + 1)
+
+
+def fold(requests, dimension, granularity):
+    # Raw requests -> one row per (period, key, bucket)
+    frame = pd.DataFrame({'Period': requests['Date_Time'].dt.floor(GRANULARITIES[granularity]),
+                          'Key': requests[DIMENSIONS[dimension]].astype(str),
+                          'Bucket': requests['Bucket'], 'Elapsed': requests['Elapsed'],
+                          'Bytes': requests['Bytes'], 'Date_Time': requests['Date_Time']})
+    return frame.groupby(FOLD_KEYS, sort=False).agg(
+        Count=('Elapsed', 'size'), Elapsed_Sum=('Elapsed', 'sum'), Elapsed_Max=('Elapsed', 'max'),
+        Bytes=('Bytes', 'sum'), Last_Request=('Date_Time', 'max')).reset_index()
+
+
+def merge_folds(folds):
+    folds = [folded for folded in folds if folded is not None and len(folded)]
+    if len(folds) == 1:
+        return folds[0]
+    if not folds:
+        return None
+    return pd.concat(folds, ignore_index=True).groupby(FOLD_KEYS, sort=False).agg(FOLD_AGGREGATES).reset_index()
+
+
+def partition_file(rollup_dir, name, day):
+    return path.join(rollup_dir, name, 'day={0}'.format(day.strftime('%Y-%m-%d')), 'part-0.parquet')
+
+
+def partition_days(rollup_dir, name):
+    rollup_path = path.join(rollup_dir, name)
+    return sorted(partition[len('day='):] for partition in os.listdir(rollup_path)
+                  if partition.startswith('day=')) if path.isdir(rollup_path) else []
+
+
+def read_partition(partition):
+    return pq.read_table(partition).to_pandas() if path.isfile(partition) else None
+
+
+def request_signatures(requests):
+    # One per request, telling apart the requests that share a timestamp
+    columns = [requests['Date_Time'].astype(str), requests['Elapsed'].map(repr),
+               requests['Bytes'].astype(float).map(repr)] + [requests[column].astype(str)
+                                                            for column in DIMENSIONS.values()]
+    return ['|'.join(values) for values in zip(*columns)]
+
+
+def day_watermarks(requests):
+    # Day -> (latest request time, signatures of the requests at it)
+    latest = requests.groupby(requests['Date_Time'].dt.floor('D'))['Date_Time'].max()
+    return {day: (time, Counter(request_signatures(requests[requests['Date_Time'] == time])))
+            for day, time in latest.items()}
+
+
+def later_watermark(first, second):
+    # The later of two watermarks; the signatures add up when they are at the same time. A watermark without
+    # signatures stands for every request at its time.
+    if first is None or second is None:
+        return first if second is None else second
+    if first[0] != second[0]:
+        return max(first, second, key=lambda watermark: watermark[0])
+    return first[0], None if first[1] is None or second[1] is None else first[1] + second[1]
+
+
+def read_watermark(partition):
+    # Partitions written before watermarks were kept fall back to their latest request, without signatures
+    if not path.isfile(partition):
+        return None
+    metadata = pq.read_schema(partition).metadata or {}
+    if WATERMARK_KEY in metadata:
+        watermark = json.loads(metadata[WATERMARK_KEY])
+        return pd.Timestamp(watermark['time']), Counter(watermark['requests'])
+    latest = pq.read_table(partition, columns=['Last_Request']).column('Last_Request').to_pandas().max()
+    return None if pd.isna(latest) else (latest, None)
+
+
+def rollup_watermark(rollup_dir, name):
+    # Requests up to this watermark are already in the rollup. Days are written oldest first, so the newest
+    # partition on disk always holds the newest request folded in, even after an interrupted update.
+    days = partition_days(rollup_dir, name)
+    return read_watermark(path.join(rollup_dir, name, 'day={0}'.format(days[-1]), 'part-0.parquet')) if days else None
+
+
+def unseen(requests, watermark):
+    # The requests after the watermark and the ones at its time that it doesn't list. The requests found in the
+    # watermark are used up, so an identical request beyond the number listed counts as new.
+    if watermark is None:
+        return requests
+    time, seen = watermark
+    keep = requests['Date_Time'] > time
+    at_mark = requests['Date_Time'] == time
+    if seen is not None and at_mark.any():
+        fresh = []
+        for signature in request_signatures(requests[at_mark]):
+            fresh.append(seen[signature] <= 0)
+            seen[signature] -= 1
+        keep[at_mark] = fresh
+    return requests if keep.all() else requests[keep]
+
+
+def write_partition(partition, folded, watermark=None):
+    # Written beside the old file and swapped in, so a partition is never left half written
+    os.makedirs(path.dirname(partition), exist_ok=True)
+    temp_file = partition + '.tmp'
+    table = pa.Table.from_pandas(folded, preserve_index=False)
+    if watermark is not None and watermark[1] is not None:
+        time, seen = watermark
+        requests = {signature: count for signature, count in seen.items() if count > 0}
+        table = table.replace_schema_metadata({**table.schema.metadata, WATERMARK_KEY: json.dumps(
+            {'time': time.isoformat(), 'requests': requests})})
+    pq.write_table(table, temp_file, compression='zstd')
+    os.replace(temp_file, partition)
+
+
+def prune_rollup(rollup_dir, name, keep_days, today):
+    oldest = (today - timedelta(days=keep_days)).strftime('%Y-%m-%d')
+    removed = 0
+    for day in partition_days(rollup_dir, name):
+        if day < oldest:
+            shutil.rmtree(path.join(rollup_dir, name, 'day={0}'.format(day)))
+            removed += 1
+    return removed
+
+
+def prepare_requests(chunk):
+    # The all_requests columns the rollups need, with each request's sketch bucket
+    requests = pd.DataFrame({'Date_Time': pd.to_datetime(chunk['Date_Time'], errors='coerce'),
+                             'Elapsed': pd.to_numeric(chunk['Elapsed_Time'], errors='coerce'),
+                             'Bytes': pd.to_numeric(chunk['Content_Length_Bits'], errors='coerce')})
+    for column in DIMENSIONS.values():
+        requests[column] = chunk[column]
+    requests = requests.dropna(subset=['Date_Time', 'Elapsed'])
+    requests['Bucket'] = sketch_bucket(requests['Elapsed'].to_numpy())
+    return requests
+
+
+def update_rollups(rollup_dir, chunks, retention=None, today=None):
+    # chunks: all_requests frames (renamed columns, as in all_requests.csv). Requests already in a rollup, by its
+    # watermark, are skipped, so overlapping run windows and reruns aren't counted twice.
+    retention = dict(RETENTION_DAYS, **(retention or {}))
+    today = today or datetime.now()
+    names = rollup_names()
+    marks = {name: rollup_watermark(rollup_dir, name) for name in names}
+    folded = dict.fromkeys(names)
+    watermarks = {name: {} for name in names}
+    for chunk in chunks:
+        requests = prepare_requests(chunk)
+        chunk_watermarks = None
+        for name in names:
+            dimension, granularity = name.split('_')
+            new = unseen(requests, marks[name])
+            folded[name] = merge_folds([folded[name], fold(new, dimension, granularity)])
+            # Usually every rollup takes the whole chunk, and its watermarks are found once
+            if new is not requests:
+                new_watermarks = day_watermarks(new)
+            elif chunk_watermarks is None:
+                new_watermarks = chunk_watermarks = day_watermarks(requests)
+            else:
+                new_watermarks = chunk_watermarks
+            for day, watermark in new_watermarks.items():
+                watermarks[name][day] = later_watermark(watermarks[name].get(day), watermark)
+
+    for name in names:
+        granularity = name.split('_')[1]
+        added = folded[name]
+        if added is not None:
+            days = added['Period'].dt.floor('D')
+            for day in sorted(days.unique()):
+                partition = partition_file(rollup_dir, name, day)
+                write_partition(partition, merge_folds([read_partition(partition), added[days == day]]),
+                                later_watermark(read_watermark(partition), watermarks[name].get(day)))
+        removed = prune_rollup(rollup_dir, name, retention[granularity], today)
+        logging.info('Rollup {0}: {1} requests added, {2} expired days removed'.format(
+            name, 0 if added is None else int(added['Count'].sum()), removed))
+
+
+def summarize(folded, dimension):
+    # Sketch rows -> one dashboard row per (period, key): request count, mean / P95 / P99 / max elapsed and bytes
+    folded = folded.sort_values(FOLD_KEYS, ignore_index=True)
+    groups = folded.groupby(['Period', 'Key'], sort=False)
+    summary = groups.agg(Requests=('Count', 'sum'), Elapsed_Sum=('Elapsed_Sum', 'sum'),
+                         Max_Elapsed=('Elapsed_Max', 'max'), Bytes=('Bytes', 'sum'))
+    summary.insert(1, 'Avg_Elapsed', summary.pop('Elapsed_Sum') / summary['Requests'])
+
+    # A quantile is the first bucket whose running count passes its rank
+    running = groups['Count'].cumsum()
+    total = groups['Count'].transform('sum')
+    for column, quantile in QUANTILES.items():
+        reached = folded.loc[running > quantile * (total - 1), ['Period', 'Key', 'Bucket']]
+        first = reached.groupby(['Period', 'Key'], sort=False)['Bucket'].first()
+        summary[column] = np.minimum(bucket_value(first.reindex(summary.index).to_numpy()),
+                                     summary['Max_Elapsed'].to_numpy())
+    summary = summary[['Requests', 'Avg_Elapsed', 'P95_Elapsed', 'P99_Elapsed', 'Max_Elapsed', 'Bytes']]
+    return summary.reset_index().rename(columns={'Key': DIMENSIONS[dimension]})
+
+
+def read_rollup(rollup_dir, name):
+    # Summarized rollup, a day partition at a time
+    dimension = name.split('_')[0]
+    for day in partition_days(rollup_dir, name):
+        folded = read_partition(path.join(rollup_dir, name, 'day={0}'.format(day), 'part-0.parquet'))
+        if folded is not None and len(folded):
+            yield summarize(folded, dimension)
+
+
+def rollup_tables(rollup_dir):
+    # Table name -> iterable of frames, for a table store's replace_all
+    return {'rollup_{0}'.format(name): read_rollup(rollup_dir, name) for name in rollup_names()}
@@ -0,0 +1,174 @@
+import cProfile
+import json
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from os import path
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Per-stage wall/CPU time, rows and peak RSS (sampled while the stage runs), plus REST request counts and latency
+# histograms per endpoint, written as one JSON report per run so a slow night can be compared with earlier ones.
+
+# How often the RSS of the running stages is sampled, allocations freed again sooner than this can be missed
+RSS_SAMPLE_SECONDS = 0.1
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf')]
+
+# Item / group ids and user names are folded so requests are grouped by endpoint
+ID_PATTERN = re.compile(r'/[0-9a-f]{32}(?=/|$)')
+USER_PATTERN = re.compile(r'/users/[^/]+')
+
+
+def endpoint_name(url):
+    endpoint = url.split('/sharing/rest/', 1)[-1].split('?', 1)[0]
+    return USER_PATTERN.sub('/users/{username}', ID_PATTERN.sub('/{id}', '/' + endpoint.strip('/')))
+
+
+def peak_rss_mb():
+    # The peak, never the current RSS: ru_maxrss where there is a resource module, psutil's peak working set on Windows
+    if resource is not None:
+        # ru_maxrss is reported in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if psutil is not None:
+        peak = getattr(psutil.Process().memory_info(), 'peak_wset', None)
+        if peak is not None:
+            return peak / 1024 / 1024
+    return None
+
+
+def current_rss_mb():
+    # The RSS right now, from psutil where it is installed, /proc/self/statm on Linux otherwise
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RunMetrics:
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.started = datetime.now()
+        self.stages = {}
+        # Stages running right now, whose peak RSS the sampler thread updates while any is running
+        self.running = {}
+        self.sampler = None
+        self.requests = defaultdict(lambda: {'count': 0, 'errors': 0, 'seconds': 0.0, 'max': 0.0,
+                                             'buckets': [0] * len(LATENCY_BUCKETS)})
+
+    @contextmanager
+    def stage(self, name):
+        # cProfile only sees the calling thread, worker threads show up as time spent waiting on them
+        profiler = cProfile.Profile() if self.profile_dir else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        stage = self.stages.setdefault(name, {'rows': {}})
+        # ru_maxrss is the peak of the whole process so far, and stages run side by side, so each stage's peak is
+        # the highest RSS sampled while it runs
+        rss = current_rss_mb()
+        if rss is not None:
+            stage['start_rss_mb'] = round(rss, 1)
+            with self.lock:
+                self.running[name] = [rss]
+                if self.sampler is None:
+                    self.sampler = threading.Thread(target=self.sample_rss, daemon=True)
+                    self.sampler.start()
+        if profiler:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another stage running on a different thread already holds the profiler
+                profiler = None
+        try:
+            yield stage
+        finally:
+            if profiler:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(path.join(self.profile_dir, '{0}.prof'.format(name)))
+            stage['wall_seconds'] = round(time.perf_counter() - wall, 3)
+            stage['cpu_seconds'] = round(time.process_time() - cpu, 3)
+            if rss is not None:
+                rss = current_rss_mb()
+                with self.lock:
+                    peak = max(self.running.pop(name)[0], rss)
+                stage['peak_rss_mb'] = round(peak, 1)
+            logging.info('Stage {0}: {1}s wall, {2}s CPU'.format(name, stage['wall_seconds'], stage['cpu_seconds']))
+
+    def sample_rss(self):
+        # Runs until no stage is left running, the next stage to start begins a new sampler
+        while True:
+            time.sleep(RSS_SAMPLE_SECONDS)
+            rss = current_rss_mb()
+            with self.lock:
+                if not self.running:
+                    self.sampler = None
+                    return
+                for peak in self.running.values():
+                    peak[0] = max(peak[0], rss)
+
+    def rows(self, stage, dataset, count):
+        self.stages.setdefault(stage, {'rows': {}})['rows'][dataset] = count
+
+    def record_request(self, url, seconds, failed=False):
+        endpoint = endpoint_name(url)
+        with self.lock:
+            stats = self.requests[endpoint]
+            stats['count'] += 1
+            stats['errors'] += failed
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['buckets'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def instrument(self, connection):
+        # Times every get/post made through an arcgis connection, the arcgis API's own calls included
+        for method in ('get', 'post'):
+            call = getattr(connection, method)
+
+            def timed(*args, _call=call, **kwargs):
+                # The url is the first argument, which the arcgis API also passes by keyword as path=
+                url = args[0] if args else kwargs.get('path', kwargs.get('url', ''))
+                started = time.perf_counter()
+                failed = True
+                try:
+                    result = _call(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    self.record_request(url, time.perf_counter() - started, failed)
+
+            setattr(connection, method, timed)
+
+    def report(self):
+        with self.lock:
+            requests = {endpoint: dict(stats, seconds=round(stats['seconds'], 3), max=round(stats['max'], 3),
+                                       buckets=dict(zip([str(b) for b in LATENCY_BUCKETS], stats['buckets'])))
+                        for endpoint, stats in sorted(self.requests.items())}
+        return {'started': self.started.isoformat(timespec='seconds'),
+                'finished': datetime.now().isoformat(timespec='seconds'),
+                'peak_rss_mb': peak_rss_mb(), 'stages': self.stages, 'requests': requests}
+
+    def write_report(self, report_file):
+        os.makedirs(path.dirname(report_file), exist_ok=True)
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+        logging.info('Run report:   {0}'.format(report_file))
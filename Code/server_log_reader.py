@@ -0,0 +1,291 @@
+import mmap
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+from os import path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Native reader for ArcGIS Server log files (<log dir>/<machine>/server|services/**/*.log), producing the same
+# frames as the System Log Parser spreadsheet so process_sys_log_report can use either one.
+# Request timings are only written when the server log level is FINE or more verbose.
+
+MSG_PATTERN = re.compile(rb'<Msg ([^>]*)>(.*?)</Msg>', re.DOTALL)
+ATTR_PATTERN = re.compile(rb'(\w+)="([^"]*)"')
+RESPONSE_SIZE_PATTERN = re.compile(rb'Response size is (\d+)')
+
+# Groups of log files handed to each worker process, so a big file can be balanced out by small ones
+TASKS_PER_WORKER = 2
+
+# Parsed records held as tuples before they are turned into a frame
+RECORD_BATCH_ROWS = 100000
+
+# Files larger than this are memory-mapped instead of read into memory
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+REQUEST_COLUMNS = ['Date Time (Local Time)', 'User', 'Server Machine', 'Content Length (Bytes)', 'HTTP Code',
+                   'Elapsed Time (>= 0 sec)', 'Resource', 'ArcGIS Method', 'ArcGIS Code', 'ArcGIS Type']
+
+# Columns of all_requests, the record columns plus the ones derived from the request time and elapsed time
+ALL_REQUESTS_COLUMNS = ['Date Time (Local Time)', 'Epoch Time', 'Date Time (Day)', 'Date Time (Hour)',
+                        'Date Time (Minute)', 'User', 'Server Machine', 'Content Length (Bytes)', 'HTTP Code',
+                        'Elapsed Time (>= 0 sec)', 'Elapsed Time (Floor)', 'Resource', 'ArcGIS Method', 'ArcGIS Code',
+                        'ArcGIS Type']
+
+# The columns the throughput and stats sheets are built from, all that a chunked read keeps of every request
+STATS_SOURCE_COLUMNS = ['Date Time (Minute)', 'User', 'HTTP Code', 'Elapsed Time (>= 0 sec)', 'Resource',
+                        'ArcGIS Method']
+
+# Kept as categories in a chunked read, a few distinct values repeated over every request
+STATS_SOURCE_CATEGORIES = ['User', 'Resource', 'ArcGIS Method']
+
+# Types of the record columns, so a window without any requests still gives typed, empty frames
+REQUEST_DTYPES = {'Date Time (Local Time)': object, 'User': object, 'Server Machine': object,
+                  'Content Length (Bytes)': 'int64', 'HTTP Code': 'int64', 'Elapsed Time (>= 0 sec)': 'float64',
+                  'Resource': object, 'ArcGIS Method': object, 'ArcGIS Code': 'int64', 'ArcGIS Type': object}
+
+# Log times are written in the server's local time
+LOCAL_TIMEZONE = datetime.now().astimezone().tzinfo
+
+# Log times are ISO formatted, so they sort the same as strings
+LOG_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S,%f'
+
+STATS_COLUMNS = ['Count', 'Count Pct', 'Avg', 'Min', 'P25', 'P50', 'P75', 'P95', 'P99', 'Max', 'Stdev', 'Sum',
+                 'Sum Pct']
+
+
+def list_log_files(log_dir, since):
+    # Files last written before the window started cannot hold any requests inside it
+    for root, dirs, files in os.walk(log_dir):
+        for file in sorted(files):
+            log_file = path.join(root, file)
+            if file.endswith('.log') and path.getmtime(log_file) >= since:
+                yield log_file
+
+
+def parse_log_file(log_file):
+    # Yields one record (ordered like REQUEST_COLUMNS, time still a string) per service request in the file
+    with open(log_file, 'rb') as f:
+        if path.getsize(log_file) > MMAP_THRESHOLD:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = f.read()
+
+        try:
+            for msg in MSG_PATTERN.finditer(data):
+                attrs = dict(ATTR_PATTERN.findall(msg.group(1)))
+                elapsed = attrs.get(b'elapsed')
+                target = attrs.get(b'target', b'')
+                if not elapsed or not target.endswith(b'Server'):
+                    continue
+
+                msg_type = attrs.get(b'type', b'').decode()
+                size = RESPONSE_SIZE_PATTERN.search(msg.group(2))
+                yield (attrs.get(b'time', b'').decode(),
+                       attrs.get(b'user', b'').decode() or '-',
+                       attrs.get(b'machine', b'').decode(),
+                       int(size.group(1)) if size else 0,
+                       500 if msg_type == 'SEVERE' else 400 if msg_type == 'WARNING' else 200,
+                       float(elapsed),
+                       target.decode(),
+                       attrs.get(b'methodName', b'').decode(),
+                       int(attrs.get(b'code', b'0') or 0),
+                       msg_type)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def epoch_ms(local_time):
+    return (local_time.dt.tz_localize(LOCAL_TIMEZONE) - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+
+
+def build_requests(records, start_time, end_time):
+    # Typed frame of the records inside the window, with the columns derived from the request time
+    values = dict(zip(REQUEST_COLUMNS, zip(*records))) if records else {}
+    columns = {column: pd.Series(values.get(column, ()), dtype=dtype) for column, dtype in REQUEST_DTYPES.items()}
+    local_time = pd.to_datetime(columns['Date Time (Local Time)'], format=LOG_TIME_FORMAT)
+    inside = (local_time >= start_time) & (local_time <= end_time)
+    if not inside.all():
+        local_time = local_time[inside].reset_index(drop=True)
+        columns = {column: series[inside].reset_index(drop=True) for column, series in columns.items()}
+
+    columns.update({'Date Time (Local Time)': local_time, 'Epoch Time': epoch_ms(local_time),
+                    'Date Time (Day)': local_time.dt.floor('D'), 'Date Time (Hour)': local_time.dt.floor('60min'),
+                    'Date Time (Minute)': local_time.dt.floor('min'),
+                    'Elapsed Time (Floor)': columns['Elapsed Time (>= 0 sec)'].astype(int)})
+    return pd.DataFrame(columns, columns=ALL_REQUESTS_COLUMNS)
+
+
+def split_log_files(log_files, parts):
+    # Largest files first, each onto the part with the fewest bytes so far, so the parts take about as long to parse
+    groups = [[] for _ in range(parts)]
+    sizes = [0] * parts
+    for log_file in sorted(log_files, key=path.getsize, reverse=True):
+        part = sizes.index(min(sizes))
+        groups[part].append(log_file)
+        sizes[part] += path.getsize(log_file)
+    return [group for group in groups if group]
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def spill_requests(frames, spill_file):
+    # Writes each frame, in time order, to spill_file as a row group of its own and keeps only the columns the stats
+    # are built from. Returns those, or no frames when no request was inside the window.
+    writer = None
+    kept = []
+    try:
+        for frame in frames:
+            if not len(frame):
+                continue
+            frame = frame.sort_values('Date Time (Local Time)', kind='stable', ignore_index=True)
+            table = pa.Table.from_pandas(frame, schema=writer.schema if writer else None, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(spill_file, table.schema)
+            writer.write_table(table)
+            kept.append(frame[STATS_SOURCE_COLUMNS].astype(dict.fromkeys(STATS_SOURCE_CATEGORIES, 'category')))
+    finally:
+        if writer is not None:
+            writer.close()
+    return kept
+
+
+def read_log_group(log_files, start_time, end_time, batch_rows=None, spill_file=None):
+    # Runs in a worker process: the requests inside the window go back to the parent as typed frames, which pickle
+    # as a few arrays instead of a tuple per request. Records are turned into a frame every batch_rows
+    # (RECORD_BATCH_ROWS by default), so no more than that are held as tuples. With a spill_file the requests are
+    # written there instead, and only their stats columns go back.
+    start, end = start_time.strftime(LOG_TIME_FORMAT), end_time.strftime(LOG_TIME_FORMAT)
+    records = (record for log_file in log_files for record in parse_log_file(log_file) if start <= record[0] <= end)
+    batches = batched(records, batch_rows or RECORD_BATCH_ROWS)
+    frames = (build_requests(batch, start_time, end_time) for batch in batches)
+    if spill_file is None:
+        return list(frames)
+    return spill_requests(frames, spill_file)
+
+
+def read_log_files(log_files, start_time, end_time, workers, batch_rows=None, spill_dir=None):
+    # With a spill_dir each group of files is written to a Parquet file of its own there, see read_log_group
+    if workers <= 1 or len(log_files) <= 1:
+        groups = [log_files]
+    else:
+        # A few groups of files per worker: a frame per file would cost more to build and merge than its requests
+        groups = split_log_files(log_files, workers * TASKS_PER_WORKER)
+    spill_files = [path.join(spill_dir, 'part-{0:03d}.parquet'.format(part)) if spill_dir else None
+                   for part in range(len(groups))]
+    if len(groups) == 1:
+        return read_log_group(groups[0], start_time, end_time, batch_rows, spill_files[0])
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [frame for frames in executor.map(read_log_group, groups, [start_time] * len(groups),
+                                                 [end_time] * len(groups), [batch_rows] * len(groups), spill_files)
+                for frame in frames]
+
+
+def build_all_requests(frames, start_time, end_time):
+    # The frames of the record batches merged into one, in request time order
+    frames = [frame for frame in frames if len(frame)] or [build_requests([], start_time, end_time)]
+    requests = pd.concat(frames, ignore_index=True)
+    return requests.sort_values('Date Time (Local Time)', kind='stable', ignore_index=True)
+
+
+def build_stats_source(frames, start_time, end_time):
+    # The stats columns of a chunked read merged into one; categories are merged on their values, a plain concat
+    # would turn columns whose categories differ back into strings
+    if not frames:
+        return build_requests([], start_time, end_time)[STATS_SOURCE_COLUMNS]
+    columns = {column: pd.api.types.union_categoricals([frame[column] for frame in frames])
+               if column in STATS_SOURCE_CATEGORIES else pd.concat([frame[column] for frame in frames],
+                                                                   ignore_index=True)
+               for column in STATS_SOURCE_COLUMNS}
+    return pd.DataFrame(columns, columns=STATS_SOURCE_COLUMNS)
+
+
+def read_spilled_requests(spill_dir, chunk_rows):
+    # all_requests of a chunked read, back out of its Parquet files in frames of up to chunk_rows rows
+    for spill_file in sorted(os.listdir(spill_dir)):
+        for batch in pq.ParquetFile(path.join(spill_dir, spill_file)).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+
+
+def build_throughput(requests):
+    minute = requests['Date Time (Minute)']
+    elapsed = requests['Elapsed Time (>= 0 sec)'].groupby(minute)
+    throughput = pd.DataFrame({'Requests/Minute': elapsed.count(),
+                               'Avg Response Time': elapsed.mean(),
+                               'Min Response Time': elapsed.min(),
+                               'P95 Response Time': elapsed.quantile(0.95),
+                               'P99 Response Time': elapsed.quantile(0.99),
+                               'Max Response Time': elapsed.max()})
+    throughput.insert(1, 'Requests/Seccond', throughput['Requests/Minute'] / 60)
+
+    http_codes = pd.crosstab(minute, requests['HTTP Code'] // 100 * 100)
+    for code in [200, 300, 400, 500]:
+        throughput['HTTP {0}'.format(code)] = http_codes[code] if code in http_codes else 0
+
+    throughput.index.name = 'Date Time (Local Time)'
+    throughput = throughput.reset_index()
+    local_time = throughput['Date Time (Local Time)']
+    throughput.insert(1, 'Epoch Time', epoch_ms(local_time))
+    for position, part in enumerate(['Year', 'Month', 'Day', 'Hour', 'Minute'], start=2):
+        throughput.insert(position, part, getattr(local_time.dt, part.lower()))
+    return throughput
+
+
+def build_stats(requests, keys):
+    elapsed = requests.groupby(keys, observed=True)['Elapsed Time (>= 0 sec)']
+    stats = elapsed.agg(['count', 'mean', 'min', 'max', 'std', 'sum'])
+    stats.columns = ['Count', 'Avg', 'Min', 'Max', 'Stdev', 'Sum']
+    for quantile in [25, 50, 75, 95, 99]:
+        stats['P{0}'.format(quantile)] = elapsed.quantile(quantile / 100)
+    stats['Count Pct'] = stats['Count'] / stats['Count'].sum() * 100
+    stats['Sum Pct'] = stats['Sum'] / stats['Sum'].sum() * 100
+    stats = stats[STATS_COLUMNS].reset_index()
+    # The keys of a chunked read are categories, the sheet has them as text either way
+    return stats.astype({key: stats[key].cat.categories.dtype for key in keys
+                         if isinstance(stats[key].dtype, pd.CategoricalDtype)})
+
+
+def read_server_logs(log_dir, window_minutes=1440, end_time=None, workers=None, chunk_rows=0, spill_dir=None):
+    # Same output as read_sys_log_report: throughput, stats_by_user, stats_by_resource and all_requests.
+    # Log files are parsed into frames in up to workers processes (one per CPU by default), which are merged before
+    # the stats are built. With chunk_rows and a spill_dir the requests are written to Parquet files there instead
+    # of being merged, and all_requests is an iterator over them in frames of up to chunk_rows rows, each in time
+    # order; only the stats columns of every request are held at once.
+    end_time = end_time or datetime.now()
+    start_time = end_time - timedelta(minutes=window_minutes)
+    workers = workers or os.cpu_count() or 1
+
+    log_files = list(list_log_files(log_dir, start_time.timestamp()))
+    if chunk_rows and spill_dir:
+        # A rerun starts over, Parquet files left by an earlier one would be read back with the new ones
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        os.makedirs(spill_dir)
+        frames = read_log_files(log_files, start_time, end_time, workers, chunk_rows, spill_dir)
+        requests = build_stats_source(frames, start_time, end_time)
+        del frames
+        all_requests = read_spilled_requests(spill_dir, chunk_rows)
+    else:
+        requests = all_requests = build_all_requests(read_log_files(log_files, start_time, end_time, workers),
+                                                     start_time, end_time)
+
+    by_resource = requests[['Resource', 'ArcGIS Method', 'Elapsed Time (>= 0 sec)']].rename(
+        columns={'ArcGIS Method': 'Method'})
+    by_resource.insert(1, 'Capability', by_resource['Resource'].str.rsplit('.', n=1).str[-1])
+
+    return {'throughput': build_throughput(requests),
+            'stats_by_user': build_stats(requests, ['Resource', 'User']),
+            'stats_by_resource': build_stats(by_resource, ['Resource', 'Capability', 'Method']),
+            'all_requests': all_requests}
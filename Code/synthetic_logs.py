@@ -0,0 +1,125 @@
+import os
+from datetime import datetime, timedelta
+from os import path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from server_log_reader import build_stats, build_throughput, epoch_ms
+
+# Synthetic request data for benchmark.py: System Log Parser-shaped Parquet exports (read by read_sys_log_report)
+# and ArcGIS Server XML log files (read by read_server_logs), both spread over the last 24 hours.
+
+SERVICE_TYPES = ['MapServer', 'FeatureServer', 'GPServer', 'ImageServer']
+METHODS = {'MapServer': 'MapServer.exportImage', 'FeatureServer': 'FeatureServer.query',
+           'GPServer': 'GPServer.execute', 'ImageServer': 'ImageServer.exportImage'}
+
+# Rows generated (and written) at a time, so 50M row exports don't need 50M rows in memory
+CHUNK_ROWS = 1000000
+
+# Rows the throughput and stats sheets are computed from
+STATS_SAMPLE_ROWS = 1000000
+
+
+def resource_names(resources):
+    return ['Folder{0}/Service{1}.{2}'.format(n % 20, n, SERVICE_TYPES[n % len(SERVICE_TYPES)])
+            for n in range(resources)]
+
+
+def request_chunk(rng, rows, resources, users, end_time):
+    local_time = pd.Series(pd.to_datetime(end_time) - pd.to_timedelta(rng.integers(0, 86400000, rows), unit='ms'))
+    local_time = local_time.sort_values(ignore_index=True)
+    resource = pd.Categorical.from_codes(rng.integers(0, len(resources), rows), resources)
+    elapsed = np.round(rng.lognormal(-2, 1, rows), 3)
+    chunk = pd.DataFrame({'Date Time (Local Time)': local_time,
+                          'Epoch Time': epoch_ms(local_time),
+                          'Date Time (Day)': local_time.dt.floor('D'),
+                          'Date Time (Hour)': local_time.dt.floor('60min'),
+                          'Date Time (Minute)': local_time.dt.floor('min'),
+                          'User': pd.Categorical.from_codes(rng.integers(0, len(users), rows), users),
+                          'Server Machine': pd.Categorical.from_codes(rng.integers(0, 8, rows),
+                                                                      ['GIS{0}'.format(n) for n in range(8)]),
+                          'Content Length (Bytes)': rng.integers(0, 5000000, rows),
+                          'HTTP Code': rng.choice([200, 304, 400, 500], rows, p=[0.95, 0.02, 0.02, 0.01]),
+                          'Elapsed Time (>= 0 sec)': elapsed,
+                          'Elapsed Time (Floor)': elapsed.astype(int),
+                          'Resource': resource})
+    chunk['ArcGIS Method'] = pd.Series(resource).str.rsplit('.', n=1).str[-1].map(METHODS)
+    chunk['ArcGIS Code'] = 100004
+    chunk['ArcGIS Type'] = 'FINE'
+    return chunk
+
+
+def write_sys_log_report(report_dir, rows, resources=500, users=2000, seed=1, end_time=None):
+    # all_requests.parquet plus throughput / stats_by_user / stats_by_resource computed from the first
+    # STATS_SAMPLE_ROWS rows; returns the resource names so matching items can be generated
+    os.makedirs(report_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    end_time = end_time or datetime.now()
+    resources = resource_names(resources)
+    user_names = ['-'] + ['user{0:06d}'.format(n) for n in range(users)]
+
+    writer = None
+    sample = []
+    try:
+        for start in range(0, rows, CHUNK_ROWS):
+            chunk = request_chunk(rng, min(CHUNK_ROWS, rows - start), resources, user_names, end_time)
+            if start < STATS_SAMPLE_ROWS:
+                sample.append(chunk)
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path.join(report_dir, 'all_requests.parquet'), table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    sample = pd.concat(sample, ignore_index=True).astype({'Resource': str, 'User': str})
+    by_resource = sample[['Resource', 'ArcGIS Method', 'Elapsed Time (>= 0 sec)']].rename(
+        columns={'ArcGIS Method': 'Method'})
+    by_resource.insert(1, 'Capability', by_resource['Resource'].str.rsplit('.', n=1).str[-1])
+    build_throughput(sample).to_parquet(path.join(report_dir, 'throughput.parquet'), index=False)
+    build_stats(sample, ['Resource', 'User']).to_parquet(path.join(report_dir, 'stats_by_user.parquet'), index=False)
+    build_stats(by_resource, ['Resource', 'Capability', 'Method']).to_parquet(
+        path.join(report_dir, 'stats_by_resource.parquet'), index=False)
+    return resources
+
+
+def write_items_csv(csv_dir, resources, seed=1):
+    # items.csv with a Map / Feature Service item for most of the map and feature services in the requests
+    rng = np.random.default_rng(seed)
+    os.makedirs(csv_dir, exist_ok=True)
+    services = [name.rsplit('/', 1)[-1].rsplit('.', 1) for name in resources]
+    items = pd.DataFrame([{'TITLE': title, 'OWNER': 'user000000', 'ID': '{0:032x}'.format(n),
+                           'TYPE': 'Map Service' if service_type == 'MapServer' else 'Feature Service'}
+                          for n, (title, service_type) in enumerate(services)
+                          if service_type in ('MapServer', 'FeatureServer') and rng.random() < 0.9])
+    items.to_csv(path.join(csv_dir, 'items.csv'), index=False)
+
+
+def write_server_logs(log_dir, rows, machines=8, files_per_machine=24, resources=500, users=2000, seed=1,
+                      end_time=None):
+    # <log_dir>/<machine>/services/server-<n>.log files in the ArcGIS Server XML log format
+    rng = np.random.default_rng(seed)
+    end_time = end_time or datetime.now()
+    resources = resource_names(resources)
+    files = machines * files_per_machine
+    for n in range(files):
+        machine = 'GIS{0}'.format(n % machines)
+        machine_dir = path.join(log_dir, machine, 'services')
+        os.makedirs(machine_dir, exist_ok=True)
+        file_rows = rows // files + (n < rows % files)
+        offsets = np.sort(rng.integers(0, 86400000, file_rows))[::-1]
+        with open(path.join(machine_dir, 'server-{0:04d}.log'.format(n)), 'w', encoding='utf-8') as f:
+            for offset, resource, user, elapsed, size in zip(offsets, rng.integers(0, len(resources), file_rows),
+                                                              rng.integers(0, users, file_rows),
+                                                              rng.lognormal(-2, 1, file_rows),
+                                                              rng.integers(0, 5000000, file_rows)):
+                target = resources[resource].rsplit('/', 1)[-1]
+                log_time = (end_time - timedelta(milliseconds=int(offset))).strftime('%Y-%m-%dT%H:%M:%S,%f')[:-3]
+                f.write('<Msg time="{0}" type="FINE" code="100004" target="{1}" methodName="{2}" machine="{3}" '
+                        'process="1234" thread="1" user="user{4:06d}" elapsed="{5:.3f}">Response size is {6} '
+                        'bytes</Msg>\n'.format(log_time, target, METHODS[target.rsplit('.', 1)[-1]], machine, user,
+                                               elapsed, size))
@@ -0,0 +1,248 @@
+import hashlib
+import importlib.util
+import random
+import re
+import sys
+import time
+import types
+
+# In-memory stand-in for an arcgis GIS, used by benchmark.py. It generates users, groups, items and folders
+# and answers the calls portal_audit_tools makes, sleeping `latency` seconds wherever the real API would
+# make a REST request.
+
+ITEM_TYPES = ['Map Service', 'Feature Service', 'Web Map', 'Web Mapping Application', 'PDF', 'CSV',
+              'Geoprocessing Service', 'Vector Tile Service']
+ROLES = [('org_admin', 'Administrator'), ('org_publisher', 'Publisher'), ('org_user', 'User'),
+         ('viewer', 'Viewer')]
+TITLE_13_LICENSE = ('This report contains information, the release of which is protected by Title 13, United States '
+                    'Code (U.S.C.) and is for Bureau of the Census official use only. Moreover, Census Bureau policy '
+                    'DS 018 prohibits the browsing of files in which individuals or businesses may be directly or '
+                    'indirectly identified, except for work-related purposes.')
+
+CREATED_RANGE = re.compile(r'created:\[(\d+) TO')
+
+
+class FakeItem:
+
+    def __init__(self, gis, itemid, itemdict=None):
+        self._gis = gis
+        self.__dict__.update(itemdict if itemdict is not None else gis.item_records[itemid])
+
+    @property
+    def homepage(self):
+        return '{0}/home/item.html?id={1}'.format(self._gis.url, self.id)
+
+    @property
+    def content_status(self):
+        return self.__dict__.get('contentStatus') or None
+
+    def get_thumbnail(self):
+        self._gis.pause()
+        return hashlib.sha256(self.thumbnail.encode()).digest() * 64 if self.thumbnail else None
+
+
+class FakeUser:
+
+    def __init__(self, gis, username, userdict=None):
+        self._gis = gis
+        self.__dict__.update(userdict if userdict is not None else gis.user_records[username])
+
+    @property
+    def groups(self):
+        self._gis.pause()
+        return [self._gis.group_objects[group_id] for group_id in self._gis.memberships[self.username]]
+
+    @property
+    def folders(self):
+        self._gis.pause()
+        return [{'title': folder} for folder in self._gis.folders[self.username]]
+
+    def items(self, folder=None, max_items=100):
+        self._gis.pause()
+        return [FakeItem(self._gis, record['id'], record) for record in self._gis.owned[self.username]
+                if record['folder'] == folder][:max_items]
+
+
+class FakeGroup:
+
+    def __init__(self, gis, record):
+        self._gis = gis
+        self.__dict__.update(record)
+        self.groupid = record['id']
+
+    def get_members(self):
+        self._gis.pause()
+        return {'owner': self.owner, 'admins': [self.owner], 'users': list(self._gis.members[self.groupid])}
+
+    def content(self, max_items=1000):
+        self._gis.pause()
+        return [FakeItem(self._gis, record['id'], record) for record in self._gis.group_items[self.groupid]][:max_items]
+
+
+class FakeRole:
+
+    def __init__(self, role_id, name):
+        self.role_id = role_id
+        self.name = name
+
+
+class FakeConnection:
+    # The REST calls made through portal._con by portal_audit_tools
+
+    def __init__(self, gis):
+        self.gis = gis
+        self.token = 'synthetic'
+
+    def get(self, url, params=None):
+        self.gis.pause()
+        params = params or {}
+        endpoint = url.split('/sharing/rest/', 1)[-1]
+        if endpoint == 'search':
+            return self.gis.search(params.get('q', ''), int(params.get('start', 1)), int(params.get('num', 10)))
+        if endpoint.startswith('content/items/') and endpoint.endswith('/groups'):
+            item_id = endpoint.split('/')[2]
+            return {'admin': [], 'other': [],
+                    'member': [{'id': group_id, 'title': self.gis.group_records[group_id]['title']}
+                               for group_id in self.gis.item_groups.get(item_id, [])]}
+        raise NotImplementedError(endpoint)
+
+    def post(self, url, params=None):
+        raise NotImplementedError(url)
+
+
+class FakeUserManager:
+
+    def __init__(self, gis):
+        self.gis = gis
+        self.roles = types.SimpleNamespace(all=lambda: [FakeRole(*role) for role in ROLES])
+
+    def search(self, query='', max_users=None):
+        self.gis.pause()
+        return [FakeUser(self.gis, username, record) for username, record in self.gis.user_records.items()]
+
+    def get(self, username):
+        self.gis.pause()
+        return FakeUser(self.gis, username) if username in self.gis.user_records else None
+
+
+class FakeGroupManager:
+
+    def __init__(self, gis):
+        self.gis = gis
+
+    def search(self, query='', max_groups=None):
+        self.gis.pause()
+        return list(self.gis.group_objects.values())
+
+    def get(self, group_id):
+        self.gis.pause()
+        return self.gis.group_objects.get(group_id)
+
+
+class FakeContentManager:
+
+    def __init__(self, gis):
+        self.gis = gis
+
+    def get(self, item_id):
+        self.gis.pause()
+        return FakeItem(self.gis, item_id) if item_id in self.gis.item_records else None
+
+
+class FakeGIS:
+
+    def __init__(self, url='https://portal.example.com/portal', username=None, password=None, verify_cert=True,
+                 users=100, groups=20, items=1000, folders_per_user=2, groups_per_user=3, latency=0.0,
+                 title_13_share=0.05, seed=1):
+        rng = random.Random(seed)
+        self.url = url
+        self.latency = latency
+        self._portal = types.SimpleNamespace(resturl=url + '/sharing/rest/')
+        self._con = FakeConnection(self)
+        self.users = FakeUserManager(self)
+        self.groups = FakeGroupManager(self)
+        self.content = FakeContentManager(self)
+        now = int(time.time() * 1000)
+
+        usernames = ['user{0:06d}'.format(n) for n in range(users)]
+        self.user_records = {username: {'username': username, 'email': '{0}@example.com'.format(username),
+                                        'roleId': rng.choice(ROLES)[0], 'role': 'org_user',
+                                        'lastLogin': now - rng.randint(0, 90) * 86400000,
+                                        'created': now - rng.randint(90, 2000) * 86400000,
+                                        'modified': now - rng.randint(0, 90) * 86400000}
+                             for username in usernames}
+        self.folders = {username: ['folder{0}'.format(n) for n in range(folders_per_user)] for username in usernames}
+
+        self.group_records = {}
+        for n in range(groups):
+            group_id = '{0:032x}'.format(rng.getrandbits(128))
+            self.group_records[group_id] = {'id': group_id, 'title': 'Group {0}'.format(n),
+                                            'owner': rng.choice(usernames),
+                                            'modified': now - rng.randint(0, 90) * 86400000}
+        self.group_objects = {group_id: FakeGroup(self, record) for group_id, record in self.group_records.items()}
+        group_ids = list(self.group_records)
+
+        self.memberships = {username: rng.sample(group_ids, min(groups_per_user, len(group_ids)))
+                            for username in usernames}
+        self.members = {group_id: [] for group_id in group_ids}
+        for username, member_of in self.memberships.items():
+            for group_id in member_of:
+                self.members[group_id].append(username)
+
+        self.item_records = {}
+        self.owned = {username: [] for username in usernames}
+        self.item_groups = {}
+        self.group_items = {group_id: [] for group_id in group_ids}
+        for n in range(items):
+            item_id = '{0:032x}'.format(rng.getrandbits(128))
+            owner = rng.choice(usernames)
+            titled = rng.random() < title_13_share
+            record = {'id': item_id, 'title': 'Title 13 Service {0}'.format(n) if titled else 'Service {0}'.format(n),
+                      'owner': owner, 'type': rng.choice(ITEM_TYPES), 'tags': ['title 13'] if titled else ['demo'],
+                      'description': 'Synthetic item {0} '.format(n) * rng.randint(0, 4) or None,
+                      'licenseInfo': TITLE_13_LICENSE if rng.random() < 0.8 else None,
+                      'numViews': rng.randint(0, 10000), 'created': now - (items - n) * 60000,
+                      'modified': now - rng.randint(0, 90) * 86400000,
+                      'access': rng.choice(['private', 'shared', 'org', 'public']), 'size': rng.randint(0, 10 ** 8),
+                      'thumbnail': 'thumbnail/{0}.png'.format(rng.choice(['title13', 'logo', 'map'])),
+                      'folder': rng.choice([None] + self.folders[owner])}
+            self.item_records[item_id] = record
+            self.owned[owner].append(record)
+            shared_to = rng.sample(group_ids, min(rng.randint(0, 3), len(group_ids)))
+            self.item_groups[item_id] = shared_to
+            for group_id in shared_to:
+                self.group_items[group_id].append(record)
+        self.items_by_created = sorted(self.item_records.values(), key=lambda record: record['created'])
+
+    def pause(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def search(self, query, start, num):
+        # /sharing/rest/search: group:<id> counts, 'title 13' matches titled items, anything else every item
+        if query.startswith('group:'):
+            results = self.group_items.get(query[len('group:'):], [])
+        else:
+            results = self.items_by_created
+            if 'title 13' in query:
+                results = [record for record in results if 'title 13' in record['tags']]
+            created = CREATED_RANGE.search(query)
+            if created:
+                results = [record for record in results if record['created'] >= int(created.group(1))]
+        page = results[start - 1:start - 1 + num]
+        next_start = start + len(page) if num and start - 1 + num < len(results) else -1
+        return {'total': len(results), 'start': start, 'num': num, 'nextStart': next_start, 'results': page}
+
+
+def install_stand_ins():
+    # Lets portal_audit_tools import on a machine without the ArcGIS API for Python (or keyring)
+    if importlib.util.find_spec('arcgis') is None:
+        gis_module = types.ModuleType('arcgis.gis')
+        gis_module.GIS, gis_module.Item, gis_module.User, gis_module.Group = FakeGIS, FakeItem, FakeUser, FakeGroup
+        sys.modules['arcgis'] = types.ModuleType('arcgis')
+        sys.modules['arcgis'].gis = gis_module
+        sys.modules['arcgis.gis'] = gis_module
+    if importlib.util.find_spec('keyring') is None:
+        keyring_module = types.ModuleType('keyring')
+        keyring_module.get_password = lambda service, username: None
+        sys.modules['keyring'] = keyring_module
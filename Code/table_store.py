@@ -0,0 +1,263 @@
+import logging
+import sqlite3
+from contextlib import closing
+from os import path
+
+import pandas as pd
+
+# Table stores write pandas frames straight into the audit tables. ArcpyTableStore targets the file geodatabase,
+# SqliteTableStore a SQLite database or GeoPackage so the pipeline can run without ArcPy.
+# Every frame is matched to its table's fields before the first table is touched, then converted and inserted
+# INSERT_BATCH rows at a time, so a table's Python rows never have to fit in memory at once. A table may also be
+# given as an iterable of frames (e.g. all_requests read in chunks), which is loaded one chunk at a time.
+
+# ArcPy field type -> how frame values are converted for an insert cursor
+ARCPY_FIELD_KINDS = {'Date': 'date', 'DateOnly': 'date', 'TimestampOffset': 'date',
+                     'SmallInteger': 'int', 'Integer': 'int', 'BigInteger': 'int',
+                     'Single': 'float', 'Double': 'float'}
+
+# Frame dtype kind -> declared type of a SQLite column, named like GeoPackage attribute table columns
+SQLITE_COLUMN_TYPES = {'b': 'BOOLEAN', 'i': 'INTEGER', 'u': 'INTEGER', 'f': 'DOUBLE', 'M': 'DATETIME'}
+
+# Milliseconds are left after the microseconds are trimmed
+GPKG_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# The tables every GeoPackage has (OGC 12-128r18, with its required spatial reference systems)
+GPKG_SCHEMA = """
+PRAGMA application_id = 1196444487;
+PRAGMA user_version = 10400;
+CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL,
+    organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+INSERT INTO gpkg_spatial_ref_sys VALUES
+    ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+    ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system'),
+    ('WGS 84 geodetic', 4326, 'EPSG', 4326, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,'
+     || '298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG",'
+     || '"8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]',
+     'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid');
+CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+    description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+    min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL,
+    geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+    CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name), CONSTRAINT uk_gc_table_name UNIQUE (table_name),
+    CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+    CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id));
+"""
+
+# Rows converted per insert cursor batch in ArcPy and written per INSERT statement batch in SQLite
+INSERT_BATCH = 5000
+
+
+def column_values(column, kind):
+    # One Python value per row, with None wherever pandas has a missing value
+    if isinstance(column.dtype, pd.PeriodDtype):
+        column = column.dt.to_timestamp()
+    if kind == 'date':
+        values = pd.to_datetime(column, errors='coerce').astype(object)
+    elif kind == 'int':
+        values = pd.to_numeric(column, errors='coerce').round().astype('Int64').astype(object)
+    elif kind == 'float':
+        values = pd.to_numeric(column, errors='coerce').astype(object)
+    else:
+        values = column.astype(str).astype(object)
+    return values.where(column.notna() & values.notna(), None).tolist()
+
+
+class ArcpyTableStore:
+    # Loads frames into the tables of a file geodatabase through arcpy.da insert cursors
+
+    def __init__(self, workspace):
+        import arcpy
+        self.arcpy = arcpy
+        self.workspace = workspace
+
+    def table(self, name):
+        return path.join(self.workspace, name)
+
+    def ensure_table(self, name, frame):
+        # Tables that aren't in the geodatabase yet (e.g. the rollups) get a field per frame column:
+        # dates, doubles for every number so large sums fit, text for the rest
+        if self.arcpy.Exists(self.table(name)):
+            return
+        self.arcpy.management.CreateTable(self.workspace, name)
+        for column in frame.columns:
+            kind = frame[column].dtype.kind
+            field_type = 'DATE' if kind == 'M' else 'DOUBLE' if kind in 'iuf' else 'TEXT'
+            self.arcpy.management.AddField(self.table(name), column, field_type, field_length=255)
+        logging.info('Created table {0}'.format(self.table(name)))
+
+    def prepare(self, name, frame):
+        # Frame columns are matched to the table's editable fields by name, the rest are ignored like Append NO_TEST.
+        # Returns the field names and the frame's rows for them, converted lazily a batch at a time.
+        columns = {column.lower(): column for column in frame.columns}
+        fields = [field for field in self.arcpy.ListFields(self.table(name))
+                  if field.editable and field.type not in ('OID', 'Geometry', 'GlobalID')
+                  and field.name.lower() in columns]
+        kinds = [(columns[field.name.lower()], ARCPY_FIELD_KINDS.get(field.type, 'text')) for field in fields]
+        return [field.name for field in fields], self.rows(frame, kinds)
+
+    @staticmethod
+    def rows(frame, kinds):
+        for start in range(0, len(frame), INSERT_BATCH):
+            batch = frame.iloc[start:start + INSERT_BATCH]
+            yield from zip(*[column_values(batch[column], kind) for column, kind in kinds])
+
+    def insert(self, name, fields, rows):
+        inserted = 0
+        with self.arcpy.da.InsertCursor(self.table(name), fields) as cursor:
+            for row in rows:
+                cursor.insertRow(row)
+                inserted += 1
+        return inserted
+
+    def replace_all(self, frames):
+        chunked = {name: frame for name, frame in frames.items() if not isinstance(frame, pd.DataFrame)}
+        for name, frame in frames.items():
+            if name not in chunked:
+                self.ensure_table(name, frame)
+        loads = {name: self.prepare(name, frame) for name, frame in frames.items() if name not in chunked}
+        for name, (fields, rows) in loads.items():
+            self.arcpy.management.TruncateTable(self.table(name))
+            logging.info('Loaded {0} rows into {1}'.format(self.insert(name, fields, rows), name))
+        for name, chunks in chunked.items():
+            if self.arcpy.Exists(self.table(name)):
+                self.arcpy.management.TruncateTable(self.table(name))
+            loaded = 0
+            for chunk in chunks:
+                self.ensure_table(name, chunk)
+                fields, rows = self.prepare(name, chunk)
+                loaded += self.insert(name, fields, rows)
+            logging.info('Loaded {0} rows into {1}'.format(loaded, name))
+
+    def ensure_key(self, name, key):
+        # The key field upsert matches on, added before the full load so every row gets its key
+        table = self.table(name)
+        if self.arcpy.Exists(table) and key not in [f.name for f in self.arcpy.ListFields(table)]:
+            self.arcpy.management.AddField(table, key, 'TEXT', field_length=64)
+            logging.info('Added key field {0} to {1}'.format(key, table))
+
+    def upsert(self, name, frame, key, stale_keys):
+        # Replace the rows whose key changed or disappeared, leaving the rest of the table alone
+        table = self.table(name)
+        self.ensure_key(name, key)
+
+        fields, rows = self.prepare(name, frame)
+        deleted = 0
+        with self.arcpy.da.UpdateCursor(table, [key]) as cursor:
+            for row in cursor:
+                if row[0] in stale_keys:
+                    cursor.deleteRow()
+                    deleted += 1
+        if len(frame):
+            self.insert(name, fields, rows)
+        logging.info('Upserted {0}: removed {1} stale rows'.format(table, deleted))
+
+    def compact(self):
+        self.arcpy.Compact_management(self.workspace)
+
+
+class SqliteTableStore:
+    # Loads frames into a SQLite database or GeoPackage, creating tables from the frames when they don't exist yet.
+    # In a GeoPackage the tables are attribute tables: they get an integer primary key and are registered in
+    # gpkg_contents, so GIS clients list them.
+
+    def __init__(self, database):
+        self.database = database
+        self.geopackage = path.splitext(database)[1].lower() == '.gpkg'
+
+    def connect(self):
+        # Use as `with closing(self.connect()) as connection, connection:`, the connection commits and is closed
+        connection = sqlite3.connect(self.database)
+        if self.geopackage and not self.has_table(connection, 'gpkg_contents'):
+            with connection:
+                connection.executescript(GPKG_SCHEMA)
+        return connection
+
+    def prepare(self, frame):
+        frame = frame.copy()
+        for column in frame.columns:
+            if isinstance(frame[column].dtype, (pd.PeriodDtype, pd.CategoricalDtype)):
+                frame[column] = frame[column].astype(str).where(frame[column].notna(), None)
+            elif self.geopackage and frame[column].dtype.kind == 'M':
+                # GeoPackage DATETIME values are ISO 8601 text
+                frame[column] = frame[column].dt.strftime(GPKG_DATETIME_FORMAT).str[:-3]
+        return frame
+
+    @staticmethod
+    def has_table(connection, name):
+        return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                  (name,)).fetchone() is not None
+
+    @staticmethod
+    def column_type(frame, column):
+        if isinstance(frame[column].dtype, (pd.PeriodDtype, pd.CategoricalDtype)):
+            return 'TEXT'
+        return SQLITE_COLUMN_TYPES.get(frame[column].dtype.kind, 'TEXT')
+
+    def add_columns(self, connection, name, frame):
+        # Columns added to a CSV since its table was created (e.g. new items.csv fields)
+        existing = {row[1] for row in connection.execute('PRAGMA table_info("{0}")'.format(name))}
+        for column in frame.columns:
+            if column not in existing:
+                connection.execute('ALTER TABLE "{0}" ADD COLUMN "{1}" {2}'.format(name, column,
+                                                                                  self.column_type(frame, column)))
+
+    def ensure_table(self, connection, name, frame):
+        # Creates the table from the frame's columns, or adds the ones it doesn't have yet. Tables written to a
+        # GeoPackage before they were registered are registered now.
+        if self.has_table(connection, name):
+            self.add_columns(connection, name, frame)
+        elif self.geopackage:
+            columns = ''.join(', "{0}" {1}'.format(column, self.column_type(frame, column)) for column in frame.columns)
+            connection.execute('CREATE TABLE "{0}" ("fid" INTEGER PRIMARY KEY AUTOINCREMENT{1})'.format(name, columns))
+            logging.info('Created table {0}'.format(name))
+        else:
+            frame.head(0).to_sql(name, connection, index=False)
+            logging.info('Created table {0}'.format(name))
+        if self.geopackage:
+            connection.execute("INSERT OR IGNORE INTO gpkg_contents (table_name, data_type, identifier) "
+                               "VALUES (?, 'attributes', ?)", (name, name))
+            connection.execute("UPDATE gpkg_contents SET last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') "
+                               "WHERE table_name = ?", (name,))
+
+    def ensure_key(self, name, key):
+        with closing(self.connect()) as connection, connection:
+            if self.has_table(connection, name):
+                self.add_columns(connection, name, pd.DataFrame(columns=[key]))
+
+    def insert(self, connection, name, frame):
+        self.ensure_table(connection, name, frame)
+        if len(frame):
+            self.prepare(frame).to_sql(name, connection, if_exists='append', index=False, chunksize=INSERT_BATCH)
+        return len(frame)
+
+    def replace_all(self, frames):
+        with closing(self.connect()) as connection, connection:
+            for name, frame in frames.items():
+                if self.has_table(connection, name):
+                    connection.execute('DELETE FROM "{0}"'.format(name))
+                chunks = [frame] if isinstance(frame, pd.DataFrame) else frame
+                loaded = sum(self.insert(connection, name, chunk) for chunk in chunks)
+                logging.info('Loaded {0} rows into {1}'.format(loaded, name))
+
+    def upsert(self, name, frame, key, stale_keys):
+        with closing(self.connect()) as connection, connection:
+            deleted = 0
+            if self.has_table(connection, name):
+                deleted = connection.executemany('DELETE FROM "{0}" WHERE "{1}" = ?'.format(name, key),
+                                                 [(stale_key,) for stale_key in stale_keys]).rowcount
+            self.insert(connection, name, frame)
+        logging.info('Upserted {0}: removed {1} stale rows'.format(name, deleted))
+
+    def compact(self):
+        with closing(self.connect()) as connection:
+            connection.execute('VACUUM')
+
+
+def open_table_store(target):
+    # .gpkg / .sqlite / .db targets are written with sqlite3, anything else is treated as a file geodatabase
+    if path.splitext(target)[1].lower() in ('.gpkg', '.sqlite', '.db'):
+        return SqliteTableStore(target)
+    return ArcpyTableStore(target)
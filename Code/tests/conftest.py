@@ -0,0 +1,7 @@
+import sys
+from os import path
+
+# The audit tools are plain modules in Code/, imported the same way portal_audit_tools imports them
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+DATA_DIR = path.join(path.dirname(path.abspath(__file__)), 'data')
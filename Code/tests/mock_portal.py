@@ -0,0 +1,136 @@
+import asyncio
+import json
+import re
+import threading
+from os import path
+
+from aiohttp import web
+
+from conftest import DATA_DIR
+
+# A local stand-in for the portal sharing REST API, serving the responses recorded in tests/data/portal. Searches page
+# like the portal does: start/num/nextStart, sorted on sortField, refused past SEARCH_WINDOW results, and narrowed
+# by a created:[from TO to] term in q (the rest of q is ignored). Queued failures, (status, headers) pairs, answer the
+# next requests before any of them is served.
+
+SEARCH_WINDOW = 10000
+
+CREATED_RANGE = re.compile(r'created:\[(\d+) TO (\d+)\]')
+
+
+def load_fixture(name):
+    with open(path.join(DATA_DIR, 'portal', '{0}.json'.format(name))) as f:
+        return json.load(f)
+
+
+class MockPortal:
+
+    def __init__(self, users=None, groups=None, items=None):
+        self.users = users if users is not None else load_fixture('users')
+        self.groups = groups if groups is not None else load_fixture('groups')
+        self.items = items if items is not None else load_fixture('items')
+        self.user_groups = load_fixture('user_groups')
+        self.group_users = load_fixture('group_users')
+        self.item_groups = load_fixture('item_groups')
+        self.requests = []
+        self.failures = []
+        self.url = None
+        self.loop = None
+        self.runner = None
+        self.thread = None
+
+    def search(self, records, request):
+        self.requests.append(dict(request.query))
+        query = request.query
+        start, num = int(query.get('start', 1)), int(query.get('num', 10))
+        if start + num - 1 > SEARCH_WINDOW:
+            return web.json_response({'error': {'code': 400, 'message': 'start + num exceeds the search window',
+                                                'details': []}})
+        created = CREATED_RANGE.search(query.get('q', ''))
+        if created:
+            low, high = int(created.group(1)), int(created.group(2))
+            records = [record for record in records if low <= record['created'] <= high]
+        if 'sortField' in query:
+            records = sorted(records, key=lambda record: record[query['sortField']],
+                             reverse=query.get('sortOrder') == 'desc')
+        page = records[start - 1:start - 1 + num]
+        next_start = start + len(page) if start - 1 + num < len(records) else -1
+        return web.json_response({'total': len(records), 'start': start, 'num': num, 'nextStart': next_start,
+                                  'results': page})
+
+    async def users_search(self, request):
+        return self.search(self.users, request)
+
+    async def groups_search(self, request):
+        return self.search(self.groups, request)
+
+    async def items_search(self, request):
+        group = re.fullmatch(r'group:(\w+)', request.query.get('q', ''))
+        if group:
+            shared = [item for item in self.items
+                      if any(g['id'] == group.group(1) for groups in self.item_groups.get(item['id'], {}).values()
+                             for g in groups)]
+            return self.search(shared, request)
+        return self.search(self.items, request)
+
+    async def user(self, request):
+        username = request.match_info['username']
+        user = next((u for u in self.users if u['username'] == username), None)
+        if user is None:
+            return web.json_response({'error': {'code': 400, 'message': 'User does not exist', 'details': []}})
+        return web.json_response(dict(user, groups=self.user_groups.get(username, [])))
+
+    async def group_members(self, request):
+        return web.json_response(self.group_users.get(request.match_info['group_id'],
+                                                      {'owner': None, 'admins': [], 'users': []}))
+
+    async def item_sharing(self, request):
+        return web.json_response(self.item_groups.get(request.match_info['item_id'],
+                                                      {'admin': [], 'member': [], 'other': []}))
+
+    @web.middleware
+    async def fail(self, request, handler):
+        if self.failures:
+            status, headers = self.failures.pop(0)
+            return web.Response(status=status, headers=headers, text='Try again later')
+        return await handler(request)
+
+    def app(self):
+        app = web.Application(middlewares=[self.fail])
+        app.add_routes([web.get('/sharing/rest/community/users', self.users_search),
+                        web.get('/sharing/rest/community/users/{username}', self.user),
+                        web.get('/sharing/rest/community/groups', self.groups_search),
+                        web.get('/sharing/rest/community/groups/{group_id}/users', self.group_members),
+                        web.get('/sharing/rest/search', self.items_search),
+                        web.get('/sharing/rest/content/items/{item_id}/groups', self.item_sharing)])
+        return app
+
+    def start(self):
+        # Served from its own event loop on a background thread, so the harvester can run its own asyncio.run
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        async def serve():
+            self.runner = web.AppRunner(self.app())
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, '127.0.0.1', 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self.url = 'http://127.0.0.1:{0}/sharing/rest/'.format(port)
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(serve())
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
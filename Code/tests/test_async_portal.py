@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+import async_portal
+from async_portal import SEARCH_WINDOW, AsyncPortalClient, harvest_portal
+from mock_portal import MockPortal, load_fixture
+
+
+@pytest.fixture
+def portal():
+    mock = MockPortal().start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def large_portal():
+    # More users and groups than one search window, three to each created time so a window can end mid-timestamp
+    user, group = load_fixture('users')[0], load_fixture('groups')[0]
+    count = SEARCH_WINDOW + 250
+    mock = MockPortal(users=[dict(user, username='user{0:05d}'.format(n), created=1546300800000 + n // 3)
+                             for n in range(count)],
+                      groups=[dict(group, id='group{0:05d}'.format(n), title='Group {0}'.format(n),
+                                   created=1546300800000 + n // 3) for n in range(count)]).start()
+    yield mock
+    mock.stop()
+
+
+def pages(mock, *args, **params):
+    async def run():
+        async with AsyncPortalClient(mock.url, requests_per_second=0) as client:
+            return await client.pages(*args, **params)
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    # The backoff sleeps, taken without waiting; the jitter factor is fixed at 1
+    slept = []
+    sleep = asyncio.sleep
+
+    async def record(delay, *args, **kwargs):
+        slept.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(async_portal.asyncio, 'sleep', record)
+    monkeypatch.setattr(async_portal.random, 'random', lambda: 0.5)
+    return slept
+
+
+def client_get(mock, path, retries=5, **params):
+    async def run():
+        async with AsyncPortalClient(mock.url, requests_per_second=0, retries=retries) as client:
+            try:
+                return await client.get(path, **params)
+            finally:
+                counts.update(requests=client.requests, retried=client.retried)
+    counts = {}
+    return asyncio.run(run()), counts
+
+
+def test_harvest(portal):
+    harvest = harvest_portal(portal.url, None, '!USER:esri_*', '!owner:esri_*', '!owner:esri*', lambda record: False,
+                             lambda record: False, lambda record: False, requests_per_second=0)
+
+    users = {record['username']: groups for record, groups in harvest['users']}
+    assert list(users) == ['adoe', 'jsmith', 'portaladmin']
+    assert users['portaladmin'] == ['Census Tracts', 'Field Operations']
+
+    groups = {record['title']: detail for record, detail in harvest['groups']}
+    members, content = groups['Census Tracts']
+    assert members['users'] == ['portaladmin']
+    assert content == 2
+
+    items = {record['title']: groups for record, groups in harvest['items']}
+    assert items['Blocks'] == ['Census Tracts', 'Field Operations']
+    assert items['Crew Schedule'] == []
+    assert all(query['f'] == 'json' and 'token' not in query for query in portal.requests)
+
+
+def test_reused_records_are_not_looked_up(portal):
+    harvest = harvest_portal(portal.url, None, '*', '*', '*', lambda record: True, lambda record: True,
+                             lambda record: record['owner'] == 'jsmith', requests_per_second=0)
+    assert all(groups is None for record, groups in harvest['users'])
+    assert all(detail is None for record, detail in harvest['groups'])
+    assert [record['title'] for record, groups in harvest['items'] if groups is not None] == ['Crew Schedule']
+
+
+def test_in_requested_order_within_one_window(portal):
+    users = pages(portal, 'community/users', 'username', q='*', sortField='username')
+    assert [user['username'] for user in users] == ['adoe', 'jsmith', 'portaladmin']
+
+
+@pytest.mark.parametrize('endpoint, key, sort_field', [('community/users', 'username', 'username'),
+                                                        ('community/groups', 'id', 'title')])
+def test_past_search_window(large_portal, endpoint, key, sort_field):
+    results = pages(large_portal, endpoint, key, q='*', sortField=sort_field)
+    keys = [result[key] for result in results]
+    assert len(keys) == len(set(keys)) == SEARCH_WINDOW + 250
+    assert any('created:[' in query['q'] for query in large_portal.requests)
+
+
+def test_too_many_results_at_one_time(portal):
+    portal.users = [dict(portal.users[0], username='user{0:05d}'.format(n)) for n in range(SEARCH_WINDOW + 1)]
+    with pytest.raises(RuntimeError):
+        pages(portal, 'community/users', 'username', q='*', sortField='username')
+
+
+def test_retry_after_then_backoff(portal, delays):
+    portal.failures = [(429, {'Retry-After': '7'}), (503, {})]
+    body, counts = client_get(portal, 'community/users', q='*', sortField='username')
+    assert [user['username'] for user in body['results']] == ['adoe', 'jsmith', 'portaladmin']
+    # The 429 waits as long as the portal asks, the 503 on the second attempt backs off 2 ** 1 seconds
+    assert delays == [7.0, 2.0]
+    assert counts == {'requests': 3, 'retried': 2}
+    assert len(portal.requests) == 1
+
+
+def test_retries_exhausted(portal, delays):
+    portal.failures = [(429, {'Retry-After': '7'}), (503, {})]
+    with pytest.raises(RuntimeError, match='503'):
+        client_get(portal, 'community/users', retries=1, q='*')
+    assert delays == [7.0]
+    assert portal.requests == []
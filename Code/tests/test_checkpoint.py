@@ -0,0 +1,53 @@
+import csv
+
+import pytest
+
+from checkpoint import ResumableCsv, RunCheckpoint
+
+FIELDS = ['USERNAME', 'EMAIL']
+
+
+def export(csv_path, checkpoint, usernames, fail_at=None):
+    with ResumableCsv(csv_path, FIELDS, 'USERNAME', checkpoint, every=2) as users_file:
+        for username in usernames:
+            if users_file.skip(username):
+                continue
+            if username == fail_at:
+                raise RuntimeError('Connection reset')
+            users_file.advance(username, {'USERNAME': username, 'EMAIL': '{0}@example.gov'.format(username)})
+
+
+def written(csv_path):
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        return [row['USERNAME'] for row in csv.DictReader(f)]
+
+
+def test_resume_after_users_are_added(tmp_path):
+    csv_path = str(tmp_path / 'users.csv')
+    checkpoint = RunCheckpoint(str(tmp_path / 'checkpoint.json'))
+    with pytest.raises(RuntimeError):
+        export(csv_path, checkpoint, ['adoe', 'bking', 'cruiz', 'dlee', 'jsmith'], fail_at='jsmith')
+
+    # A user created before the rerun sorts into the middle of the search results
+    export(csv_path, RunCheckpoint(str(tmp_path / 'checkpoint.json')),
+           ['adoe', 'bking', 'bnew', 'cruiz', 'dlee', 'jsmith'])
+    assert sorted(written(csv_path)) == ['adoe', 'bking', 'bnew', 'cruiz', 'dlee', 'jsmith']
+
+
+def test_rows_after_the_last_cursor_are_redone(tmp_path):
+    csv_path = str(tmp_path / 'users.csv')
+    checkpoint = RunCheckpoint(str(tmp_path / 'checkpoint.json'))
+    with ResumableCsv(csv_path, FIELDS, 'USERNAME', checkpoint, every=2) as users_file:
+        for username in ['adoe', 'bking', 'cruiz']:
+            users_file.advance(username, {'USERNAME': username, 'EMAIL': ''})
+        users_file.save_cursor = lambda: None  # killed before the final cursor is saved
+
+    export(csv_path, RunCheckpoint(str(tmp_path / 'checkpoint.json')), ['adoe', 'bking', 'cruiz', 'dlee'])
+    assert written(csv_path) == ['adoe', 'bking', 'cruiz', 'dlee']
+
+
+def test_without_checkpoint(tmp_path):
+    csv_path = str(tmp_path / 'users.csv')
+    export(csv_path, None, ['adoe', 'bking'])
+    export(csv_path, None, ['adoe'])
+    assert written(csv_path) == ['adoe']
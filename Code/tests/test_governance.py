@@ -0,0 +1,95 @@
+import pandas as pd
+
+from governance import TITLE_13_LICENSE, UNVERIFIABLE, evaluate, policy_rules, title_13_rules
+
+DIGEST = 'c0ffee'
+DESCRIPTION = '2010 census tracts with the population and housing unit counts'
+
+
+def item(item_id, **fields):
+    # An items.csv row that passes every rule unless fields say otherwise
+    row = {'TITLE': item_id.title(), 'OWNER': 'jsmith', 'ID': item_id, 'TYPE': 'Web Map', 'TAGS': "'census', 'tracts'",
+           'SHARED_WITH_EVERYONE': False, 'VIEWS': 12, 'HOMEPAGE': 'https://gis.example.gov/portal/home/item.html?id='
+           + item_id, 'THUMBNAIL': 'thumbnail/{0}.png'.format(item_id), 'DESCRIPTION': DESCRIPTION, 'SIZE': 0.5,
+           'MODIFIED': '06/01/2020', 'LICENSE_INFO': TITLE_13_LICENSE}
+    row.update(fields)
+    return row
+
+
+def violations(rules, rows, digests=None):
+    digests = digests or {}
+    fetched = []
+
+    def fetch_digests(items):
+        fetched.extend(items['ID'])
+        return items['ID'].map(lambda item_id: digests.get(item_id, DIGEST))
+
+    found = evaluate(pd.DataFrame(rows), rules, {'THUMBNAIL_DIGEST': fetch_digests})
+    return sorted(zip(found['RULE'], found['ID'])), fetched
+
+
+def test_title_13_compliant():
+    assert violations(title_13_rules(DIGEST, ''), [item('tracts')]) == ([], ['tracts'])
+
+
+def test_title_13_thumbnail():
+    found, fetched = violations(title_13_rules(DIGEST, ''),
+                                [item('tracts'), item('blocks'), item('places', THUMBNAIL=None), item('roads')],
+                                {'blocks': 'bad', 'roads': None})
+    assert found == [('title_13_thumbnail', 'blocks'), ('title_13_thumbnail', 'roads')]
+    # Items without a thumbnail are out of scope, so theirs is never downloaded
+    assert fetched == ['tracts', 'blocks', 'roads']
+
+
+def test_title_13_thumbnail_unverifiable():
+    rules = title_13_rules(DIGEST, '')
+    found, fetched = violations(rules, [item('tracts'), item('blocks')], {'blocks': UNVERIFIABLE})
+    assert found == [('title_13_thumbnail_unverifiable', 'blocks')]
+    assert not next(rule for rule in rules if rule.name == 'title_13_thumbnail_unverifiable').notify
+
+
+def test_title_13_description():
+    found, fetched = violations(title_13_rules(DIGEST, ''),
+                                [item('tracts', DESCRIPTION=None), item('blocks', DESCRIPTION=' '),
+                                 item('places', DESCRIPTION='Census places')])
+    assert found == [('title_13_description', 'blocks'), ('title_13_description', 'tracts'),
+                     ('title_13_short_description', 'places')]
+
+
+def test_title_13_terms_of_use():
+    found, fetched = violations(title_13_rules(DIGEST, ''),
+                                [item('tracts', LICENSE_INFO=None), item('blocks', LICENSE_INFO='Public domain')])
+    assert found == [('title_13_terms_of_use', 'tracts'), ('title_13_wrong_terms_of_use', 'blocks')]
+
+
+def test_no_policy_configured():
+    assert policy_rules() == []
+
+
+def test_required_tags():
+    found, fetched = violations(policy_rules(required_tags=['Census']),
+                                [item('tracts'), item('blocks', TAGS="'censuses'"), item('places', TAGS=None)])
+    assert found == [('required_tags', 'blocks'), ('required_tags', 'places')]
+    assert fetched == []
+
+
+def test_public_sharing():
+    found, fetched = violations(policy_rules(public_item_types=['Web Map']),
+                                [item('tracts', SHARED_WITH_EVERYONE=True),
+                                 item('blocks', TYPE='Feature Service', SHARED_WITH_EVERYONE='True'),
+                                 item('places', TYPE='Feature Service')])
+    assert found == [('public_sharing', 'blocks')]
+
+
+def test_stale_item():
+    found, fetched = violations(policy_rules(stale_days=30, today='2020-07-15'),
+                                [item('tracts', VIEWS=0, MODIFIED='06/14/2020'),
+                                 item('blocks', VIEWS=0, MODIFIED='06/16/2020'),
+                                 item('places', VIEWS=3, MODIFIED='01/01/2019')])
+    assert found == [('stale_item', 'tracts')]
+
+
+def test_oversize_item():
+    found, fetched = violations(policy_rules(max_size_mb=100),
+                                [item('tracts', SIZE=100), item('blocks', SIZE=100.5), item('places', SIZE=None)])
+    assert found == [('oversize_item', 'blocks')]
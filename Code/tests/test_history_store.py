@@ -0,0 +1,56 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from history_store import read_history, write_snapshot
+
+DAY_1 = datetime(2020, 6, 8)
+DAY_2 = datetime(2020, 6, 9)
+
+
+def test_empty_text_column(tmp_path):
+    # AUTHORITATIVE read from a day's items.csv with no values comes back as all-NaN floats
+    write_snapshot(tmp_path, 'items', pd.DataFrame({'ID': ['a'], 'AUTHORITATIVE': [np.nan]}), DAY_1)
+    write_snapshot(tmp_path, 'items', pd.DataFrame({'ID': ['b'], 'AUTHORITATIVE': ['true']}), DAY_2)
+    history = read_history(tmp_path, 'items').sort_values('snapshot')
+    assert history['AUTHORITATIVE'].isna().tolist() == [True, False]
+    assert history['AUTHORITATIVE'].iloc[1] == 'true'
+
+
+def test_no_rows(tmp_path):
+    write_snapshot(tmp_path, 'violations', pd.DataFrame(columns=['ID', 'MESSAGE']), DAY_1)
+    write_snapshot(tmp_path, 'violations', pd.DataFrame({'ID': ['a'], 'MESSAGE': ['No thumbnail']}), DAY_2)
+    history = read_history(tmp_path, 'violations')
+    assert history['MESSAGE'].tolist() == ['No thumbnail']
+
+
+def test_int_and_float(tmp_path):
+    write_snapshot(tmp_path, 'stats_by_user', pd.DataFrame({'User': ['a'], 'Min': [1]}), DAY_1)
+    write_snapshot(tmp_path, 'stats_by_user', pd.DataFrame({'User': ['a'], 'Min': [0.5]}), DAY_2)
+    history = read_history(tmp_path, 'stats_by_user').sort_values('snapshot')
+    assert history['Min'].tolist() == [1.0, 0.5]
+
+
+def test_chunks_starting_without_text(tmp_path):
+    chunks = [pd.DataFrame({'User': [None, None], 'Elapsed_Time': [0.1, 0.2]}),
+              pd.DataFrame({'User': ['jsmith', None], 'Elapsed_Time': [0.3, np.nan]})]
+    assert write_snapshot(tmp_path, 'all_requests', iter(chunks), DAY_1) == 4
+    history = read_history(tmp_path, 'all_requests')
+    assert sorted(history['User'].dropna()) == ['jsmith']
+    assert history['Elapsed_Time'].sum() == pytest.approx(0.6)
+
+
+def test_types(tmp_path):
+    frame = pd.DataFrame({'Count': pd.array([3, None], dtype='Int64'), 'Shared': [True, False],
+                          'Resource': pd.Categorical(['a.MapServer', None]),
+                          'Day': pd.period_range('2020-06-08', periods=2, freq='D'),
+                          'Date_Time': pd.to_datetime(['2020-06-08 10:00', None])})
+    write_snapshot(tmp_path, 'requests', frame, DAY_1)
+    history = read_history(tmp_path, 'requests')
+    assert history['Count'].tolist()[0] == 3.0 and pd.isna(history['Count'].iloc[1])
+    assert history['Shared'].tolist() == ['True', 'False']
+    assert history['Resource'].tolist()[0] == 'a.MapServer' and pd.isna(history['Resource'].iloc[1])
+    assert history['Day'].iloc[0] == pd.Timestamp('2020-06-08')
+    assert history['Date_Time'].iloc[0] == pd.Timestamp('2020-06-08 10:00')
@@ -0,0 +1,204 @@
+import csv
+import socketserver
+import threading
+from email import message_from_bytes
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('arcgis')
+pytest.importorskip('keyring')
+requests = pytest.importorskip('requests')
+
+import portal_audit_tools
+from governance import UNVERIFIABLE
+from mock_portal import SEARCH_WINDOW, MockPortal, load_fixture
+
+
+class Connection:
+    # The call signature of arcgis' Connection.get, served by the mock portal
+
+    def get(self, path, params=None, **kwargs):
+        return requests.get(path, params=params).json()
+
+
+def gis(url):
+    return SimpleNamespace(_portal=SimpleNamespace(resturl=url), _con=Connection(),
+                           url='https://gis.example.gov/portal')
+
+
+@pytest.fixture
+def portal():
+    mock = MockPortal().start()
+    yield mock
+    mock.stop()
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP for smtplib: every command is accepted, QUIT hangs up when the server says so
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost')
+        sender, recipients = None, []
+        for line in self.rfile:
+            command = line.decode('ascii').strip().upper()
+            if command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                self.server.messages.append((sender, recipients, message_from_bytes(data)))
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                if not self.server.drop_quit:
+                    self.reply('221 Bye')
+                return
+            else:
+                if command.startswith('MAIL FROM:'):
+                    sender = line.decode('ascii').strip()[10:].strip('<>')
+                elif command.startswith('RCPT TO:'):
+                    recipients.append(line.decode('ascii').strip()[8:].strip('<>'))
+                self.reply('250 OK')
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SmtpHandler)
+    server.daemon_threads = True
+    server.messages = []
+    server.drop_quit = False
+    server.address = '127.0.0.1:{0}'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def items_frame(records):
+    return pd.DataFrame([portal_audit_tools.get_item_row(portal_audit_tools.Item(gis(''), record['id'], record),
+                                                         (None, None, None)) for record in records],
+                        columns=portal_audit_tools.ITEM_FIELDS)
+
+
+def request_rows(*rows):
+    # all_requests sheet rows from (time, resource, user)
+    times = pd.to_datetime([time for time, resource, user in rows])
+    return pd.DataFrame({'Date Time (Local Time)': times, 'Epoch Time': times.astype('int64') // 10 ** 6,
+                         'Date Time (Day)': times.floor('D'), 'Date Time (Hour)': times.floor('h'),
+                         'Date Time (Minute)': times.floor('min'), 'User': [user for time, resource, user in rows],
+                         'Server Machine': 'GIS1', 'Content Length (Bytes)': 1024, 'HTTP Code': 200,
+                         'Elapsed Time (>= 0 sec)': 0.25, 'Elapsed Time (Floor)': 0,
+                         'Resource': [resource for time, resource, user in rows], 'ArcGIS Method': 'query',
+                         'ArcGIS Code': 0, 'ArcGIS Type': 'FINE'})
+
+
+def test_thumbnail_failures_are_unverifiable(monkeypatch):
+    def thumbnail_digest(item):
+        if item.id == 'b':
+            raise ConnectionError('Connection reset')
+        return 'digest-' + item.id
+
+    monkeypatch.setattr(portal_audit_tools, 'thumbnail_digest', thumbnail_digest)
+    items = pd.DataFrame({'ID': ['a', 'b', 'c'], 'TYPE': 'Web Map', 'THUMBNAIL': ['a.png', 'b.png', 'c.png'],
+                          'MODIFIED_EPOCH': [1, 2, 3]})
+    used = {}
+    digests = portal_audit_tools.get_thumbnail_digests(gis(''), items, {'c|c.png|3': 'cached'}, used, workers=2)
+    assert digests.tolist() == ['digest-a', UNVERIFIABLE, 'cached']
+    # Only the downloaded and reused digests are cached, the failed one is downloaded again next run
+    assert used == {'a|a.png|1': 'digest-a', 'c|c.png|3': 'cached'}
+
+
+def test_title_13_items_include_skipped_types(portal):
+    # The mock portal ignores the search text, so every item is a search result. arcgis drops a size of -1 and
+    # requests the whole item when it is read, which the mock portal doesn't serve.
+    records = [dict(record, size=2048000) for record in load_fixture('items')]
+    exported = items_frame(records[1:])
+    portal.items = records + [dict(records[0], id='99ff88ee77dd66cc55bb44aa33221100', type='Service Definition')]
+
+    titled = portal_audit_tools.title_13_items(gis(portal.url), exported)
+    assert sorted(titled['ID']) == sorted(record['id'] for record in portal.items)
+    assert titled.loc[titled['ID'] == '99ff88ee77dd66cc55bb44aa33221100', 'TYPE'].tolist() == ['Service Definition']
+    assert list(titled.columns) == portal_audit_tools.ITEM_FIELDS
+
+
+def test_notification_digests(smtp_server):
+    notifications = portal_audit_tools.NotificationQueue(smtp_server.address, 'gis@example.gov')
+    notifications.add('jsmith@example.gov', 'Tracts is missing tags', 'Add the census tag')
+    notifications.add('adoe@example.gov', 'Blocks is public', 'Share it with the organization')
+    notifications.add('jsmith@example.gov', 'Places is stale', 'Update or delete it')
+    notifications.send()
+
+    assert [(sender, recipients, message['Subject']) for sender, recipients, message in smtp_server.messages] == \
+        [('gis@example.gov', ['adoe@example.gov'], '1 items are not compliant with portal governance'),
+         ('gis@example.gov', ['jsmith@example.gov'], '2 items are not compliant with portal governance')]
+    body = smtp_server.messages[1][2].get_payload(decode=True).decode('utf-8')
+    assert 'Tracts is missing tags' in body and 'Places is stale' in body
+
+
+def test_failed_quit_keeps_the_original_error(smtp_server, monkeypatch):
+    smtp_server.drop_quit = True
+    notifications = portal_audit_tools.NotificationQueue(smtp_server.address, 'gis@example.gov')
+    notifications.add('jsmith@example.gov', 'Tracts is missing tags', 'Add the census tag')
+    notifications.add('adoe@example.gov', 'Blocks is public', 'Share it with the organization')
+    notifications.send()
+    assert len(smtp_server.messages) == 2
+
+    def send_email(smtp, sender, recipient, subject, body):
+        raise ValueError('Bad address {0}'.format(recipient))
+
+    monkeypatch.setattr(portal_audit_tools, 'send_email', send_email)
+    with pytest.raises(ValueError, match='adoe@example.gov'):
+        notifications.send()
+
+
+def test_search_past_the_search_window(portal):
+    # Seven items to each created time, so the first window ends part way through the items of one time
+    record = dict(load_fixture('items')[0], size=2048000)
+    portal.items = [dict(record, id='{0:032x}'.format(n), created=1546300800000 + n // 7)
+                    for n in range(SEARCH_WINDOW + 250)]
+
+    ids = [item.id for item in portal_audit_tools.search_items(gis(portal.url), '*')]
+    assert len(ids) == len(set(ids)) == SEARCH_WINDOW + 250
+    anchored = [query for query in portal.requests if 'created:[' in query['q']]
+    assert anchored and anchored[0]['start'] == '1'
+    assert all(int(query['start']) + int(query['num']) - 1 <= SEARCH_WINDOW for query in portal.requests)
+
+
+def test_split_resources():
+    resources = pd.Series(['Census/Tracts.MapServer', 'Roads.FeatureServer', None, 'Census/Tracts.MapServer',
+                           'Tracts.MapServer', 'Utilities'])
+    codes, names, types = portal_audit_tools.split_resources(resources)
+    assert codes.tolist() == [0, 1, -1, 0, 2, 3]
+    assert names.tolist() == ['Tracts', 'Roads', 'Tracts', 'Utilities']
+    assert types.tolist() == ['MapServer', 'FeatureServer', 'MapServer', '']
+
+
+@pytest.mark.parametrize('keep', [False, True])
+def test_export_all_requests(keep, tmp_path):
+    chunks = [request_rows(('2020-06-08 10:00', 'Census/Tracts.MapServer', 'jsmith'),
+                           ('2020-06-08 10:05', 'Tools/Buffer.GPServer', 'jsmith'),
+                           ('2020-06-08 10:06', None, '-')),
+              request_rows(('2020-06-08 09:00', 'Census/Tracts.MapServer', 'adoe'),
+                           ('2020-06-08 11:00', 'Roads.FeatureServer', 'adoe'))]
+    csv_path = str(tmp_path / 'all_requests.csv')
+    last_accessed, rows, kept = portal_audit_tools.export_all_requests(iter(chunks), csv_path, keep=keep)
+
+    assert rows == 3
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        written = list(csv.DictReader(f))
+    assert list(written[0]) == list(portal_audit_tools.ALL_REQUESTS_COLUMNS.values())
+    assert [(row['Resource'], row['User']) for row in written] == \
+        [('Census/Tracts.MapServer', 'jsmith'), ('Census/Tracts.MapServer', 'adoe'), ('Roads.FeatureServer', 'adoe')]
+    # The last request of every service, GP services included, across both chunks
+    assert last_accessed.to_dict() == {('FeatureServer', 'Roads'): pd.Timestamp('2020-06-08 11:00'),
+                                       ('GPServer', 'Buffer'): pd.Timestamp('2020-06-08 10:05'),
+                                       ('MapServer', 'Tracts'): pd.Timestamp('2020-06-08 10:00')}
+    if keep:
+        assert kept['User'].tolist() == ['jsmith', 'adoe', 'adoe']
+        assert list(kept.columns) == list(portal_audit_tools.ALL_REQUESTS_COLUMNS.values())
+    else:
+        assert kept is None
@@ -0,0 +1,94 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+import rollups
+from rollups import (GAMMA, MIN_ELAPSED, QUANTILES, SKETCH_ACCURACY, bucket_value, fold, merge_folds,
+                     prepare_requests, read_rollup, sketch_bucket, summarize, update_rollups)
+
+TODAY = datetime(2020, 6, 9)
+
+
+def requests(*rows):
+    # all_requests.csv rows: (time, service, user, elapsed)
+    return pd.DataFrame([{'Date_Time': time, 'Resource': service, 'User': user, 'Server_Machine': 'GIS1',
+                          'Elapsed_Time': elapsed, 'Content_Length_Bits': 1024}
+                         for time, service, user, elapsed in rows])
+
+
+def service_day(rollup_dir):
+    return pd.concat(read_rollup(str(rollup_dir), 'service_day')).set_index('Resource')['Requests'].to_dict()
+
+
+def test_sketch_bucket():
+    values = np.geomspace(MIN_ELAPSED, 600, 5000)
+    buckets = sketch_bucket(values)
+    assert (GAMMA ** (buckets - 1.0) < values * (1 + 1e-12)).all()
+    assert (values <= GAMMA ** buckets.astype(float) * (1 + 1e-12)).all()
+    assert (np.abs(bucket_value(buckets) - values) <= SKETCH_ACCURACY * values * (1 + 1e-9)).all()
+    assert sketch_bucket(np.array([0.0, MIN_ELAPSED / 10])).tolist() == \
+        sketch_bucket(np.array([MIN_ELAPSED])).tolist() * 2
+
+
+def test_merged_folds_equal_one_fold():
+    rng = np.random.default_rng(7)
+    times = pd.Timestamp('2020-06-08') + pd.to_timedelta(rng.integers(0, 86400, 2000), unit='s')
+    chunk = prepare_requests(requests(*zip(times, rng.choice(['a.MapServer', 'b.MapServer'], 2000),
+                                           rng.choice(['jsmith', 'adoe'], 2000), rng.lognormal(-1, 1, 2000))))
+    whole = fold(chunk, 'service', 'hour')
+    merged = merge_folds([fold(chunk.iloc[:700], 'service', 'hour'), None,
+                          fold(chunk.iloc[700:], 'service', 'hour')])
+    pd.testing.assert_frame_equal(whole.sort_values(rollups.FOLD_KEYS, ignore_index=True),
+                                  merged.sort_values(rollups.FOLD_KEYS, ignore_index=True), check_dtype=False)
+
+
+@pytest.mark.parametrize('count', [1, 2, 20, 5000])
+def test_quantiles_against_exact(count):
+    rng = np.random.default_rng(count)
+    elapsed = rng.lognormal(-1, 1.5, count)
+    chunk = prepare_requests(requests(*[('2020-06-08 10:00', 'a.MapServer', 'jsmith', value) for value in elapsed]))
+    summary = summarize(fold(chunk, 'service', 'day'), 'service').iloc[0]
+    assert summary['Requests'] == count
+    assert summary['Avg_Elapsed'] == pytest.approx(elapsed.mean())
+    assert summary['Max_Elapsed'] == elapsed.max()
+    for column, quantile in QUANTILES.items():
+        exact = np.quantile(elapsed, quantile, method='lower')
+        assert abs(summary[column] - exact) <= SKETCH_ACCURACY * exact
+
+
+def test_requests_at_the_watermark_are_added_once(tmp_path):
+    first = requests(('2020-06-08 10:00:00', 'a.MapServer', 'jsmith', 0.2),
+                     ('2020-06-08 10:00:05', 'a.MapServer', 'jsmith', 0.4),
+                     ('2020-06-08 10:00:05', 'a.MapServer', 'adoe', 0.4))
+    update_rollups(str(tmp_path), [first], today=TODAY)
+
+    # The next window overlaps: the requests at the last time seen come again, beside new ones at the same time
+    second = requests(('2020-06-08 10:00:05', 'a.MapServer', 'jsmith', 0.4),
+                      ('2020-06-08 10:00:05', 'a.MapServer', 'adoe', 0.4),
+                      ('2020-06-08 10:00:05', 'b.MapServer', 'adoe', 0.4),
+                      ('2020-06-08 10:00:05', 'a.MapServer', 'jsmith', 0.4))
+    update_rollups(str(tmp_path), [second.iloc[:2], second.iloc[2:]], today=TODAY)
+    assert service_day(tmp_path) == {'a.MapServer': 4, 'b.MapServer': 1}
+
+    # Reruns add nothing
+    update_rollups(str(tmp_path), [second], today=TODAY)
+    update_rollups(str(tmp_path), [first], today=TODAY)
+    assert service_day(tmp_path) == {'a.MapServer': 4, 'b.MapServer': 1}
+
+
+def test_partitions_without_a_watermark(tmp_path):
+    update_rollups(str(tmp_path), [requests(('2020-06-08 10:00:05', 'a.MapServer', 'jsmith', 0.4))], today=TODAY)
+    partition = rollups.partition_file(str(tmp_path), 'service_day', pd.Timestamp('2020-06-08'))
+    table = pq.read_table(partition, partitioning=None)
+    metadata = dict(table.schema.metadata)
+    del metadata[rollups.WATERMARK_KEY]
+    pq.write_table(table.replace_schema_metadata(metadata), partition)
+
+    # Every request at the latest time counts as folded in, like before watermarks were kept
+
+    update_rollups(str(tmp_path), [requests(('2020-06-08 10:00:05', 'a.MapServer', 'jsmith', 0.4),
+                                            ('2020-06-08 10:00:06', 'a.MapServer', 'jsmith', 0.4))], today=TODAY)
+    assert service_day(tmp_path) == {'a.MapServer': 2}
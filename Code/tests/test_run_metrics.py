@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+import run_metrics
+from run_metrics import RunMetrics, current_rss_mb, endpoint_name
+
+
+class Connection:
+    # The call signature of arcgis' Connection.get / post
+
+    def get(self, path, params=None, **kwargs):
+        return path
+
+    def post(self, path, postdata=None, **kwargs):
+        raise RuntimeError('Token required')
+
+
+def test_instrument_positional_and_keyword_urls():
+    metrics = RunMetrics()
+    connection = Connection()
+    metrics.instrument(connection)
+
+    assert connection.get('https://gis.example.gov/portal/sharing/rest/community/users/jsmith', {'f': 'json'}) == \
+        'https://gis.example.gov/portal/sharing/rest/community/users/jsmith'
+    assert connection.get(path='https://gis.example.gov/portal/sharing/rest/search', params={'q': '*'}) == \
+        'https://gis.example.gov/portal/sharing/rest/search'
+    with pytest.raises(RuntimeError):
+        connection.post(path='https://gis.example.gov/portal/sharing/rest/content/items/'
+                             '11aa22bb33cc44dd55ee66ff77889901/update')
+
+    requests = metrics.report()['requests']
+    assert requests['/community/users/{username}']['count'] == 1
+    assert requests['/search']['count'] == 1
+    assert requests['/content/items/{id}/update']['errors'] == 1
+
+
+def test_endpoint_name():
+    assert endpoint_name('https://gis.example.gov/portal/sharing/rest/community/groups/'
+                         '4f1e2d3c4b5a49687766554433221101/users?f=json') == '/community/groups/{id}/users'
+
+
+def test_stage_peak_rss_is_the_stage_own(monkeypatch):
+    if current_rss_mb() is None:
+        pytest.skip('No way to read the current RSS here')
+    monkeypatch.setattr(run_metrics, 'RSS_SAMPLE_SECONDS', 0.01)
+    metrics = RunMetrics()
+    with metrics.stage('large'):
+        block = b'x' * (200 * 1024 * 1024)
+        time.sleep(0.2)
+        del block
+    with metrics.stage('small'):
+        time.sleep(0.2)
+
+    large, small = metrics.stages['large'], metrics.stages['small']
+    assert large['peak_rss_mb'] - large['start_rss_mb'] >= 150
+    # The process peak is still the large stage's, the small stage reports its own
+    assert small['peak_rss_mb'] < large['peak_rss_mb'] - 150
+    assert metrics.report()['peak_rss_mb'] >= large['peak_rss_mb'] - 1
+    assert not metrics.running
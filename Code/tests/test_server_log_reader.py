@@ -0,0 +1,125 @@
+from datetime import datetime
+from os import path
+
+import pandas as pd
+import pytest
+
+import server_log_reader
+from server_log_reader import read_server_logs
+
+from conftest import DATA_DIR
+
+SAMPLE_LOGS = path.join(DATA_DIR, 'server_logs')
+
+# With a 90 minute window this covers every sample request except the one at 11:30
+END_TIME = datetime(2020, 6, 8, 11, 0)
+
+
+@pytest.fixture(params=[1, 2], ids=['single', 'pool'])
+def frames(request):
+    return read_server_logs(SAMPLE_LOGS, window_minutes=90, end_time=END_TIME, workers=request.param)
+
+
+def test_all_requests(frames):
+    requests = frames['all_requests']
+    assert len(requests) == 6
+    assert requests['Date Time (Local Time)'].is_monotonic_increasing
+    assert set(requests['Server Machine']) == {'GIS1', 'GIS2'}
+
+    first = requests.iloc[0]
+    assert first['Resource'] == 'Census/Tracts.MapServer'
+    assert first['User'] == 'jsmith'
+    assert first['Content Length (Bytes)'] == 10240
+    assert first['Elapsed Time (>= 0 sec)'] == 0.25
+    assert first['Date Time (Minute)'] == datetime(2020, 6, 8, 9, 59)
+
+
+def test_request_details(frames):
+    requests = frames['all_requests'].set_index('Date Time (Local Time)')
+    anonymous = requests.loc[datetime(2020, 6, 8, 10, 0, 40)]
+    assert anonymous['User'] == '-'
+    assert anonymous['Elapsed Time (Floor)'] == 1
+
+    failed = requests.loc[datetime(2020, 6, 8, 10, 1, 20)]
+    assert failed['HTTP Code'] == 500
+    assert failed['ArcGIS Type'] == 'SEVERE'
+
+
+def test_stats(frames):
+    by_user = frames['stats_by_user'].set_index(['Resource', 'User'])
+    assert by_user['Count'].sum() == 6
+    assert by_user.loc[('Census/Tracts.MapServer', 'jsmith'), 'Count'] == 2
+    assert by_user.loc[('Census/Tracts.MapServer', 'jsmith'), 'Max'] == 0.25
+
+    by_resource = frames['stats_by_resource']
+    assert set(by_resource['Capability']) == {'MapServer', 'FeatureServer', 'GPServer'}
+    assert by_resource['Count Pct'].sum() == pytest.approx(100)
+
+
+def test_throughput(frames):
+    throughput = frames['throughput'].set_index('Date Time (Local Time)')
+    assert throughput['Requests/Minute'].sum() == 6
+    minute = throughput.loc[datetime(2020, 6, 8, 10, 0)]
+    assert minute['Requests/Minute'] == 3
+    assert minute['HTTP 200'] == 3
+    assert throughput.loc[datetime(2020, 6, 8, 10, 1), 'HTTP 500'] == 1
+
+
+def test_memory_mapped_reads(monkeypatch):
+    monkeypatch.setattr(server_log_reader, 'MMAP_THRESHOLD', 0)
+    frames = read_server_logs(SAMPLE_LOGS, window_minutes=90, end_time=END_TIME, workers=1)
+    assert len(frames['all_requests']) == 6
+
+
+def test_record_batches(monkeypatch, frames):
+    monkeypatch.setattr(server_log_reader, 'RECORD_BATCH_ROWS', 4)
+    log_files = list(server_log_reader.list_log_files(SAMPLE_LOGS, 0))
+    start_time = datetime(2020, 6, 8, 9, 30)
+    assert [len(frame) for frame in server_log_reader.read_log_group(log_files, start_time, END_TIME)] == [4, 2]
+
+    batched = read_server_logs(SAMPLE_LOGS, window_minutes=90, end_time=END_TIME, workers=1)
+    for name in frames:
+        assert batched[name].equals(frames[name])
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_chunked_read(frames, workers, tmp_path):
+    spill_dir = str(tmp_path / 'all_requests_parts')
+    (tmp_path / 'all_requests_parts').mkdir()
+    (tmp_path / 'all_requests_parts' / 'part-009.parquet').write_bytes(b'left by an earlier run')
+    chunked = read_server_logs(SAMPLE_LOGS, window_minutes=90, end_time=END_TIME, workers=workers, chunk_rows=4,
+                               spill_dir=spill_dir)
+    for name in ['throughput', 'stats_by_user', 'stats_by_resource']:
+        pd.testing.assert_frame_equal(chunked[name], frames[name])
+
+    chunks = list(chunked['all_requests'])
+    assert all(len(chunk) <= 4 and chunk['Date Time (Local Time)'].is_monotonic_increasing for chunk in chunks)
+    requests = pd.concat(chunks).sort_values(['Date Time (Local Time)', 'Server Machine'], ignore_index=True)
+    expected = frames['all_requests'].sort_values(['Date Time (Local Time)', 'Server Machine'], ignore_index=True)
+    pd.testing.assert_frame_equal(requests, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('log_dir', ['server_logs_warning', 'missing'])
+def test_no_requests_gives_empty_frames(log_dir, tmp_path):
+    # WARNING level logs have no request timings, and an empty directory has no logs at all
+    log_dir = path.join(DATA_DIR, log_dir) if log_dir != 'missing' else str(tmp_path)
+    frames = read_server_logs(log_dir, window_minutes=90, end_time=END_TIME, workers=1)
+    chunked = read_server_logs(log_dir, window_minutes=90, end_time=END_TIME, workers=1, chunk_rows=4,
+                               spill_dir=str(tmp_path / 'all_requests_parts'))
+    assert list(chunked.pop('all_requests')) == []
+    for name in chunked:
+        pd.testing.assert_frame_equal(chunked[name], frames[name], check_dtype=False)
+    for name, columns in [('all_requests', 'Resource'), ('throughput', 'Requests/Minute'),
+                          ('stats_by_user', 'P95'), ('stats_by_resource', 'Capability')]:
+        assert len(frames[name]) == 0
+        assert columns in frames[name].columns
+
+
+def test_split_log_files(tmp_path):
+    sizes = {'a.log': 900, 'b.log': 500, 'c.log': 400, 'd.log': 300, 'e.log': 100}
+    for name, size in sizes.items():
+        (tmp_path / name).write_bytes(b' ' * size)
+    groups = server_log_reader.split_log_files([str(tmp_path / name) for name in sizes], 3)
+    assert [[path.basename(log_file) for log_file in group] for group in groups] == \
+        [['a.log'], ['b.log', 'e.log'], ['c.log', 'd.log']]
+    assert server_log_reader.split_log_files([str(tmp_path / 'a.log')], 4) == [[str(tmp_path / 'a.log')]]
@@ -0,0 +1,90 @@
+import sqlite3
+from contextlib import closing
+
+import pandas as pd
+import pytest
+
+import table_store
+from table_store import SqliteTableStore, open_table_store
+
+ITEMS = pd.DataFrame({'ID': ['a', 'b', 'c'], 'VIEWS': [3, 0, 7], 'SIZE': [0.5, None, 2.0],
+                      'CREATED': pd.to_datetime(['2020-06-08 10:00:01.250', '2020-06-09 00:00:00.000', None]),
+                      'Day': pd.period_range('2020-06-08', periods=3, freq='D')})
+
+
+@pytest.fixture(params=['audit.sqlite', 'audit.gpkg'])
+def store(request, tmp_path):
+    return open_table_store(str(tmp_path / request.param))
+
+
+def query(store, sql, *params):
+    with closing(sqlite3.connect(store.database)) as connection:
+        return connection.execute(sql, params).fetchall()
+
+
+def columns(store, name):
+    return [row[1] for row in query(store, 'PRAGMA table_info("{0}")'.format(name)) if row[1] != 'fid']
+
+
+def test_ensure_table(store):
+    with closing(store.connect()) as connection, connection:
+        store.ensure_table(connection, 'items', ITEMS)
+        store.ensure_table(connection, 'items', ITEMS.assign(LICENSE_INFO='Public domain'))
+    assert columns(store, 'items') == ['ID', 'VIEWS', 'SIZE', 'CREATED', 'Day', 'LICENSE_INFO']
+    assert query(store, 'SELECT COUNT(*) FROM items') == [(0,)]
+
+
+def test_geopackage_tables_are_registered(tmp_path):
+    database = str(tmp_path / 'audit.gpkg')
+    with closing(sqlite3.connect(database)) as connection, connection:
+        # A table written before tables were registered
+        ITEMS[['ID', 'VIEWS']].to_sql('groups', connection, index=False)
+
+    store = SqliteTableStore(database)
+    store.replace_all({'items': ITEMS, 'all_requests': iter([ITEMS, ITEMS]), 'groups': ITEMS})
+    assert query(store, 'PRAGMA application_id') == [(0x47504B47,)]
+    assert sorted(query(store, 'SELECT table_name, data_type FROM gpkg_contents')) == \
+        [('all_requests', 'attributes'), ('groups', 'attributes'), ('items', 'attributes')]
+    assert query(store, "SELECT srs_id FROM gpkg_spatial_ref_sys ORDER BY srs_id") == [(-1,), (0,), (4326,)]
+    assert query(store, 'SELECT fid, CREATED FROM items') == \
+        [(1, '2020-06-08T10:00:01.250'), (2, '2020-06-09T00:00:00.000'), (3, None)]
+    assert query(store, 'SELECT COUNT(*) FROM all_requests') == [(6,)]
+
+
+def test_ensure_key(store):
+    store.ensure_key('items', 'KEY')
+    assert query(store, "SELECT name FROM sqlite_master WHERE name = 'items'") == []
+
+    store.replace_all({'items': ITEMS})
+    store.ensure_key('items', 'KEY')
+    store.ensure_key('items', 'KEY')
+    assert columns(store, 'items') == ['ID', 'VIEWS', 'SIZE', 'CREATED', 'Day', 'KEY']
+
+
+def test_upsert(store):
+    store.upsert('items', ITEMS.assign(KEY=ITEMS['ID']), 'KEY', set())
+    store.upsert('items', pd.DataFrame({'ID': ['b', 'd'], 'VIEWS': [1, 0], 'KEY': ['b', 'd']}), 'KEY', {'b', 'c'})
+    assert query(store, 'SELECT KEY, VIEWS, Day FROM items ORDER BY KEY') == \
+        [('a', 3, '2020-06-08'), ('b', 1, None), ('d', 0, None)]
+
+    store.upsert('items', ITEMS.iloc[:0].assign(KEY=[]), 'KEY', {'a'})
+    assert query(store, 'SELECT KEY FROM items ORDER BY KEY') == [('b',), ('d',)]
+
+
+def test_connections_are_closed(store, monkeypatch):
+    connections = []
+    sqlite_connect = sqlite3.connect
+
+    def connect(database):
+        connections.append(sqlite_connect(database))
+        return connections[-1]
+
+    monkeypatch.setattr(table_store.sqlite3, 'connect', connect)
+    store.replace_all({'items': ITEMS})
+    store.ensure_key('items', 'KEY')
+    store.upsert('items', ITEMS.assign(KEY=ITEMS['ID']), 'KEY', {'a'})
+    store.compact()
+    assert len(connections) == 4
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute('SELECT 1')